@@ -0,0 +1,134 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Any
+from weakref import WeakValueDictionary
+from registrationAPI.registration_api import API
+from registrationAPI.storage import Store
+
+
+class AsyncAPI:
+    def __init__(self, store: Store = None, max_workers: int = 32, api: API = None):
+        """
+        The same surface as API, for ASGI frameworks such as Quart. Storage, encryption and mail I/O run on a bounded
+        thread pool instead of the event loop, and changes to the same user, group or org are serialized with
+        per-key asyncio locks.
+        :param store: Where to keep all data. Defaults to the store configured by RAPI_STORAGE.
+        :param max_workers: The maximum number of blocking calls running at once
+        :param api: An existing API to wrap (store is ignored if provided)
+        """
+        self.api = api or API(store)
+        self.store = self.api.store
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='async-api')
+        self._locks = WeakValueDictionary()  # Locks disappear once no coroutine holds or waits on them
+
+    async def _run(self, func, *args, **kwargs) -> Any:
+        return await asyncio.get_running_loop().run_in_executor(self._executor, partial(func, *args, **kwargs))
+
+    def _lock(self, *key) -> asyncio.Lock:
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = self._locks[key] = asyncio.Lock()
+        return lock
+
+    async def _locked(self, key: tuple, func, *args, **kwargs) -> Any:
+        async with self._lock(*key):
+            return await self._run(func, *args, **kwargs)
+
+    def close(self) -> None:
+        """
+        Wait for running calls to finish and shut down the thread pool
+        """
+        self._executor.shutdown(wait=True)
+
+    # Authentication
+
+    async def register(self, username: str, email: str, password: str, **kwargs) -> Any:
+        # Two signups with the same email would otherwise both pass the uniqueness check
+        return await self._locked(('email', email), self.api.register, username, email, password, **kwargs)
+
+    async def login(self, session, identifier, password, **kwargs) -> Any:
+        return await self._run(self.api.login, session, identifier, password, **kwargs)
+
+    async def logout(self, session, **kwargs) -> Any:
+        return self.api.logout(session, **kwargs)  # Doesn't touch storage
+
+    async def verify(self, token) -> Any:
+        return await self._locked(('token', token), self.api.verify, token)
+
+    async def change_email(self, user_id, new_email, **kwargs) -> Any:
+        return await self._locked(('user', user_id), self.api.change_email, user_id, new_email, **kwargs)
+
+    async def change_username(self, user_id, new_username) -> Any:
+        return await self._locked(('user', user_id), self.api.change_username, user_id, new_username)
+
+    async def change_password(self, user_id, new_password) -> Any:
+        return await self._locked(('user', user_id), self.api.change_password, user_id, new_password)
+
+    async def handle_social_login(self, username, platform, session) -> Any:
+        return await self._locked(('social', platform, username), self.api.handle_social_login, username, platform,
+                                  session)
+
+    async def link_social_account(self, user_id, social_name, social_platform) -> bool:
+        return await self._locked(('user', user_id), self.api.link_social_account, user_id, social_name,
+                                  social_platform)
+
+    async def unlink_social_account(self, user_id, social_platform) -> bool:
+        return await self._locked(('user', user_id), self.api.unlink_social_account, user_id, social_platform)
+
+    async def delete_account(self, user_id: str, session: dict = None) -> None:
+        return await self._locked(('user', user_id), self.api.delete_account, user_id, session)
+
+    async def delete_accounts(self, user_ids, **kwargs) -> dict:
+        return await self._run(self.api.delete_accounts, user_ids, **kwargs)
+
+    # Group management functions
+
+    async def create_group(self, owner_id: str, name: str) -> str:
+        return await self._run(self.api.create_group, owner_id, name)
+
+    async def modify_group(self, group_id: str, **kwargs) -> Any:
+        return await self._locked(('group', group_id), self.api.modify_group, group_id, **kwargs)
+
+    async def delete_group(self, group_id: str) -> None:
+        return await self._locked(('group', group_id), self.api.delete_group, group_id)
+
+    # Organization management functions
+
+    async def create_org(self, owner_id: str, name: str) -> str:
+        return await self._run(self.api.create_org, owner_id, name)
+
+    async def modify_org(self, org_id: str, **kwargs) -> Any:
+        return await self._locked(('org', org_id), self.api.modify_org, org_id, **kwargs)
+
+    async def delete_org(self, org_id: str) -> None:
+        return await self._locked(('org', org_id), self.api.delete_org, org_id)
+
+    async def modify_many(self, changes: dict, kind: str = 'groups') -> Any:
+        return await self._run(self.api.modify_many, changes, kind)
+
+    async def add_group_to_org(self, org_id: str, group_id: str) -> Any:
+        return await self._locked(('org', org_id), self.api.add_group_to_org, org_id, group_id)
+
+    async def remove_group_from_org(self, org_id: str, group_id: str) -> bool:
+        return await self._locked(('org', org_id), self.api.remove_group_from_org, org_id, group_id)
+
+    async def groups_of_org(self, org_id: str, **kwargs) -> tuple:
+        return await self._run(self.api.groups_of_org, org_id, **kwargs)
+
+    # Membership functions
+
+    async def add_member(self, entity_id: str, user_id: str, kind: str = 'groups') -> Any:
+        return await self._locked(('user', user_id), self.api.add_member, entity_id, user_id, kind)
+
+    async def remove_member(self, entity_id: str, user_id: str, kind: str = 'groups') -> bool:
+        return await self._locked(('user', user_id), self.api.remove_member, entity_id, user_id, kind)
+
+    async def members_of(self, entity_id: str, **kwargs) -> tuple:
+        return await self._run(self.api.members_of, entity_id, **kwargs)
+
+    async def groups_for_user(self, user_id: str, **kwargs) -> tuple:
+        return await self._run(self.api.groups_for_user, user_id, **kwargs)
+
+    async def orgs_for_user(self, user_id: str, **kwargs) -> tuple:
+        return await self._run(self.api.orgs_for_user, user_id, **kwargs)
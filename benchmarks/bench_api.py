@@ -0,0 +1,237 @@
+"""
+Latency percentiles and throughput of the main API operations against synthetic datasets of increasing size.
+Outgoing mail is delivered to a local SMTP sink. Results are written as JSON, so runs on different commits can be
+compared.
+
+Usage: python benchmarks/bench_api.py [--users 1000,100000,1000000] [--samples 1000] [--backend pyntree]
+                                      [--output results.json]
+Each dataset size runs in a fresh process, in a scratch folder which is deleted afterwards (unless --keep).
+Set RAPI_AUTHKEY to include the cost of encrypting user records.
+(registrationAPI must be importable, e.g. run from the folder containing it with PYTHONPATH=.)
+"""
+import json
+import os
+import platform
+import random
+import shutil
+import socketserver
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from argparse import ArgumentParser
+from datetime import datetime, timedelta
+
+parser = ArgumentParser()
+parser.add_argument('--users', default='1000,100000,1000000', help='Comma-separated dataset sizes')
+parser.add_argument('--samples', type=int, default=1000, help='Calls per operation')
+parser.add_argument('--backend', default='pyntree', choices=['pyntree', 'sqlite'])
+parser.add_argument('--seed', type=int, default=0)
+parser.add_argument('--output', help='Write the results to this file instead of stdout')
+parser.add_argument('--keep', action='store_true', help="Don't delete the generated datasets")
+parser.add_argument('--password-hash', default='scrypt:n=1024,r=8,p=1',
+                    help='The hashing cost, kept low so generating large datasets stays feasible '
+                         '(see bench_passwords.py for the cost of realistic settings)')
+parser.add_argument('--run-size', type=int, help='(internal) Benchmark a single dataset size in this process')
+args = parser.parse_args()
+os.environ['RAPI_PASSWORD_HASH'] = args.password_hash
+
+UNVERIFIED_SHARE = 0.1  # Pending signups, relative to the number of users (half of them expired)
+SOCIAL_SHARE = 0.1  # Users with a linked social account
+
+TEMPLATE = '<a href="https://example.com/verify?token={{ token }}">Verify</a> ' \
+           '<a href="https://example.com/unsubscribe?id={{ unsub_id }}">Unsubscribe</a>'
+
+
+class SMTPSink(socketserver.StreamRequestHandler):
+    # Accepts and discards everything, as quickly as possible
+    received = 0
+
+    def handle(self):
+        self.reply('220 sink')
+        in_data = False
+        for line in self.rfile:
+            if in_data:
+                if line.rstrip(b'\r\n') == b'.':
+                    in_data = False
+                    SMTPSink.received += 1
+                    self.reply('250 ok')
+                continue
+            command = line[:4].upper()
+            if command == b'DATA':
+                in_data = True
+                self.reply('354 go ahead')
+            elif command == b'QUIT':
+                self.reply('221 bye')
+                return
+            else:
+                self.reply('250 ok')
+
+    def reply(self, text):
+        self.wfile.write(text.encode() + b'\r\n')
+
+
+def start_sink() -> socketserver.ThreadingTCPServer:
+    server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), SMTPSink)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def summarize(latencies: list, elapsed: float, errors: int = 0) -> dict:
+    latencies = sorted(latencies)
+
+    def percentile(p):
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p / 100))] * 1000
+
+    return {
+        "samples": len(latencies),
+        "errors": errors,
+        "mean_ms": sum(latencies) / len(latencies) * 1000,
+        "p50_ms": percentile(50),
+        "p90_ms": percentile(90),
+        "p99_ms": percentile(99),
+        "max_ms": latencies[-1] * 1000,
+        "ops_per_sec": len(latencies) / elapsed,
+    }
+
+
+def measure(func, calls) -> dict:
+    latencies = []
+    errors = 0
+    start = time.perf_counter()
+    for call in calls:
+        begin = time.perf_counter()
+        result = func(*call)
+        latencies.append(time.perf_counter() - begin)
+        if isinstance(result, tuple) and len(result) == 2 and result[1] >= 400:  # The API's (message, status) errors
+            errors += 1
+    return summarize(latencies, time.perf_counter() - start, errors)
+
+
+def generate(store, users: int, rng: random.Random) -> None:
+    """
+    Fill a store with verified users (user<i>, user<i>@example.com, password 'password<i>'), pending signups and
+    linked social accounts
+    """
+    from registrationAPI.bulk import import_accounts
+    from registrationAPI.storage import VERIFIED, UNVERIFIED
+
+    import_accounts(({"username": f'user{i}', "email": f'user{i}@example.com', "password": f'password{i}'}
+                     for i in range(users)), store=store, batch_size=5000)
+
+    now = datetime.now()
+    pending = int(users * UNVERIFIED_SHARE)
+    for start in range(0, pending, 5000):
+        with store.transaction():
+            for i in range(start, min(pending, start + 5000)):
+                age = timedelta(days=2) if i % 2 else timedelta(minutes=rng.randrange(60))  # Half are expired
+                store.put_account(UNVERIFIED, f'pending-{i}', {
+                    "email": f'pending{i}@example.com', "username": f'pending{i}', "password": 'password',
+                    "token": f'pending-token-{i}', "crtime": now - age,
+                })
+
+    linked = int(users * SOCIAL_SHARE)
+    for start in range(0, linked, 5000):
+        with store.transaction():
+            for i in range(start, min(linked, start + 5000)):
+                store.set_social('bench', f'social{i}', store.find_account(VERIFIED, 'username', f'user{i}'))
+
+
+def run_size(users: int) -> dict:
+    data_dir = os.path.abspath(f'data-{args.backend}-{users}')
+    os.makedirs('templates/email', exist_ok=True)
+    with open('templates/email/verify.html', 'w') as file:
+        file.write(TEMPLATE)
+    sink = start_sink()
+    os.environ['RAPI_STORAGE'] = args.backend
+
+    from registrationAPI.registration_api import API, find_user, clear_unverified_accounts
+    from registrationAPI.storage import open_data_dir, UNVERIFIED
+
+    config = {"SMTP_EMAIL": 'bench@example.com', "SMTP_SERVER": '127.0.0.1', "SMTP_PORT": sink.server_address[1],
+              "SMTP_SSL": False, "MAIL_QUEUE_DIR": f'{data_dir}/mail'}
+    rng = random.Random(args.seed)
+    start = time.perf_counter()
+    generate(open_data_dir(data_dir, cache_size=0), users, rng)
+    setup = time.perf_counter() - start
+
+    api = API(data_dir=data_dir, config=config)
+    samples = args.samples
+    existing = [rng.randrange(users) for _ in range(samples)]
+    results = {}
+
+    results['register'] = measure(lambda i: api.register(f'new{i}', f'new{i}@example.com', 'password'),
+                                  ((i,) for i in range(samples)))
+    tokens = [api.store.get_account(UNVERIFIED, api.store.find_account(UNVERIFIED, 'username', f'new{i}'))['token']
+              for i in range(samples)]
+    results['verify'] = measure(api.verify, ((token,) for token in tokens))
+    results['login'] = measure(lambda i: api.login({}, f'user{i}', f'password{i}'), ((i,) for i in existing))
+    results['login_by_email'] = measure(lambda i: api.login({}, f'user{i}@example.com', f'password{i}'),
+                                        ((i,) for i in existing))
+    results['find_user'] = measure(find_user, ((f'user{i}@example.com', api.store) for i in existing))
+    user_ids = [find_user(f'user{i}', api.store) for i in existing]
+    results['change_username'] = measure(api.change_username,
+                                         ((user_id, f'renamed{n}') for n, user_id in enumerate(user_ids)))
+    linked = max(1, int(users * SOCIAL_SHARE))
+    results['social_login_returning'] = measure(api.handle_social_login, (
+        (f'social{rng.randrange(linked)}', 'bench', {}) for _ in range(samples)))
+    results['social_login_new'] = measure(api.handle_social_login, (
+        (f'newsocial{n}', 'bench', {}) for n in range(samples)))
+    # The first sweep removes the expired backlog; later sweeps find little or nothing
+    results['clear_unverified_accounts'] = measure(clear_unverified_accounts, ((60 * 24, api.store),) * 10)
+
+    queue = api.mailer.get_queue()
+    queue.join()
+    api.hasher.close()  # Its worker processes would outlive os._exit() and keep the parent's pipe open
+    return {"users": users, "setup_seconds": setup, "emails_delivered": SMTPSink.received, "operations": results}
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if args.run_size:
+    print(json.dumps(run_size(args.run_size)))
+    os._exit(0)  # Don't wait for the mail queue's and journals' background threads
+
+report = {
+    "meta": {
+        "commit": git_commit(),
+        "timestamp": datetime.now().isoformat(),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "backend": args.backend,
+        "samples": args.samples,
+        "seed": args.seed,
+        "encrypted": bool(os.getenv('RAPI_AUTHKEY')),
+        "password_hash": args.password_hash,
+    },
+    "results": [],
+}
+for size in map(int, args.users.split(',')):
+    folder = tempfile.mkdtemp(prefix=f'bench-api-{size}-')
+    try:
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), '--run-size', str(size),
+                                 '--samples', str(args.samples), '--backend', args.backend, '--seed', str(args.seed),
+                                 '--password-hash', args.password_hash],
+                                cwd=folder, check=True, capture_output=True, text=True).stdout
+        result = json.loads(output.splitlines()[-1])
+    finally:
+        if not args.keep:
+            shutil.rmtree(folder, ignore_errors=True)
+    report['results'].append(result)
+    print(f'{size} users: ' + ', '.join(f'{name} p50 {stats["p50_ms"]:.2f}ms'
+                                        for name, stats in result['operations'].items()), file=sys.stderr)
+
+if args.output:
+    with open(args.output, 'w') as file:
+        json.dump(report, file, indent=2)
+else:
+    print(json.dumps(report, indent=2))
@@ -0,0 +1,89 @@
+"""
+Requests/sec and event loop stalls for concurrent logins, calling the sync API from coroutines versus AsyncAPI.
+
+Usage: python benchmarks/bench_async.py [--clients 100] [--requests 20] [--users 1000] [--io-latency 1]
+--io-latency adds a sleep (in ms) to every user record read, to stand in for a slow disk or network filesystem.
+(registrationAPI must be importable, e.g. run from the folder containing it with PYTHONPATH=.)
+"""
+import asyncio
+import os
+import random
+import tempfile
+import time
+from argparse import ArgumentParser
+
+parser = ArgumentParser()
+parser.add_argument('--clients', type=int, default=100)
+parser.add_argument('--requests', type=int, default=20, help='Logins per client')
+parser.add_argument('--users', type=int, default=1000)
+parser.add_argument('--io-latency', type=float, default=1.0)
+parser.add_argument('--workers', type=int, default=32, help='AsyncAPI thread pool size')
+args = parser.parse_args()
+
+os.environ.setdefault('RAPI_PASSWORD_HASH', 'scrypt:n=1024,r=8,p=1')  # Cheap, to keep the focus on I/O
+
+# Work in a scratch folder, since the API keeps its data relative to the CWD
+os.chdir(tempfile.mkdtemp())
+with open('config.json', 'w') as file:
+    file.write('{}')
+
+from registrationAPI.async_api import AsyncAPI  # noqa: E402
+from registrationAPI.bulk import import_accounts  # noqa: E402
+from registrationAPI.registration_api import API  # noqa: E402
+from registrationAPI.storage import open_store  # noqa: E402
+
+store = open_store(cache_size=0)  # Every login reads the user record
+import_accounts(({"username": f'user{i}', "email": f'user{i}@example.com', "password": 'password'}
+                 for i in range(args.users)), store=store, processes=1)
+if args.io_latency:
+    load_user = store.load_user
+
+    def slow_load_user(user_id):
+        time.sleep(args.io_latency / 1000)
+        return load_user(user_id)
+
+    store.load_user = slow_load_user
+
+api = API(store)
+async_api = AsyncAPI(api=api, max_workers=args.workers)
+
+
+async def heartbeat(stalls: list, stop: asyncio.Event):
+    # Measures how late the event loop wakes up a task which only sleeps for 1ms
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(0.001)
+        stalls.append(time.perf_counter() - start - 0.001)
+
+
+async def client(login):
+    for _ in range(args.requests):
+        await login({}, f'user{random.randrange(args.users)}', 'password')
+
+
+async def run(name, login):
+    stalls, stop = [], asyncio.Event()
+    beat = asyncio.create_task(heartbeat(stalls, stop))
+    start = time.perf_counter()
+    await asyncio.gather(*(client(login) for _ in range(args.clients)))
+    elapsed = time.perf_counter() - start
+    stop.set()
+    await beat
+    total = args.clients * args.requests
+    stalls = sorted(stalls) or [0]
+    print(f'{name:>6}: {total / elapsed:8.0f} logins/sec, event loop stall p50 {stalls[len(stalls) // 2] * 1000:.1f}ms '
+          f'max {stalls[-1] * 1000:.1f}ms')
+
+
+async def sync_login(*login_args):
+    return api.login(*login_args)  # Blocks the event loop, as the sync API would under ASGI
+
+
+async def main():
+    print(f'{args.clients} clients x {args.requests} logins, {args.users} users, {args.io_latency}ms I/O latency')
+    await run('sync', sync_login)
+    await run('async', async_api.login)
+
+
+asyncio.run(main())
+async_api.close()
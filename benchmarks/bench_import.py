@@ -0,0 +1,69 @@
+"""
+Cold-start cost versus user count: how long a fresh process takes to import the API, construct it, and serve its
+first login, compared with loading every map up front (as importing the API used to).
+
+Usage: python benchmarks/bench_import.py [--users 1000,10000,100000] [--runs 3]
+(registrationAPI must be importable, e.g. run from the folder containing it with PYTHONPATH=.)
+"""
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from argparse import ArgumentParser
+from uuid import uuid4
+
+parser = ArgumentParser()
+parser.add_argument('--users', default='1000,10000,100000', help='Comma-separated user counts')
+parser.add_argument('--runs', type=int, default=3, help='Fresh processes per measurement (the median is shown)')
+args = parser.parse_args()
+os.environ.setdefault('RAPI_PASSWORD_HASH', 'scrypt:n=1024,r=8,p=1')  # Keeps populating large user bases quick
+
+# Runs in a fresh interpreter, so nothing is cached between measurements
+COLD_START = """
+import json, sys, time
+start = time.perf_counter()
+from registrationAPI.registration_api import API
+imported = time.perf_counter()
+api = API(data_dir=sys.argv[1], config={})
+constructed = time.perf_counter()
+api.login({}, 'user0', 'password')
+logged_in = time.perf_counter()
+store = api.store.store
+store.social_map, store.email_map  # Load the remaining maps, as importing the API used to
+everything = time.perf_counter()
+print(json.dumps({"import": imported - start, "construct": constructed - imported, "first login": logged_in - start,
+                  "all maps": everything - start}))
+"""
+
+
+def populate(data_dir, users):
+    from registrationAPI.bulk import import_accounts
+    from registrationAPI.storage import open_data_dir
+
+    store = open_data_dir(data_dir, cache_size=0)
+    import_accounts(({"username": f'user{i}', "email": f'user{i}@example.com', "password": 'password'}
+                     for i in range(users)), store=store, batch_size=5000)
+    store.set_email_ids({f'user{i}@example.com': str(uuid4()) for i in range(users)})  # Everyone has been emailed
+    for journal in (*store.journals.values(), store.email_journal):
+        journal.compact()  # Start from a snapshot, as a long-running deployment would
+
+
+def cold_start(data_dir):
+    runs = []
+    for _ in range(args.runs):
+        output = subprocess.run([sys.executable, '-c', COLD_START, data_dir], check=True, capture_output=True,
+                                text=True, env=os.environ).stdout
+        runs.append(json.loads(output.splitlines()[-1]))
+    return {key: sorted(run[key] for run in runs)[len(runs) // 2] for key in runs[0]}
+
+
+root = tempfile.mkdtemp()
+os.chdir(root)
+print(f'{"users":>8} {"import":>9} {"API()":>9} {"1st login":>10} {"all maps":>9}')
+for users in map(int, args.users.split(',')):
+    data_dir = f'{root}/{users}'
+    populate(data_dir, users)
+    result = cold_start(data_dir)
+    print(f'{users:>8} {result["import"] * 1000:>7.1f}ms {result["construct"] * 1000:>7.2f}ms '
+          f'{result["first login"] * 1000:>8.1f}ms {result["all maps"] * 1000:>7.1f}ms')
@@ -0,0 +1,46 @@
+"""
+Overhead of instrumentation on a cheap, cached API call: uninstrumented, with metrics disabled, and enabled.
+
+Usage: python benchmarks/bench_metrics.py [--calls 20000] [--rounds 5]
+(registrationAPI must be importable, e.g. run from the folder containing it with PYTHONPATH=.)
+"""
+import os
+import tempfile
+import time
+from argparse import ArgumentParser
+
+parser = ArgumentParser()
+parser.add_argument('--calls', type=int, default=20000)
+parser.add_argument('--rounds', type=int, default=5)
+args = parser.parse_args()
+
+os.chdir(tempfile.mkdtemp())
+
+from registrationAPI import metrics  # noqa: E402
+from registrationAPI.passwords import PasswordHasher  # noqa: E402
+from registrationAPI.registration_api import API  # noqa: E402
+
+# A token hashing cost, which would otherwise dwarf the overhead being measured
+api = API(data_dir='data', config={}, hasher=PasswordHasher('pbkdf2_sha256:iterations=1', workers=0))
+api.verify(api.register('user', 'user@example.com', 'password', send_email=False))
+user_id = api.store.find_account('verified', 'username', 'user')
+
+
+def run(login, enable):
+    metrics.enabled = enable
+    start = time.perf_counter()
+    for _ in range(args.calls):
+        login(api, {}, user_id, 'password', finduser=False)
+    return (time.perf_counter() - start) / args.calls
+
+
+variants = {"uninstrumented": (API.login.__wrapped__, False), "disabled": (API.login, False),
+            "enabled": (API.login, True)}
+best = {name: float('inf') for name in variants}
+for _ in range(args.rounds):  # Interleaved, keeping the best round of each, to cancel out warm-up and noise
+    for name, (login, enable) in variants.items():
+        best[name] = min(best[name], run(login, enable))
+for name, per_call in best.items():
+    print(f'{name:>15}: {per_call * 1e6:.2f}us per login')
+print(f'Overhead: {(best["disabled"] - best["uninstrumented"]) * 1e9:.0f}ns disabled, '
+      f'{(best["enabled"] - best["uninstrumented"]) * 1e9:.0f}ns enabled')
@@ -0,0 +1,69 @@
+"""
+Login throughput at each password hashing cost: concurrent request threads log in through the API while the hashing
+runs on the hasher's process pool.
+
+Usage: python benchmarks/bench_passwords.py [--specs "scrypt:n=8192;scrypt:n=16384"] [--threads 16] [--logins 200]
+                                            [--workers N] [--calibrate-ms 50]
+Specs are separated by semicolons. --calibrate-ms adds the scrypt cost calibrated to that many ms per hash.
+(registrationAPI must be importable, e.g. run from the folder containing it with PYTHONPATH=.)
+"""
+import os
+import tempfile
+import threading
+import time
+from argparse import ArgumentParser
+
+parser = ArgumentParser()
+parser.add_argument('--specs', default='scrypt:n=4096;scrypt:n=16384;scrypt:n=65536;'
+                                       'pbkdf2_sha256:iterations=100000;pbkdf2_sha256:iterations=600000')
+parser.add_argument('--threads', type=int, default=16, help='Concurrent request threads')
+parser.add_argument('--logins', type=int, default=200, help='Logins per cost setting')
+parser.add_argument('--workers', type=int, default=None, help='Hashing processes (defaults to the number of CPUs)')
+parser.add_argument('--calibrate-ms', type=float)
+args = parser.parse_args()
+
+os.chdir(tempfile.mkdtemp())
+
+from registrationAPI.passwords import PasswordHasher, calibrate  # noqa: E402
+from registrationAPI.registration_api import API  # noqa: E402
+
+specs = args.specs.split(';')
+if args.calibrate_ms:
+    specs.append(calibrate(args.calibrate_ms))
+
+print(f'{args.threads} threads, {args.logins} logins per setting')
+print(f'{"cost":>36} {"1 hash":>9} {"logins/sec":>11} {"p50":>9} {"p99":>9}')
+for number, spec in enumerate(specs):
+    hasher = PasswordHasher(spec, workers=args.workers)
+    api = API(data_dir=f'data-{number}', config={}, hasher=hasher)
+    api.verify(api.register('user', 'user@example.com', 'password', send_email=False))
+    api.login({}, 'user', 'password')  # Start the pool and warm the user cache
+
+    start = time.perf_counter()
+    hasher.hash('password')
+    single = time.perf_counter() - start
+
+    latencies = []
+    remaining = iter(range(args.logins))
+    lock = threading.Lock()
+
+    def client():
+        while True:
+            with lock:
+                if next(remaining, None) is None:
+                    return
+            begin = time.perf_counter()
+            api.login({}, 'user', 'password')
+            latencies.append(time.perf_counter() - begin)
+
+    threads = [threading.Thread(target=client) for _ in range(args.threads)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    print(f'{hasher.spec:>36} {single * 1000:>7.1f}ms {len(latencies) / elapsed:>11.1f} '
+          f'{latencies[len(latencies) // 2] * 1000:>7.1f}ms {latencies[int(len(latencies) * 0.99)] * 1000:>7.1f}ms')
+    hasher.close()
@@ -0,0 +1,55 @@
+"""
+Per-recipient cost of rendering a template for a large send, before and after the template cache.
+
+Usage: python benchmarks/bench_templates.py [recipients]
+(registrationAPI must be importable, e.g. run from the folder containing it with PYTHONPATH=.)
+"""
+import os
+import sys
+import tempfile
+import time
+from jinja2 import Template
+
+TEMPLATE = """<html><body>
+<h1>Hello {{ name }}</h1>
+{% for item in items %}<p>{{ item }}</p>{% endfor %}
+<a href="https://example.com/verify?token={{ token }}">Verify</a>
+<a href="https://example.com/unsubscribe?id={{ unsub_id }}">Unsubscribe</a>
+</body></html>"""
+
+recipients = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+
+# Work in a scratch folder, since sendmail reads config.json and templates/ from the CWD
+os.chdir(tempfile.mkdtemp())
+os.makedirs('templates/email')
+with open('templates/email/bench.html', 'w') as file:
+    file.write(TEMPLATE)
+with open('config.json', 'w') as file:
+    file.write('{}')
+
+from registrationAPI import sendmail  # noqa: E402
+
+kwargs = {"name": "Someone", "items": ["one", "two", "three"], "token": "abc"}
+unsub_ids = [f'id-{i}' for i in range(recipients)]
+
+
+def uncached():
+    # What send_template used to do for every recipient
+    for unsub_id in unsub_ids:
+        with open('templates/email/bench.html', 'r') as file:
+            Template(file.read()).render(**kwargs, unsub_id=unsub_id)
+
+
+def cached():
+    template = sendmail.load_template('email/bench.html')
+    context = dict(kwargs)
+    for unsub_id in unsub_ids:
+        context['unsub_id'] = unsub_id
+        template.render(context)
+
+
+for name, func in (('uncached', uncached), ('cached', cached)):
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+    print(f'{name:>9}: {elapsed:.3f}s total, {elapsed / recipients * 1e6:.1f}us per recipient')
@@ -0,0 +1,197 @@
+import csv
+import json
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from functools import partial
+from itertools import islice
+from typing import Iterable, Iterator
+from uuid import uuid4
+from registrationAPI.passwords import PasswordHasher, default_hasher, hash_password, parse_spec
+from registrationAPI.registration_api import USERNAME_ALLOWED, is_email
+from registrationAPI.storage import Store, default_store, encode_user, VERIFIED, UNVERIFIED
+
+EXPORT_FIELDS = ('id', 'username', 'email', 'crtime')
+
+
+def read_records(filename: str) -> Iterator[dict]:
+    """
+    Stream records from a CSV file (with a header row) or a JSONL file (one object per line)
+    :param filename: A .csv or .jsonl file
+    :return: The records, one at a time
+    """
+    with open(filename, 'r', newline='') as file:
+        if filename.endswith('.csv'):
+            yield from csv.DictReader(file)
+        else:
+            for line in file:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def write_records(records: Iterable[dict], filename: str, fields=EXPORT_FIELDS) -> int:
+    """
+    Stream records to a CSV or JSONL file
+    :param records: The records to write
+    :param filename: A .csv or .jsonl file
+    :param fields: The fields to write (CSV columns)
+    :return: The number of records written
+    """
+    count = 0
+    with open(filename, 'w', newline='') as file:
+        writer = csv.DictWriter(file, fields, extrasaction='ignore') if filename.endswith('.csv') else None
+        if writer:
+            writer.writeheader()
+        for record in records:
+            record = {field: record[field].isoformat() if isinstance(record[field], datetime) else record[field]
+                      for field in fields if field in record}
+            if writer:
+                writer.writerow(record)
+            else:
+                file.write(json.dumps(record) + '\n')
+            count += 1
+    return count
+
+
+def validate(record: dict, emails: set, usernames: set, store: Store, validate_username: bool = True):
+    """
+    Apply the same rules as API.register to a record
+    :param record: Needs 'username', 'email' and 'password'
+    :param emails: Emails already taken by earlier records in this import
+    :param usernames: Usernames already taken by earlier records in this import
+    :param store: The store to check for existing accounts
+    :param validate_username: Whether to ensure usernames contain only valid characters
+    :return: The reason the record was rejected, or None if it is valid
+    """
+    username, email, password = record.get('username'), record.get('email'), record.get('password')
+    if not username or not email or not password:
+        return 'Missing required information'
+    if validate_username and any(char not in USERNAME_ALLOWED for char in username):
+        return 'Invalid username'
+    if not is_email(email):
+        return 'Invalid email'
+    if email in emails:
+        return 'Email already taken'
+    if username in usernames:
+        return 'Username already taken'
+    return _taken(email, username, store)
+
+
+def _taken(email: str, username: str, store: Store):
+    # Why an existing account prevents importing this email and username, or None
+    if store.find_account(VERIFIED, 'email', email) or store.find_account(UNVERIFIED, 'email', email):
+        return 'Email already taken'
+    if store.find_account(VERIFIED, 'username', username) or store.find_account(UNVERIFIED, 'username', username):
+        return 'Username already taken'
+    return None
+
+
+def _hash_and_encode(user: dict, spec: str, password: str, salt: bytes) -> bytes:
+    # Runs in a worker process
+    return encode_user({**user, "password": hash_password(user['password'], *parse_spec(spec))}, password, salt)
+
+
+def import_accounts(records: Iterable[dict], store: Store = None, batch_size: int = 1000, processes: int = None,
+                    validate_username: bool = True, progress=None, hasher: PasswordHasher = None) -> dict:
+    """
+    Create verified accounts in bulk, without sending emails. Records are validated against the same rules as
+    API.register, passwords are hashed and user records encrypted on a process pool, and each batch is committed at
+    once.
+    :param records: Dicts with 'username', 'email' and 'password' (e.g. from read_records)
+    :param store: The store to import into (defaults to the shared store)
+    :param batch_size: How many records to commit at a time
+    :param processes: The number of hashing and encryption processes (defaults to the number of CPUs)
+    :param validate_username: Whether to ensure usernames contain only valid characters
+    :param progress: Called with the report after each batch
+    :param hasher: Its algorithm and cost are used to hash the passwords (defaults to the shared hasher's)
+    :return: A report: {'imported': int, 'rejected': [(record number, reason), ...]}
+    """
+    store = store or default_store()
+    report = {"imported": 0, "rejected": []}
+    emails, usernames = set(), set()  # Taken by this import so far
+    records = enumerate(records, start=1)
+    encode = partial(_hash_and_encode, spec=(hasher or default_hasher()).spec, password=store.password, salt=store.salt)
+
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        while True:
+            batch = list(islice(records, batch_size))
+            if not batch:
+                break
+            accounts = {}
+            users = {}
+            numbers = {}
+            for number, record in batch:
+                reason = validate(record, emails, usernames, store, validate_username=validate_username)
+                if reason:
+                    report['rejected'].append((number, reason))
+                    continue
+                emails.add(record['email'])
+                usernames.add(record['username'])
+                user_id = str(uuid4())
+                numbers[user_id] = number
+                accounts[user_id] = {"email": record['email'], "username": record['username']}
+                users[user_id] = {
+                    "email": record['email'],
+                    "username": record['username'],
+                    "crtime": datetime.now(),
+                    "password": record['password'],
+                    "id": user_id,
+                    "socials": {},
+                    "groups": [],
+                    "orgs": [],
+                }
+            blobs = dict(zip(users, executor.map(encode, users.values(), chunksize=64)))
+            with store.transaction():
+                # Checked again where the batch is committed, in case an account was registered meanwhile
+                for user_id, account in list(accounts.items()):
+                    reason = _taken(account['email'], account['username'], store)
+                    if reason:
+                        report['rejected'].append((numbers[user_id], reason))
+                        del accounts[user_id], blobs[user_id]
+                store.save_user_blobs(blobs)
+                for user_id, account in accounts.items():
+                    store.put_account(VERIFIED, user_id, account)
+            report['imported'] += len(accounts)
+            if progress:
+                progress(report)
+    return report
+
+
+def export_accounts(store: Store = None, fields=EXPORT_FIELDS) -> Iterator[dict]:
+    """
+    Stream every verified account. User records are only loaded (one at a time) if a field requires it.
+    :param store: The store to export from (defaults to the shared store)
+    :param fields: The fields to include
+    :return: The accounts, one at a time
+    """
+    store = store or default_store()
+    needs_user = any(field not in ('id', 'email', 'username') for field in fields)
+    for user_id, account in store.accounts(VERIFIED):
+        record = {"id": user_id, **account}
+        if needs_user:
+            record.update(store.load_user(user_id) or {})
+        yield {field: record.get(field) for field in fields}
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Import or export accounts as CSV or JSONL')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    import_parser = subparsers.add_parser('import')
+    import_parser.add_argument('filename')
+    import_parser.add_argument('--batch-size', type=int, default=1000)
+    import_parser.add_argument('--processes', type=int, default=None)
+    import_parser.add_argument('--no-validate-username', action='store_true')
+    export_parser = subparsers.add_parser('export')
+    export_parser.add_argument('filename')
+    export_parser.add_argument('--fields', default=','.join(EXPORT_FIELDS))
+    args = parser.parse_args()
+
+    if args.command == 'import':
+        result = import_accounts(read_records(args.filename), batch_size=args.batch_size, processes=args.processes,
+                                 validate_username=not args.no_validate_username,
+                                 progress=lambda r: print(f"{r['imported']} imported, {len(r['rejected'])} rejected"))
+        for number, reason in result['rejected']:
+            print(f'Record {number}: {reason}')
+    else:
+        fields = args.fields.split(',')
+        print(f'{write_records(export_accounts(fields=fields), args.filename, fields=fields)} accounts exported')
@@ -0,0 +1,72 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable
+
+
+class LRUCache:
+    MISSING = object()  # Returned by get() when a key isn't cached, since None can be a cached value
+
+    def __init__(self, maxsize: int = 10000, ttl: float = 300):
+        """
+        A thread-safe cache which evicts the least recently used entry once full, and expires entries after ttl
+        :param maxsize: The maximum number of entries
+        :param ttl: How long (in seconds) an entry stays valid. 0 disables expiry.
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # key -> (expiry time, value), least recently used first
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, valid: Callable[[Any], bool] = None) -> Any:
+        """
+        :param key:
+        :param valid: If given, a cached value is only returned if valid(value) is true. Otherwise it is stale: it is
+                      evicted and counted as a miss.
+        :return: The cached value, or LRUCache.MISSING
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and ((self.ttl and entry[0] < time.monotonic()) or
+                                      (valid is not None and not valid(entry[1]))):
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return self.MISSING
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key: Hashable, value: Any) -> None:
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key: Hashable) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        """
+        :return: The cache's counters and current size
+        """
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+    def __len__(self):
+        return len(self._entries)
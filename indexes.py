@@ -0,0 +1,238 @@
+import heapq
+from bisect import bisect_left, bisect_right
+from typing import Any, Optional
+from pyntree import Node
+
+
+class MapIndex:
+    def __init__(self, node: Node, *fields: str):
+        """
+        An in-memory secondary index over an account map, so lookups don't have to scan with Node.where()
+        :param node: The map to index (format: {'id': {'field': value, ...}, ...})
+        :param fields: The fields to index. Each value should belong to at most one entry.
+        """
+        self.node = node
+        self.fields = fields
+        self._index = {field: {} for field in fields}  # field -> {value: id}
+        self._entries = {}  # id -> {field: value}, as last indexed (needed to remove stale values)
+        self.rebuild()
+
+    def rebuild(self) -> None:
+        """
+        Discard the index and rebuild it from the contents of the map
+        :return:
+        """
+        self._index = {field: {} for field in self.fields}
+        self._entries = {}
+        for key, record in self.node().items():
+            self.add(key, record)
+
+    def add(self, key: str, record: dict = None) -> None:
+        """
+        Index (or re-index) an entry. Call this after every change to an entry in the map.
+        :param key: The id of the entry
+        :param record: The entry's data. If not provided, it will be read from the map.
+        :return:
+        """
+        if record is None:
+            record = self.node.get(key)()
+        self.remove(key)
+        entry = {}
+        for field in self.fields:
+            if field in record:
+                value = record[field]
+                self._index[field].setdefault(value, key)  # Keep the first entry if the data has duplicates
+                entry[field] = value
+        self._entries[key] = entry
+
+    def remove(self, key: str) -> None:
+        """
+        Remove an entry from the index. Call this whenever an entry is deleted from the map.
+        :param key: The id of the entry
+        :return:
+        """
+        entry = self._entries.pop(key, {})
+        for field, value in entry.items():
+            if self._index[field].get(value) == key:
+                del self._index[field][value]
+
+    def lookup(self, field: str, value: Any) -> Optional[str]:
+        """
+        :param field: The indexed field to search
+        :param value: The value to search for
+        :return: The id of the matching entry, or None
+        """
+        return self._index[field].get(value)
+
+    def get(self, field: str, value: Any) -> Optional[Node]:
+        """
+        :param field: The indexed field to search
+        :param value: The value to search for
+        :return: The Node of the matching entry, or None
+        """
+        key = self.lookup(field, value)
+        return self.node.get(key) if key is not None else None
+
+    def check(self) -> list:
+        """
+        Compare the index against the contents of the map
+        :return: A list of problems found (empty if the index is consistent)
+        """
+        problems = []
+        data = self.node()
+        for key in self._entries:
+            if key not in data:
+                problems.append(f'{key} is indexed but no longer in the map')
+        for key, record in data.items():
+            for field in self.fields:
+                if field not in record:
+                    continue
+                found = self._index[field].get(record[field])
+                if found is None:
+                    problems.append(f'{key}: {field}={record[field]!r} is not indexed')
+                elif found != key:
+                    problems.append(f'{key}: {field}={record[field]!r} is indexed to {found}')
+        return problems
+
+
+class ExpiryIndex:
+    def __init__(self, node: Node, field: str = 'crtime'):
+        """
+        A min-heap of the entries of a map, ordered by a timestamp field, so due entries can be found without a scan.
+        Entries removed from the map are not removed from the heap; they are skipped when they come due.
+        :param node: The map to index (format: {'id': {'field': value, ...}, ...})
+        :param field: The timestamp field to order by
+        """
+        self.node = node
+        self.field = field
+        self._heap = []  # (timestamp, id)
+        self.rebuild()
+
+    def rebuild(self) -> None:
+        """
+        Discard the heap (and any stale entries in it) and rebuild it from the contents of the map
+        :return:
+        """
+        self._heap = [(record[self.field], key) for key, record in self.node().items() if self.field in record]
+        heapq.heapify(self._heap)
+
+    def add(self, key: str, record: dict = None) -> None:
+        """
+        Index an entry. Call this whenever an entry is added to the map or its timestamp changes.
+        :param key: The id of the entry
+        :param record: The entry's data. If not provided, it will be read from the map.
+        :return:
+        """
+        if record is None:
+            record = self.node.get(key)()
+        if self.field in record:
+            heapq.heappush(self._heap, (record[self.field], key))
+            if len(self._heap) > 2 * len(self.node()) + 1000:  # Mostly stale entries; start over
+                self.rebuild()
+
+    def pop_due(self, before: Any) -> list:
+        """
+        Remove and return every entry whose timestamp is at or before a cutoff. The caller is expected to delete them
+        from the map.
+        :param before: The cutoff
+        :return: The ids of the due entries, oldest first
+        """
+        data = self.node()
+        due = []
+        while self._heap and self._heap[0][0] <= before:
+            timestamp, key = heapq.heappop(self._heap)
+            record = data.get(key)
+            if record is not None and record.get(self.field) == timestamp:  # Skip stale entries
+                due.append(key)
+        return list(dict.fromkeys(due))  # An entry re-added with the same timestamp is in the heap twice
+
+    def __len__(self):
+        return len(self._heap)
+
+
+class LinkIndex:
+    def __init__(self, node: Node):
+        """
+        Sorted in-memory listings of a links map in both directions, so members can be paged through by cursor
+        without scanning or sorting
+        :param node: The map to index (format: {'relation': {'left': {'right': True, ...}, ...}, ...})
+        """
+        self.node = node
+        self._forward = {}  # relation -> {left: [right, ...]}
+        self._reverse = {}  # relation -> {right: [left, ...]}
+        self.rebuild()
+
+    def rebuild(self) -> None:
+        """
+        Discard the index and rebuild it from the contents of the map
+        :return:
+        """
+        self._forward, self._reverse = {}, {}
+        for relation, lefts in self.node().items():
+            forward = self._forward[relation] = {}
+            reverse = self._reverse[relation] = {}
+            for left, rights in lefts.items():
+                if rights:
+                    forward[left] = sorted(rights)
+                for right in rights:
+                    reverse.setdefault(right, []).append(left)
+            for values in reverse.values():
+                values.sort()
+
+    def add(self, relation: str, left: str, right: str) -> None:
+        """
+        Index a link. Call this whenever a link is added to the map.
+        :return:
+        """
+        _insort(self._forward.setdefault(relation, {}).setdefault(left, []), right)
+        _insort(self._reverse.setdefault(relation, {}).setdefault(right, []), left)
+
+    def remove(self, relation: str, left: str, right: str) -> None:
+        """
+        Remove a link from the index. Call this whenever a link is deleted from the map.
+        :return:
+        """
+        _discard(self._forward.get(relation, {}), left, right)
+        _discard(self._reverse.get(relation, {}), right, left)
+
+    def remove_left(self, relation: str, left: str) -> None:
+        """
+        Remove every link of left from the index. Call this whenever left is deleted from the map.
+        :return:
+        """
+        for right in self._forward.get(relation, {}).pop(left, []):
+            _discard(self._reverse[relation], right, left)
+
+    def linked(self, relation: str, left: str, after: str = None, limit: int = None) -> list:
+        """
+        :return: Up to limit rights linked to left, in order, starting after the cursor
+        """
+        return _page(self._forward.get(relation, {}).get(left, []), after, limit)
+
+    def linked_to(self, relation: str, right: str, after: str = None, limit: int = None) -> list:
+        """
+        :return: Up to limit lefts linked to right, in order, starting after the cursor
+        """
+        return _page(self._reverse.get(relation, {}).get(right, []), after, limit)
+
+
+def _insort(values: list, value: str) -> None:
+    i = bisect_left(values, value)
+    if i == len(values) or values[i] != value:
+        values.insert(i, value)
+
+
+def _discard(index: dict, key: str, value: str) -> None:
+    values = index.get(key)
+    if values is None:
+        return
+    i = bisect_left(values, value)
+    if i < len(values) and values[i] == value:
+        del values[i]
+        if not values:
+            del index[key]
+
+
+def _page(values: list, after: Optional[str], limit: Optional[int]) -> list:
+    start = bisect_right(values, after) if after is not None else 0
+    return values[start:start + limit] if limit is not None else values[start:]
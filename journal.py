@@ -0,0 +1,327 @@
+import os
+import pickle
+import threading
+import time
+from contextlib import contextmanager
+from pickle import UnpicklingError
+from pyntree import Node
+from registrationAPI import metrics
+
+try:
+    import fcntl
+except ImportError:  # Not available on Windows, where only a single process may use the maps
+    fcntl = None
+
+
+@contextmanager
+def file_lock(file, shared: bool = False):
+    """
+    Hold an advisory lock on an open file, which other processes using file_lock on the same file respect
+    :param file: The lock file
+    :param shared: Take a shared (read) lock instead of an exclusive one
+    """
+    if fcntl:
+        fcntl.flock(file, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+    try:
+        yield
+    finally:
+        if fcntl:
+            fcntl.flock(file, fcntl.LOCK_UN)
+
+
+class Journal:
+    def __init__(self, node: Node, commit_interval: float = 0, compact_after: int = 1000,
+                 compact_interval: float = 60, on_record=None, on_reload=None):
+        """
+        An append-only change journal for a map file, so that a change costs one small append instead of
+        rewriting the whole file. The map is periodically compacted into a fresh snapshot in the background.
+        The node should be opened WITHOUT autosave, and all changes to it should go through the journal.
+
+        Several processes may share a map. Commits and compactions hold an exclusive lock on <map>.lock, and each
+        process picks up the others' changes (by reading the journal from where it left off, or reloading the
+        snapshot if it was compacted) when it next takes the lock or calls refresh().
+
+        :param node: The root Node of the map file
+        :param commit_interval: If set, changes made outside a transaction are flushed together every
+                                commit_interval seconds instead of once per change (only safe with a single process)
+        :param compact_after: Compact once the journal holds this many records
+        :param compact_interval: How often (in seconds) the background thread checks for records to compact
+        :param on_record: Called with (op, path, value) for each change picked up from another process
+        :param on_reload: Called after the map has been reloaded from a snapshot written by another process
+        """
+        self.node = node
+        self.name = os.path.basename(node.file.name)  # Labels this map's metrics
+        self.path = node.file.name + '.journal'
+        self.commit_interval = commit_interval
+        self.compact_after = compact_after
+        self.compact_interval = compact_interval
+        self.on_record = on_record
+        self.on_reload = on_reload
+        self.records = 0  # Number of records in the journal since the last compaction
+        self._lock = threading.RLock()
+        self._depth = 0  # Nesting level of transaction()
+        self._held = 0  # Nesting level of the exclusive file lock
+        self._buffer = []  # Pickled records waiting to be written
+        self._mark = 0  # Where the running transaction's records start in _buffer
+        self._offset = 0  # How much of the journal has been applied to the map
+        self._snapshot = None  # Identifies the snapshot the map was loaded from
+        self._wake = threading.Event()
+        self._closed = False
+
+        self._lock_file = open(node.file.name + '.lock', 'ab')
+        self._file = open(self.path, 'ab')
+        with self._lock, file_lock(self._lock_file, shared=True):
+            self._snapshot = self._snapshot_id(opened=True)  # The snapshot the node was loaded from
+            self._catch_up()
+        self._thread = threading.Thread(target=self._run, name=f'journal:{node.file.name}', daemon=True)
+        self._thread.start()
+
+    # Recovery and synchronization
+    def replay(self, notify: bool = False) -> int:
+        """
+        Apply the records in the journal which haven't been applied to the map yet, e.g. after a crash or restart
+        :param notify: Whether to call on_record for each record
+        :return: The number of records applied
+        """
+        if not os.path.exists(self.path):
+            return 0
+        applied = 0
+        with open(self.path, 'rb') as file:
+            file.seek(self._offset)
+            while True:
+                try:
+                    op, path, value = pickle.load(file)
+                except (EOFError, UnpicklingError):  # End of journal, or a torn write at the end of it
+                    break
+                self._apply(op, path, value)
+                self._offset = file.tell()
+                applied += 1
+                if notify and self.on_record:
+                    self.on_record(op, path, value)
+        self.records += applied
+        if notify and applied and metrics.enabled:
+            metrics.inc('rapi_journal_records_picked_up_total', applied, map=self.name)
+        return applied
+
+    def _snapshot_id(self, opened=False) -> tuple:
+        stat = os.fstat(self.node.file.file.fileno()) if opened else os.stat(self.node.file.name)
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size  # A compaction replaces the file, so the inode changes
+
+    def _reload(self) -> None:
+        self.node.file.switch_to_file(self.node.file.name)  # Reopen, in case the snapshot was replaced
+        self.node.file.reload()
+        self._snapshot = self._snapshot_id(opened=True)
+        self._offset = 0
+        self.records = 0
+        self.replay()
+
+    def _catch_up(self) -> bool:
+        # Must be called with the file lock held
+        if self._snapshot_id() != self._snapshot or os.path.getsize(self.path) < self._offset:
+            self._reload()  # Another process compacted the map
+            if metrics.enabled:
+                metrics.inc('rapi_journal_reloads_total', map=self.name)
+            if self.on_reload:
+                self.on_reload()
+            return True
+        if os.path.getsize(self.path) > self._offset:
+            return self.replay(notify=True) > 0
+        return False
+
+    def refresh(self) -> bool:
+        """
+        Pick up changes written by other processes. This costs two stat() calls when nothing has changed.
+        :return: Whether the map changed
+        """
+        with self._lock:
+            if self._held:  # Nobody else can have written while we hold the exclusive lock
+                return False
+            with file_lock(self._lock_file, shared=True):
+                return self._catch_up()
+
+    @contextmanager
+    def _exclusive(self):
+        # Hold the exclusive file lock, catching up with other processes when it is first taken
+        with self._lock:
+            if self._held:
+                self._held += 1
+                try:
+                    yield
+                finally:
+                    self._held -= 1
+                return
+            with file_lock(self._lock_file):
+                self._held = 1
+                try:
+                    self._catch_up()
+                    if os.path.getsize(self.path) > self._offset:  # A torn write left behind by a crash
+                        self._file.truncate(self._offset)
+                    yield
+                finally:
+                    self._held = 0
+
+    def _apply(self, op, path, value) -> None:
+        target = self.node.file.data
+        for name in path[:-1]:
+            target = target[name]
+        if op == 'set':
+            target[path[-1]] = value
+        elif op == 'delete':
+            target.pop(path[-1], None)
+        elif op == 'extend':
+            target[path[-1]].extend(value)
+
+    # Changes
+    def set(self, *args) -> None:
+        """
+        Set a value in the map and journal the change
+        :param args: The names leading to the target, followed by the value to set it to
+        :return:
+        """
+        *path, value = args
+        with self.transaction():
+            self._apply('set', path, value)
+            self._record('set', path, value)
+
+    def delete(self, *path) -> None:
+        """
+        Delete a value from the map and journal the change
+        :param path: The names leading to the target
+        :return:
+        """
+        with self.transaction():
+            self._apply('delete', path, None)
+            self._record('delete', path, None)
+
+    def extend(self, *args) -> None:
+        """
+        Append values to a list in the map and journal only the new values
+        :param args: The names leading to the list, followed by a list of values to append
+        :return:
+        """
+        *path, values = args
+        values = list(values)
+        with self.transaction():
+            self._apply('extend', path, values)
+            self._record('extend', path, values)
+
+    def touch(self, *path) -> None:
+        """
+        Journal the current value at path, after it has been modified in place
+        :param path: The names leading to the target
+        :return:
+        """
+        with self.transaction():
+            target = self.node.file.data
+            for name in path:
+                target = target[name]
+            self._record('set', path, target)
+
+    def _record(self, op, path, value) -> None:
+        self._buffer.append(pickle.dumps((op, list(path), value)))  # Pickle now to capture the current state
+        if not self._depth and not self.commit_interval:
+            self.flush()
+
+    @contextmanager
+    def transaction(self):
+        """
+        Group several changes into one logical operation, which is committed with a single write and fsync.
+        The map is locked against compaction and other processes for the duration of the block, and is brought up to
+        date when the block is entered, so reads inside it can safely decide what to write.
+        If the block raises, none of its changes are committed and the map is reloaded without them.
+        """
+        with self._exclusive():
+            if not self._depth:
+                self._mark = len(self._buffer)  # Changes made before the transaction stay buffered by commit_interval
+            self._depth += 1
+            try:
+                yield self
+            except BaseException:
+                if self._depth == 1 and len(self._buffer) > self._mark:
+                    self._rollback()
+                raise
+            finally:
+                self._depth -= 1
+                if not self._depth and not self.commit_interval:
+                    self.flush()
+
+    def _rollback(self) -> None:
+        # Drop the failed transaction's records, and undo its changes to the map by reloading it from disk
+        del self._buffer[self._mark:]
+        self.flush()
+        self._reload()
+        if metrics.enabled:
+            metrics.inc('rapi_journal_rollbacks_total', map=self.name)
+        if self.on_reload:
+            self.on_reload()
+
+    def flush(self) -> None:
+        """
+        Write buffered records to the journal and fsync it
+        :return:
+        """
+        with self._lock:
+            if not self._buffer:
+                return
+            with self._exclusive():
+                start = time.perf_counter()
+                data = b''.join(self._buffer)
+                self._file.write(data)
+                self._file.flush()
+                os.fsync(self._file.fileno())
+                self._offset += len(data)
+                if metrics.enabled:
+                    metrics.observe('rapi_journal_commit_seconds', time.perf_counter() - start, map=self.name)
+                    metrics.inc('rapi_journal_written_bytes_total', len(data), map=self.name)
+            self.records += len(self._buffer)
+            self._buffer = []
+            if self.records >= self.compact_after:
+                self._wake.set()
+
+    # Compaction
+    def compact(self) -> None:
+        """
+        Write the map to a new snapshot and empty the journal
+        :return:
+        """
+        with self._exclusive():
+            self.flush()
+            if not self.records:
+                return
+            start = time.perf_counter()
+            name = self.node.file.name
+            self.node.save(name + '.tmp')  # Write the snapshot next to the map, then swap it in atomically
+            os.replace(name + '.tmp', name)
+            self.node.file.switch_to_file(name)
+            os.fsync(self.node.file.file.fileno())  # The snapshot must be durable before the journal is emptied
+            self._file.truncate(0)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self.records = 0
+            self._offset = 0
+            self._snapshot = self._snapshot_id()
+            if metrics.enabled:
+                metrics.observe('rapi_journal_compact_seconds', time.perf_counter() - start, map=self.name)
+                metrics.inc('rapi_journal_written_bytes_total', self._snapshot[2], map=self.name)
+
+    def _run(self) -> None:
+        last_compacted = time.monotonic()
+        while not self._closed:
+            self._wake.wait(self.commit_interval or self.compact_interval)
+            self._wake.clear()
+            self.flush()
+            due = time.monotonic() - last_compacted >= self.compact_interval
+            if self.records >= self.compact_after or (self.records and due):
+                self.compact()
+                last_compacted = time.monotonic()
+
+    def close(self) -> None:
+        """
+        Compact the map and stop the background thread
+        :return:
+        """
+        self._closed = True
+        self._wake.set()
+        self.compact()
+        self._file.close()
+        self._lock_file.close()
@@ -0,0 +1,104 @@
+"""
+Re-encrypt every user record under a new key, without taking the API offline:
+
+1. Restart the app with the new key in RAPI_AUTHKEY and the old one in RAPI_AUTHKEY_OLD. It then reads records
+   encrypted with either key, and writes them with the new one.
+2. Run python -m registrationAPI.keyrotation pyntree:db (with the same environment). Progress is checkpointed after
+   each batch, so an interrupted run carries on where it stopped when started again.
+3. Once it has finished, remove RAPI_AUTHKEY_OLD and restart the app.
+"""
+import hashlib
+import json
+import os
+from argparse import ArgumentParser
+from bisect import bisect_right
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from os import getenv, path
+from registrationAPI.storage import DEFAULT_SALT, Store, cipher, decode_user, encode_user, open_store
+
+
+def rotate_blob(blob: bytes, old_password: str, new_password: str, salt: bytes = DEFAULT_SALT) -> bytes:
+    """
+    Re-encrypt one encoded user record. This is a plain function so it can run in a worker process.
+    :param blob: The record, encrypted with old_password or new_password
+    :param old_password: The previous key (None if the record isn't encrypted)
+    :param new_password: The new key (None to store the record unencrypted)
+    :param salt: The encryption salt
+    :return: The record, encrypted with new_password
+    """
+    if old_password and new_password:  # Only the encryption changes, so the record needn't be unpickled
+        return cipher(new_password, salt, (old_password,)).rotate(blob)
+    return encode_user(decode_user(blob, old_password, salt), new_password, salt)
+
+
+def _fingerprint(old_password: str, new_password: str) -> str:
+    # Identifies a rotation in its checkpoint without storing either key
+    return hashlib.sha256(f'{old_password}\0{new_password}'.encode()).hexdigest()[:16]
+
+
+def rotate_keys(store: Store, old_password: str, new_password: str, processes: int = None, batch_size: int = 1000,
+                checkpoint: str = None, progress=print) -> dict:
+    """
+    Re-encrypt every user record from old_password to new_password, in order of ID. Records are re-encrypted on a
+    process pool, and each batch is committed at once. Records which the app saves while a batch is being
+    re-encrypted are left alone, as the app has already written them with the new key.
+    :param store: The store (without a cache), e.g. from open_store(url, cache_size=0)
+    :param old_password: The previous key (None if records aren't encrypted yet)
+    :param new_password: The new key (None to decrypt all records)
+    :param processes: The number of encryption processes (defaults to the number of CPUs)
+    :param batch_size: How many records to commit at a time
+    :param checkpoint: A JSON file recording progress after each batch. A run with the same keys resumes from it.
+    :param progress: Called with the report after each batch
+    :return: A report: {'last': the last ID done, 'rotated': int, 'skipped': int (changed during the run)}
+    """
+    fingerprint = _fingerprint(old_password, new_password)
+    report = {"keys": fingerprint, "last": None, "rotated": 0, "skipped": 0}
+    if checkpoint and path.exists(checkpoint):
+        with open(checkpoint) as file:
+            saved = json.load(file)
+        if saved.get('keys') == fingerprint:
+            report = saved
+
+    user_ids = sorted(store.user_ids())
+    if report['last'] is not None:
+        user_ids = user_ids[bisect_right(user_ids, report['last']):]
+    rotate = partial(rotate_blob, old_password=old_password, new_password=new_password, salt=store.salt)
+
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        for start in range(0, len(user_ids), batch_size):
+            batch = user_ids[start:start + batch_size]
+            versions = {user_id: store.user_version(user_id) for user_id in batch}  # Before reading, to be safe
+            blobs = store.load_user_blobs(batch)
+            rotated = dict(zip(blobs, executor.map(rotate, blobs.values(), chunksize=64)))
+            with store.transaction():
+                unchanged = {user_id: blob for user_id, blob in rotated.items()
+                             if store.user_version(user_id) == versions[user_id]}
+                store.save_user_blobs(unchanged)
+            report['rotated'] += len(unchanged)
+            report['skipped'] += len(rotated) - len(unchanged)
+            report['last'] = batch[-1]
+            if checkpoint:
+                with open(checkpoint + '.tmp', 'w') as file:
+                    json.dump(report, file)
+                os.replace(checkpoint + '.tmp', checkpoint)
+            if progress:
+                progress(report)
+    return report
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Re-encrypt every user record from RAPI_AUTHKEY_OLD to RAPI_AUTHKEY')
+    parser.add_argument('store', help='e.g. pyntree:db or sqlite:db/registration.sqlite3')
+    parser.add_argument('--checkpoint', default='key-rotation.json')
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--batch-size', type=int, default=1000)
+    args = parser.parse_args()
+
+    old_key, new_key = getenv("RAPI_AUTHKEY_OLD"), getenv("RAPI_AUTHKEY")  # Never on the command line
+    if old_key == new_key:
+        parser.error('RAPI_AUTHKEY_OLD and RAPI_AUTHKEY must differ')
+    result = rotate_keys(open_store(args.store, cache_size=0), old_key, new_key, processes=args.processes,
+                         batch_size=args.batch_size, checkpoint=args.checkpoint,
+                         progress=lambda r: print(f"{r['rotated']} rotated, {r['skipped']} skipped"))
+    print(f"Done: {result['rotated']} rotated, {result['skipped']} skipped")
@@ -0,0 +1,369 @@
+import logging
+import os
+import queue
+import smtplib
+import ssl
+import threading
+import time
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from os import path
+from uuid import uuid4
+from pyntree import Node
+from registrationAPI import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class SMTPPool:
+    def __init__(self, server: str, port: int, email: str, password: str = None, use_ssl: bool = True,
+                 size: int = 4, keepalive: float = 30, timeout: float = 30):
+        """
+        A pool of logged-in SMTP connections which are reused between messages
+        :param server: The SMTP server
+        :param port: The SMTP port
+        :param email: The account to log in with (and send from)
+        :param password: The account's password. If None, the connection is not logged in.
+        :param use_ssl: Whether to connect with SMTP_SSL (disable for a local stand-in server)
+        :param size: The maximum number of idle connections to keep open
+        :param keepalive: Connections idle for longer than this (in seconds) are checked with NOOP before use
+        :param timeout: The socket timeout for each connection
+        """
+        self.server = server
+        self.port = port
+        self.email = email
+        self.password = password
+        self.use_ssl = use_ssl
+        self.keepalive = keepalive
+        self.timeout = timeout
+        self._idle = queue.LifoQueue(maxsize=size)  # (connection, time released); LIFO keeps hot connections hot
+
+    def _connect(self) -> smtplib.SMTP:
+        start = time.perf_counter()
+        stage = 'connect'
+        try:
+            if self.use_ssl:
+                conn = smtplib.SMTP_SSL(self.server, self.port, context=ssl.create_default_context(),
+                                        timeout=self.timeout)
+            else:
+                conn = smtplib.SMTP(self.server, self.port, timeout=self.timeout)
+            if metrics.enabled:
+                metrics.observe('rapi_mail_connect_seconds', time.perf_counter() - start)
+            if self.password:
+                stage = 'login'
+                start = time.perf_counter()
+                conn.login(self.email, self.password)
+                if metrics.enabled:
+                    metrics.observe('rapi_mail_login_seconds', time.perf_counter() - start)
+        except (smtplib.SMTPException, OSError) as e:
+            if metrics.enabled:
+                metrics.inc('rapi_mail_failures_total', stage=stage, reason=type(e).__name__)
+            raise
+        return conn
+
+    def acquire(self) -> smtplib.SMTP:
+        """
+        :return: An open connection, reused from the pool if possible
+        """
+        while True:
+            try:
+                conn, released = self._idle.get_nowait()
+            except queue.Empty:
+                return self._connect()
+            if time.monotonic() - released < self.keepalive:
+                return conn
+            try:
+                if conn.noop()[0] == 250:
+                    return conn
+            except (smtplib.SMTPException, OSError):
+                pass
+            self.discard(conn)
+
+    def release(self, conn: smtplib.SMTP) -> None:
+        """
+        Return a healthy connection to the pool
+        """
+        try:
+            self._idle.put_nowait((conn, time.monotonic()))
+        except queue.Full:
+            self.discard(conn)
+
+    @staticmethod
+    def discard(conn: smtplib.SMTP) -> None:
+        """
+        Close a connection which won't be reused
+        """
+        try:
+            conn.quit()
+        except (smtplib.SMTPException, OSError):
+            conn.close()
+
+    def close(self) -> None:
+        while True:
+            try:
+                self.discard(self._idle.get_nowait()[0])
+            except queue.Empty:
+                return
+
+
+class RateLimiter:
+    def __init__(self, rate: float = None):
+        """
+        Spaces out calls to wait() so that, across all threads, they happen at most rate times per second
+        :param rate: Calls per second. None means unlimited.
+        """
+        self.interval = 1 / rate if rate else 0
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self) -> None:
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            slot = max(self._next, now)
+            self._next = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+def send(conn: smtplib.SMTP, sender: str, recipient: str, message: str) -> None:
+    """
+    Send a message over an open connection, recording its latency and outcome if metrics are enabled
+    """
+    if not metrics.enabled:
+        conn.sendmail(sender, recipient, message)
+        return
+    start = time.perf_counter()
+    try:
+        conn.sendmail(sender, recipient, message)
+    except (smtplib.SMTPException, OSError) as e:
+        metrics.inc('rapi_mail_failures_total', stage='send', reason=type(e).__name__)
+        raise
+    finally:
+        metrics.observe('rapi_mail_send_seconds', time.perf_counter() - start)
+    metrics.inc('rapi_mail_sent_total')
+
+
+def build_message(sender: str, recipient: str, subject: str, html: str) -> str:
+    message = MIMEMultipart("alternative")
+    message["Subject"] = subject
+    message["From"] = sender
+    message["To"] = recipient
+    message.attach(MIMEText(html, "html"))
+    return message.as_string()
+
+
+class MailQueue:
+    def __init__(self, pool: SMTPPool, folder: str = 'db/mail', workers: int = 2, max_attempts: int = 5,
+                 backoff: float = 30, stale_after: float = 600):
+        """
+        A persistent queue of outgoing messages, delivered by background worker threads.
+        Each message is a file in <folder>/queue until it is delivered. Messages which still fail after
+        max_attempts are moved to <folder>/dead. Several processes may deliver from the same folder.
+        :param pool: The SMTP connections to deliver with
+        :param folder: Where to keep queued, in-progress and dead messages
+        :param workers: The number of delivery threads
+        :param max_attempts: How many times to try a message before giving up on it
+        :param backoff: The delay (in seconds) before the first retry, doubled after every failed attempt
+        :param stale_after: How long (in seconds) a message may stay claimed before it is assumed that the process
+                            sending it died, and it is queued again. Must be well above the time a send can take.
+        """
+        self.pool = pool
+        self.folder = folder
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.stale_after = stale_after
+        self.sent = 0
+        self.failed = 0
+        self._pending = queue.Queue()  # IDs of messages ready to be delivered
+        self._retries = []  # Timers for messages waiting to be retried
+        self._closed = False
+
+        for d in (folder, f'{folder}/queue', f'{folder}/working', f'{folder}/dead'):
+            if not path.isdir(d):
+                os.makedirs(d)
+        self.recover()
+
+        self._workers = [threading.Thread(target=self._run, name=f'mailqueue-{i}', daemon=True)
+                         for i in range(workers)]
+        for worker in self._workers:
+            worker.start()
+
+    def _path(self, state: str, job_id: str) -> str:
+        return f'{self.folder}/{state}/{job_id}.pyn'
+
+    def recover(self) -> int:
+        """
+        Queue every message left on disk, e.g. after a restart. Messages claimed more than stale_after seconds ago
+        are queued again, as the process sending them has died; newer claims belong to processes still sending them.
+        Messages waiting to be retried are sent once their backoff has passed.
+        :return: The number of messages queued
+        """
+        cutoff = time.time() - self.stale_after
+        for name in os.listdir(f'{self.folder}/working'):
+            try:
+                if os.stat(f'{self.folder}/working/{name}').st_mtime < cutoff:  # Claims touch the file
+                    os.replace(f'{self.folder}/working/{name}', f'{self.folder}/queue/{name}')
+            except FileNotFoundError:  # Finished, or recovered by another process, meanwhile
+                pass
+        recovered = 0
+        for name in os.listdir(f'{self.folder}/queue'):
+            if name.endswith('.pyn'):
+                self._pending.put(name[:-len('.pyn')])
+                recovered += 1
+        return recovered
+
+    def enqueue(self, recipient: str, subject: str, html: str, sender: str = None) -> str:
+        """
+        Store a message on disk and queue it for delivery. Returns as soon as the message is stored.
+        :param recipient: The email to send to
+        :param subject: The subject of the email
+        :param html: The rendered body of the email
+        :param sender: The From address (defaults to the pool's account)
+        :return: The ID of the queued message
+        """
+        job_id = str(uuid4())
+        self._write('queue', job_id, {
+            "id": job_id,
+            "recipient": recipient,
+            "subject": subject,
+            "html": html,
+            "sender": sender or self.pool.email,
+            "attempts": 0,
+            "error": None,
+        })
+        self._pending.put(job_id)
+        return job_id
+
+    def _write(self, state, job_id, job) -> None:
+        tmp = self._path(state, job_id) + '.tmp'
+        Node(job).save(tmp)
+        os.replace(tmp, self._path(state, job_id))  # Workers never see a half-written message
+
+    def _run(self) -> None:
+        while not self._closed:
+            job_id = self._pending.get()
+            if job_id is None:  # Shutdown signal
+                break
+            try:
+                self._deliver(job_id)
+            except Exception:  # Whatever went wrong with one message, keep delivering the others
+                logger.exception('Failed to deliver queued message %s', job_id)
+            finally:
+                self._pending.task_done()
+
+    def _deliver(self, job_id) -> None:
+        try:
+            os.replace(self._path('queue', job_id), self._path('working', job_id))  # Claim the message
+        except FileNotFoundError:
+            return  # Already claimed by another worker
+        os.utime(self._path('working', job_id))  # The time of the claim, for recover()
+        job = conn = None
+        try:
+            job = Node(self._path('working', job_id))()
+            wait = job.get('retry_at', 0) - time.time()
+            if wait > 0:  # Queued for a retry by a process which has since stopped, or raced with its timer
+                os.replace(self._path('working', job_id), self._path('queue', job_id))
+                self._schedule(job_id, wait)
+                return
+            message = build_message(job['sender'], job['recipient'], job['subject'], job['html'])
+            conn = self.pool.acquire()
+            send(conn, job['sender'], job['recipient'], message)
+        except (smtplib.SMTPException, OSError) as e:
+            if conn is not None:
+                self.pool.discard(conn)
+            if job is None:
+                self._bury(job_id, None, e)
+            else:
+                self._retry(job, e)
+            return
+        except Exception as e:  # e.g. a header which can't be encoded, which no retry would fix
+            if conn is not None:
+                self.pool.discard(conn)
+            self._bury(job_id, job, e)
+            return
+        self.pool.release(conn)
+        self._unclaim(job_id)
+        self.sent += 1
+
+    def _unclaim(self, job_id) -> None:
+        try:
+            os.remove(self._path('working', job_id))
+        except FileNotFoundError:  # Taken for stale by recover() in another process, which will send it again
+            pass
+
+    def _retry(self, job, error) -> None:
+        job['attempts'] += 1
+        if job['attempts'] >= self.max_attempts or isinstance(error, smtplib.SMTPRecipientsRefused):
+            self._bury(job['id'], job, error)  # Permanent failure
+            return
+        job['error'] = repr(error)
+        if metrics.enabled:
+            metrics.inc('rapi_mail_retries_total')
+        delay = self.backoff * 2 ** (job['attempts'] - 1)
+        job['retry_at'] = time.time() + delay  # Stored, so that other processes wait for it too
+        self._write('queue', job['id'], job)
+        self._unclaim(job['id'])
+        self._schedule(job['id'], delay)
+
+    def _schedule(self, job_id, delay) -> None:
+        timer = threading.Timer(delay, self._pending.put, (job_id,))
+        timer.daemon = True
+        timer.start()
+        self._retries.append(timer)
+        self._retries = [t for t in self._retries if t.is_alive()]
+
+    def _bury(self, job_id, job, error) -> None:
+        # Move a claimed message to dead/, where it stays until retry_dead()
+        if job is None:  # It couldn't even be read
+            os.replace(self._path('working', job_id), self._path('dead', job_id))
+        else:
+            job['error'] = repr(error)
+            self._write('dead', job_id, job)
+            self._unclaim(job_id)
+        self.failed += 1
+        if metrics.enabled:
+            metrics.inc('rapi_mail_dead_letters_total')
+
+    def dead_letters(self) -> list:
+        """
+        :return: The messages which could not be delivered
+        """
+        return [Node(f'{self.folder}/dead/{name}')() for name in os.listdir(f'{self.folder}/dead')
+                if name.endswith('.pyn')]
+
+    def retry_dead(self) -> int:
+        """
+        Queue every dead message for delivery again
+        :return: The number of messages queued
+        """
+        count = 0
+        for job in self.dead_letters():
+            job['attempts'] = 0
+            job.pop('retry_at', None)
+            self._write('queue', job['id'], job)
+            os.remove(self._path('dead', job['id']))
+            self._pending.put(job['id'])
+            count += 1
+        return count
+
+    def join(self) -> None:
+        """
+        Block until every queued message has been attempted (retries waiting on their backoff are not awaited)
+        """
+        self._pending.join()
+
+    def close(self) -> None:
+        """
+        Stop the workers once the messages already queued have been attempted, and close the connection pool.
+        Messages waiting to be retried stay on disk and are picked up by the next recover().
+        """
+        for timer in self._retries:
+            timer.cancel()
+        for _ in self._workers:
+            self._pending.put(None)
+        for worker in self._workers:
+            worker.join()
+        self._closed = True
+        self.pool.close()
@@ -0,0 +1,199 @@
+"""
+Timing histograms and counters for the API, storage and mail delivery.
+
+Collection is off unless RAPI_METRICS is set or enable() is called. While it is off, each instrumented call site
+costs a single attribute check. Every recorded value is also passed to the hooks registered with add_hook(), as
+hook(name, value, labels), e.g. to forward it to StatsD or a tracing system.
+"""
+import bisect
+import threading
+import time
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os import getenv
+
+enabled = bool(getenv("RAPI_METRICS"))
+hooks = []
+
+# Upper bounds (in seconds) of the histogram buckets
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # The last bucket is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Registry:
+    def __init__(self):
+        """
+        Holds every counter and histogram, keyed by name and labels
+        """
+        self.counters = {}  # name -> {labels: value}
+        self.histograms = {}  # name -> {labels: Histogram}
+        self._lock = threading.Lock()
+
+    def inc(self, name: str, amount: float, labels: dict) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + amount
+
+    def observe(self, name: str, value: float, labels: dict) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self.histograms.setdefault(name, {})
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = Histogram()
+            histogram.observe(value)
+
+    def clear(self) -> None:
+        with self._lock:
+            self.counters = {}
+            self.histograms = {}
+
+    def prometheus(self) -> str:
+        """
+        :return: Every metric in the Prometheus text exposition format
+        """
+        lines = []
+        with self._lock:
+            for name, series in sorted(self.counters.items()):
+                lines.append(f'# TYPE {name} counter')
+                for labels, value in series.items():
+                    lines.append(f'{name}{_labels(labels)} {value}')  # Exact, so increments past 10^6 still show
+            for name, series in sorted(self.histograms.items()):
+                lines.append(f'# TYPE {name} histogram')
+                for labels, histogram in series.items():
+                    cumulative = 0
+                    for bound, count in zip((*histogram.buckets, '+Inf'), histogram.counts):
+                        cumulative += count
+                        lines.append(f'{name}_bucket{_labels(labels, le=bound)} {cumulative}')
+                    lines.append(f'{name}_sum{_labels(labels)} {float(histogram.sum)!r}')
+                    lines.append(f'{name}_count{_labels(labels)} {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+
+def _labels(labels: tuple, **extra) -> str:
+    labels = (*labels, *extra.items())
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n') for _, value in labels)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + '}'
+
+
+registry = Registry()
+
+
+def enable() -> None:
+    global enabled
+    enabled = True
+
+
+def disable() -> None:
+    global enabled
+    enabled = False
+
+
+def add_hook(hook) -> None:
+    """
+    :param hook: Called as hook(name, value, labels) for every value recorded while metrics are enabled
+    """
+    hooks.append(hook)
+
+
+def remove_hook(hook) -> None:
+    hooks.remove(hook)
+
+
+# Recording. Call sites check `metrics.enabled` first, so nothing is computed when collection is off.
+def inc(name: str, amount: float = 1, **labels) -> None:
+    """
+    Add to a counter
+    :param name: The metric name, ending in _total
+    :param amount: How much to add
+    :param labels: Labels distinguishing this series
+    """
+    registry.inc(name, amount, labels)
+    for hook in hooks:
+        hook(name, amount, labels)
+
+
+def observe(name: str, value: float, **labels) -> None:
+    """
+    Record a value (normally a duration in seconds) in a histogram
+    :param name: The metric name, ending in the unit (e.g. _seconds)
+    :param value: The value to record
+    :param labels: Labels distinguishing this series
+    """
+    registry.observe(name, value, labels)
+    for hook in hooks:
+        hook(name, value, labels)
+
+
+def api_call(func):
+    """
+    Time an API function, counting the (message, status) errors it returns and the exceptions it raises
+    """
+    method = func.__name__
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if not enabled:
+            return func(*args, **kwargs)
+        start = time.perf_counter()
+        try:
+            result = func(*args, **kwargs)
+        except BaseException:
+            inc('rapi_api_exceptions_total', method=method)
+            raise
+        finally:
+            observe('rapi_api_call_seconds', time.perf_counter() - start, method=method)
+        if isinstance(result, tuple) and len(result) == 2 and isinstance(result[1], int) and result[1] >= 400:
+            inc('rapi_api_errors_total', method=method, status=result[1])
+        return result
+
+    return wrapper
+
+
+# Exporting
+def prometheus_text() -> str:
+    """
+    :return: The metrics collected so far, in the Prometheus text format (serve as text/plain; version=0.0.4)
+    """
+    return registry.prometheus()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = prometheus_text().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_http_server(port: int, host: str = '') -> ThreadingHTTPServer:
+    """
+    Enable metrics and serve them for Prometheus to scrape, on a background thread
+    :param port: The port to listen on
+    :param host: The interface to listen on (all by default)
+    :return: The server (call shutdown() to stop it)
+    """
+    enable()
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    return server
@@ -0,0 +1,262 @@
+"""
+Password hashing with the standard library's scrypt or PBKDF2.
+
+Hashes are stored as '<algorithm>$<params>$<salt>$<digest>', so each one can be verified with the parameters it was
+made with after the configured cost changes. Passwords stored in plain text (before hashing was added) still verify,
+and are replaced with a hash at the user's next login.
+"""
+import atexit
+import base64
+import hashlib
+import hmac
+import multiprocessing
+import os
+import threading
+import time
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from os import getenv
+from typing import Optional
+from registrationAPI import metrics
+
+DEFAULT_PARAMS = {
+    'scrypt': {'n': 2 ** 14, 'r': 8, 'p': 1},
+    'pbkdf2_sha256': {'iterations': 600000},
+}
+SALT_BYTES = 16
+DIGEST_BYTES = 32
+
+
+def parse_spec(spec: str) -> tuple:
+    """
+    :param spec: An algorithm, optionally followed by its parameters, e.g. 'scrypt:n=16384,r=8,p=1' or
+                 'pbkdf2_sha256:iterations=600000'
+    :return: (algorithm, {param: value, ...}), with defaults for the parameters which weren't given
+    """
+    algorithm, _, params = spec.partition(':')
+    if algorithm not in DEFAULT_PARAMS:
+        raise ValueError(f'Unknown password hashing algorithm: {algorithm}')
+    parsed = dict(DEFAULT_PARAMS[algorithm])
+    for param in filter(None, params.split(',')):
+        name, _, value = param.partition('=')
+        if name not in parsed:
+            raise ValueError(f'Unknown {algorithm} parameter: {name}')
+        parsed[name] = int(value)
+    return algorithm, parsed
+
+
+def format_spec(algorithm: str, params: dict) -> str:
+    return f'{algorithm}:{",".join(f"{name}={value}" for name, value in params.items())}'
+
+
+def _derive(password: str, salt: bytes, algorithm: str, params: dict) -> bytes:
+    if algorithm == 'scrypt':
+        n, r, p = params['n'], params['r'], params['p']
+        return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p, dklen=DIGEST_BYTES,
+                              maxmem=128 * r * (n + p + 2) + 2 ** 20)  # What OpenSSL needs, plus some headroom
+    return hashlib.pbkdf2_hmac('sha256', password.encode(), salt, params['iterations'], dklen=DIGEST_BYTES)
+
+
+def hash_password(password: str, algorithm: str = 'scrypt', params: dict = None) -> str:
+    """
+    Hash a password with a new random salt. This is a plain function so it can run in a worker process.
+    :param password: The password
+    :param algorithm: 'scrypt' or 'pbkdf2_sha256'
+    :param params: The algorithm's cost parameters (see DEFAULT_PARAMS)
+    :return: The hash, including the algorithm, parameters and salt
+    """
+    params = {**DEFAULT_PARAMS[algorithm], **(params or {})}
+    salt = os.urandom(SALT_BYTES)
+    return _format_hash(algorithm, params, salt, _derive(password, salt, algorithm, params))
+
+
+def unusable_password(algorithm: str = 'scrypt', params: dict = None) -> str:
+    """
+    A stored password which no password verifies against, for accounts which log in another way (e.g. social logins).
+    It looks like any other hash, but its digest is random rather than derived, so it costs nothing to make.
+    :param algorithm: 'scrypt' or 'pbkdf2_sha256'
+    :param params: The algorithm's cost parameters (see DEFAULT_PARAMS)
+    :return: The stored password
+    """
+    params = {**DEFAULT_PARAMS[algorithm], **(params or {})}
+    return _format_hash(algorithm, params, os.urandom(SALT_BYTES), os.urandom(DIGEST_BYTES))
+
+
+def _format_hash(algorithm: str, params: dict, salt: bytes, digest: bytes) -> str:
+    return '$'.join((format_spec(algorithm, params).replace(':', '$', 1), _b64(salt), _b64(digest)))
+
+
+def parse_hash(hashed: str) -> Optional[tuple]:
+    """
+    :param hashed: A stored password
+    :return: (algorithm, params, salt, digest), or None if it is a plain text password
+    """
+    parts = hashed.split('$')
+    if len(parts) != 4 or parts[0] not in DEFAULT_PARAMS:
+        return None
+    try:
+        algorithm, params = parse_spec(f'{parts[0]}:{parts[1]}')
+        return algorithm, params, base64.b64decode(parts[2]), base64.b64decode(parts[3])
+    except ValueError:
+        return None
+
+
+def verify_password(password: str, hashed: str) -> bool:
+    """
+    Check a password against a stored hash (or a stored plain text password). Runs in constant time for a given hash.
+    This is a plain function so it can run in a worker process.
+    :param password: The password to check
+    :param hashed: The stored password
+    :return: Whether it matches
+    """
+    parsed = parse_hash(hashed)
+    if parsed is None:  # Stored before passwords were hashed
+        return hmac.compare_digest(password.encode(), hashed.encode())
+    algorithm, params, salt, digest = parsed
+    return hmac.compare_digest(_derive(password, salt, algorithm, params), digest)
+
+
+def _b64(data: bytes) -> str:
+    return base64.b64encode(data).decode()
+
+
+class PasswordHasher:
+    def __init__(self, spec: str = None, workers: int = None, max_pending: int = None):
+        """
+        Hashes and verifies passwords on a process pool, so slow hashes neither hold up other requests on the GIL nor
+        use more than a fixed number of CPUs at peak. The pool is started on first use.
+        :param spec: The algorithm and cost for new hashes (see parse_spec). Defaults to RAPI_PASSWORD_HASH, or scrypt
+                     with DEFAULT_PARAMS.
+        :param workers: How many processes hash passwords. 0 hashes on the calling thread instead, as do daemonic
+                        processes (e.g. multiprocessing.Pool workers). Defaults to RAPI_HASH_WORKERS, or the number of
+                        CPUs.
+        :param max_pending: How many hashes may be queued or running at once; further callers wait for a free slot.
+                            Defaults to 4 per worker.
+        """
+        self.algorithm, self.params = parse_spec(spec or getenv("RAPI_PASSWORD_HASH") or 'scrypt')
+        if workers is None:
+            workers = int(getenv("RAPI_HASH_WORKERS") or os.cpu_count() or 1)
+        self.workers = workers
+        self._slots = threading.BoundedSemaphore(max_pending or 4 * max(workers, 1))
+        self._lock = threading.Lock()
+        self._pool = None
+        self._pid = None  # The process which started the pool
+        self._exit_hook = False  # Whether close() is registered to run at exit
+
+    @property
+    def spec(self) -> str:
+        return format_spec(self.algorithm, self.params)
+
+    def _executor(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._pool is None or self._pid != os.getpid():  # Not started yet, or inherited across a fork
+                self._pool = ProcessPoolExecutor(max_workers=self.workers)
+                self._pid = os.getpid()
+                if not self._exit_hook:  # Don't leave workers behind, e.g. holding the parent's stdout open
+                    atexit.register(self.close)
+                    self._exit_hook = True
+            return self._pool
+
+    def _call(self, op, func, *args):
+        start = time.perf_counter()
+        if self.workers and not multiprocessing.current_process().daemon:  # Daemonic processes can't have children
+            with self._slots:
+                result = self._executor().submit(func, *args).result()
+        else:
+            result = func(*args)
+        if metrics.enabled:
+            metrics.observe('rapi_password_hash_seconds', time.perf_counter() - start, op=op)
+        return result
+
+    def hash(self, password: str) -> str:
+        """
+        :param password: The password
+        :return: Its hash, with the configured algorithm and cost
+        """
+        return self._call('hash', hash_password, password, self.algorithm, self.params)
+
+    def verify(self, password: str, hashed: str) -> bool:
+        """
+        :param password: The password to check
+        :param hashed: The stored password
+        :return: Whether it matches
+        """
+        return self._call('verify', verify_password, password, hashed)
+
+    def unusable(self) -> str:
+        """
+        :return: A stored password which no password verifies against (see unusable_password)
+        """
+        return unusable_password(self.algorithm, self.params)
+
+    def needs_rehash(self, hashed: str) -> bool:
+        """
+        :param hashed: A stored password which has just been verified
+        :return: Whether it is in plain text, or was hashed with a different algorithm or cost than configured
+        """
+        parsed = parse_hash(hashed)
+        return parsed is None or parsed[0] != self.algorithm or parsed[1] != self.params
+
+    def close(self) -> None:
+        """
+        Stop the worker processes. They are started again if the hasher is used afterwards.
+        :return:
+        """
+        with self._lock:
+            if self._pool is not None and self._pid == os.getpid():
+                self._pool.shutdown()
+            self._pool = None
+
+
+def calibrate(target_ms: float = 100, algorithm: str = 'scrypt', runs: int = 3) -> str:
+    """
+    Find the cost at which hashing one password takes about target_ms on this machine. Run it on the hardware which
+    will do the hashing, without other load.
+    :param target_ms: The time one hash should take
+    :param algorithm: 'scrypt' or 'pbkdf2_sha256'
+    :param runs: How many times each cost is timed (the fastest run counts)
+    :return: The spec to use (e.g. as RAPI_PASSWORD_HASH)
+    """
+    def timed(params):
+        best = float('inf')
+        for _ in range(runs):
+            start = time.perf_counter()
+            hash_password('calibration', algorithm, params)
+            best = min(best, time.perf_counter() - start)
+        return best * 1000
+
+    params = dict(DEFAULT_PARAMS[algorithm])
+    if algorithm == 'scrypt':  # n must be a power of 2; take the first one which reaches the target
+        params['n'] = 2 ** 10
+        while timed(params) < target_ms and params['n'] < 2 ** 22:
+            params['n'] *= 2
+    else:  # The cost of PBKDF2 is linear in the number of iterations
+        params['iterations'] = 10000
+        params['iterations'] = max(1000, int(round(params['iterations'] * target_ms / timed(params), -3)))
+    return format_spec(algorithm, params)
+
+
+_default_hasher = None
+_default_hasher_lock = threading.Lock()
+
+
+def default_hasher() -> PasswordHasher:
+    """
+    The hasher shared by API instances, configured by the RAPI_PASSWORD_HASH and RAPI_HASH_WORKERS environment
+    variables
+    :return:
+    """
+    global _default_hasher
+    with _default_hasher_lock:
+        if _default_hasher is None:
+            _default_hasher = PasswordHasher()
+    return _default_hasher
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Find the password hashing cost which takes a given time on this machine')
+    parser.add_argument('command', choices=['calibrate'])
+    parser.add_argument('--target-ms', type=float, default=100)
+    parser.add_argument('--algorithm', default='scrypt', choices=list(DEFAULT_PARAMS))
+    args = parser.parse_args()
+    print(f'RAPI_PASSWORD_HASH={calibrate(args.target_ms, args.algorithm)}')
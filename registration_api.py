@@ -1,59 +1,71 @@
-import os
 from typing import Any
-from pyntree import Node
-from pickle import UnpicklingError
 from uuid import uuid4
 from datetime import datetime, timedelta
+from functools import partial
+from itertools import islice
 from flask import redirect as _redirect
-from os import getenv, path, mkdir
+from os import getenv
+import logging
 import string
-from registrationAPI import sendmail
+import threading
+import time
+from registrationAPI import metrics, sendmail
+from registrationAPI.passwords import PasswordHasher, default_hasher
+from registrationAPI.storage import Store, LazyStore, default_store, open_data_dir, VERIFIED, UNVERIFIED, MEMBERS, \
+    ORG_GROUPS, VersionConflict
 
 USERNAME_ALLOWED = string.ascii_letters + string.digits + "_-"
-
-# Create needed folders and files if they don't exist
-for d in ('db', 'db/users', 'db/groups', 'db/orgs'):
-    if not path.isdir(d):
-        mkdir(d)
-
-# Init database accessors
-verified = Node('db/users/_map.pyn', autosave=True)
-unverified = Node('db/users/_map-unverified.pyn', autosave=True)
-socials = Node('db/users/_map-social.pyn', autosave=True)  # social db format: {'platform': {'social_name': 'id', ...}}
+ENTITY_NAMES = {'groups': 'Group', 'orgs': 'Organization'}
 
 # Handle server-side encryption
 ENCRYPTION_KEY = getenv("RAPI_AUTHKEY")
 
+logger = logging.getLogger(__name__)
+
 
 # Helper functions
 # noinspection PyUnboundLocalVariable
-def find_user(identifier: str):
+@metrics.api_call
+def find_user(identifier: str, store: Store = None):
     """
     Find the user given identifier
     :param identifier: An email or tagged username
-    :return: The uuid of the user and their status, or a failure notice (False)
+    :param store: The store to search (defaults to the shared store)
+    :return: The uuid of the user, or None if not found
     """
+    store = store or default_store()
 
     # Determine whether the identifier is an email or tagged username
     method = 'email' if is_email(identifier) else 'username'
 
     # Search the database
     if method == 'email':
-        found_unverified = unverified.where(email=identifier)
-        found_verified = verified.where(email=identifier)
+        found_unverified = store.find_account(UNVERIFIED, 'email', identifier)
+        found_verified = store.find_account(VERIFIED, 'email', identifier)
     if method == 'username':
-        found_unverified = []  # Only registered users have tagged usernames
-        found_verified = verified.where(username=identifier)
+        found_unverified = None  # Only registered users have tagged usernames
+        found_verified = store.find_account(VERIFIED, 'username', identifier)
 
     if found_verified:
-        return found_verified[0]  # There should only be 1!
+        return found_verified
     elif found_unverified:
-        return found_unverified[0]
+        return found_unverified
 
     return None  # Not found
 
 
+def _paginate(fetch, cursor, limit: int) -> tuple:
+    # Fetches one entry more than limit, which only shows whether there is another page
+    if not isinstance(limit, int) or limit < 1:  # A page with nothing on it would skip its cursor
+        return 'The limit must be a positive integer.', 400  # Bad request
+    items = fetch(after=cursor, limit=limit + 1)
+    return items[:limit], (items[limit - 1] if len(items) > limit else None)
+
+
 def is_email(identifier):
+    if any(char in identifier for char in '\r\n'):  # Would let the address inject headers into outgoing mail
+        return False
+
     try:
         username = identifier.split('@')[0]
         domain = identifier.split('@')[1]  # Emails can only have 1 @ symbol
@@ -69,40 +81,126 @@ def is_email(identifier):
     return True
 
 
-def send_verification_link(email, email_change=None):
+def send_verification_link(email, email_change=None, store: Store = None, mailer: sendmail.Mailer = None):
     """
     :param email: The email to send the link to
     :param email_change: Provide with user ID to send the user an email change verification
+    :param store: The store holding the user (defaults to the shared store)
+    :param mailer: The mailer to send with (defaults to the shared one)
     :return:
     """
+    store = store or default_store()
+    mailer = mailer or sendmail.mailer
     if email_change:
-        user_db = Node(f'db/users/{email_change}.pyn', password=ENCRYPTION_KEY)
-        sendmail.send_template('email/verify.html', 'Verify your new HashCards email', user_db.pending_email(),
-                               token=user_db.pending_email_token())
+        user_db = store.load_user(email_change)
+        mailer.send_template('email/verify.html', 'Verify your new HashCards email', user_db['pending_email'],
+                             token=user_db['pending_email_token'])
     else:
-        user = find_user(email)
-        if not user.email().endswith('@website.tld'):  # Do not email the fake emails given to OAuth accounts
-            sendmail.send_template('email/verify.html', 'Verify your HashCards account', user.email(), token=user.token())
+        user = store.get_account(UNVERIFIED, store.find_account(UNVERIFIED, 'email', email))
+        if not user['email'].endswith('@website.tld'):  # Do not email the fake emails given to OAuth accounts
+            mailer.send_template('email/verify.html', 'Verify your HashCards account', user['email'],
+                                 token=user['token'])
 
 
-def clear_unverified_accounts(age=0):
+@metrics.api_call
+def clear_unverified_accounts(age=0, store: Store = None):
     """
     :param age: How long the entry has existed, in minutes
-    :return:
+    :param store: The store to clear (defaults to the shared store)
+    :return: The number of entries removed
     """
-    for user in unverified._values:
-        user_info = unverified.get(user)
-        if user_info.has('crtime'):
-            if datetime.now() - timedelta(minutes=age) >= user_info.crtime():
-                unverified.delete(user)
+    store = store or default_store()
+    return len(store.expire_accounts(UNVERIFIED, datetime.now() - timedelta(minutes=age)))  # One commit
+
+
+class UnverifiedSweeper:
+    def __init__(self, age=60 * 24, interval=300, store: Store = None):
+        """
+        Periodically clears expired unverified accounts on a background thread
+        :param age: How long an entry may exist before it is removed, in minutes
+        :param interval: How often to sweep, in seconds
+        :param store: The store to sweep (defaults to the shared store)
+        """
+        self.age = age
+        self.interval = interval
+        self.store = store or default_store()
+        # Metrics
+        self.runs = 0
+        self.swept = 0  # Total entries removed
+        self.last_swept = 0
+        self.last_duration = 0.0  # Seconds
+        self.total_duration = 0.0
+        self.failures = 0  # Sweeps which raised
+        self.last_error = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def sweep(self) -> int:
+        """
+        Run a sweep now
+        :return: The number of entries removed
+        """
+        start = time.perf_counter()
+        swept = clear_unverified_accounts(self.age, store=self.store)
+        self.last_duration = time.perf_counter() - start
+        self.total_duration += self.last_duration
+        self.last_swept = swept
+        self.swept += swept
+        self.runs += 1
+        return swept
+
+    def start(self) -> None:
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='unverified-sweeper', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            try:
+                self.sweep()
+            except Exception as e:  # e.g. the store was briefly unavailable; try again at the next interval
+                self.failures += 1
+                self.last_error = repr(e)
+                logger.exception('Sweeping unverified accounts failed')
+
+    def stats(self) -> dict:
+        return {
+            "runs": self.runs,
+            "swept": self.swept,
+            "last_swept": self.last_swept,
+            "last_duration": self.last_duration,
+            "total_duration": self.total_duration,
+            "failures": self.failures,
+            "last_error": self.last_error,
+        }
 
 
 class API:
-    def __init__(self):
-        pass
+    def __init__(self, store: Store = None, data_dir: str = None, config=None, hasher: PasswordHasher = None):
+        """
+        Nothing is loaded until it is first needed, so constructing an API is cheap.
+        :param store: Where to keep all data. Defaults to the store configured by RAPI_STORAGE.
+        :param data_dir: Keep all data (including email IDs and the mail queue) in this folder instead of ./db
+        :param config: The mail settings: a dict, or the path of a JSON config file. Defaults to ./config.json
+        :param hasher: Hashes passwords. Defaults to the hasher configured by RAPI_PASSWORD_HASH and RAPI_HASH_WORKERS.
+        """
+        shared = store is None and not data_dir and config is None
+        if store is None:
+            store = LazyStore(partial(open_data_dir, data_dir, password=ENCRYPTION_KEY) if data_dir else default_store)
+        self.store = store
+        self.hasher = hasher or default_hasher()
+        # Sends the verification emails. Email IDs are kept in the same store as the users, so that deleting a user
+        # also forgets their email, and unsubscribes are checked where they were recorded.
+        self.mailer = sendmail.mailer if shared else sendmail.Mailer(config, data_store=store, folder=data_dir)
 
     # Authentication
 
+    @metrics.api_call
     def register(self, username: str, email: str, password: str, redirect='/verify', validate_username: bool = True,
                  send_email=True) -> Any:
         """
@@ -128,31 +226,40 @@ class API:
         if not is_email(email):
             return 'Please provide a valid email.', 400  # Bad request
 
-        # Ensure email is not taken
-        if verified.where(email=email) or unverified.where(email=email):  # Hopefully both are empty lists
-            return 'That email is already taken.', 401  # Unauthorized
-
-        # Ensure username is not taken
-        if verified.where(username=username) or unverified.where(username=username):  # Hopefully both are empty lists
-            return 'That username is already taken.', 401  # Unauthorized
-
-        # Generate user id
-        user_id = str(uuid4())
-
-        # Register into UNVERIFIED database
-        unverified.set(user_id, {})
-        user = unverified.get(user_id)
-        user.email = email
-        user.username = username
-        user.password = password
-        user.token = str(uuid4())  # Verification token
-        user.crtime = datetime.now()
+        # Hash before taking the store's lock, which other requests are waiting on
+        password = self.hasher.hash(password)
+
+        # The checks and the write share a transaction, so another worker can't take the email or username between
+        with self.store.transaction():
+            # Ensure email is not taken
+            if self.store.find_account(VERIFIED, 'email', email) or \
+                    self.store.find_account(UNVERIFIED, 'email', email):
+                return 'That email is already taken.', 401  # Unauthorized
+
+            # Ensure username is not taken
+            if self.store.find_account(VERIFIED, 'username', username) or \
+                    self.store.find_account(UNVERIFIED, 'username', username):
+                return 'That username is already taken.', 401  # Unauthorized
+
+            # Generate user id
+            user_id = str(uuid4())
+
+            # Register into UNVERIFIED database
+            token = str(uuid4())  # Verification token
+            self.store.put_account(UNVERIFIED, user_id, {
+                "email": email,
+                "username": username,
+                "password": password,
+                "token": token,
+                "crtime": datetime.now(),
+            })
 
         if send_email:
-            send_verification_link(email)
+            send_verification_link(email, store=self.store, mailer=self.mailer)
 
-        return user.token()
+        return token
 
+    @metrics.api_call
     def login(self, session, identifier, password, redirect='/', finduser=True) -> Any:
         """
         :param finduser: Whether to use email/password (True) or user id (False)
@@ -168,30 +275,29 @@ class API:
 
         # Identifier to UUID
         if finduser:
-            user = find_user(identifier)
+            user_id = find_user(identifier, store=self.store)
         else:
-            try:
-                user = verified.get(identifier)
-            except AttributeError:
-                user = None
-        if user is None:
+            user_id = identifier if self.store.get_account(VERIFIED, identifier) is not None else None
+        if user_id is None:
             return f'User not found: {identifier}', 404  # Not found
-        else:
-            user_id = user._name
-        # Verify password
-        user_db = Node(f'db/users/{user_id}.pyn', password=ENCRYPTION_KEY)
-        if user_db.password() != password:
+        # Verify password (unverified users don't have a user file yet)
+        user_db = self.store.load_user(user_id)
+        if user_db is None or not self.hasher.verify(password, user_db['password']):
             return f'Invalid password', 401  # Unauthorized
+        if self.hasher.needs_rehash(user_db['password']):  # Stored in plain text, or the cost has changed since
+            self._rehash(user_id, user_db['password'], password)
 
         # Log in
         session['id'] = user_id
 
         return _redirect(redirect)
 
+    @metrics.api_call
     def logout(self, session, redirect='/'):
         del session['id']
         return _redirect(redirect)
 
+    @metrics.api_call
     def verify(self, token):
         """
         Accept confirmation link sent via email
@@ -200,79 +306,90 @@ class API:
         """
 
         # Find user given token
-        try:
-            user = unverified.where(token=token)[0]
-        except IndexError:
+        entry_id = self.store.find_account(UNVERIFIED, 'token', token)
+        if entry_id is None:
             return f'No user found. Maybe you already verified your email?', 404  # Not found
-
-        if user.has('email_change'):
-            user_id = user.user_id()
-            user_db = Node(f'db/users/{user_id}.pyn', password=ENCRYPTION_KEY)
-            user_db.email = user_db.pending_email()
-            user_db.delete('pending_email_token')
-            user_db.delete('pending_email')
-            user_db.save()
-            user_info = verified.get(user_id)
-            user_info.email = user_db.email()
-            user.delete()
+        user = self.store.get_account(UNVERIFIED, entry_id)
+
+        if 'email_change' in user:
+            user_id = user['user_id']
+            with self.store.transaction():
+                # Loaded inside the transaction, so changes saved by other workers meanwhile aren't lost
+                user_db = dict(self.store.load_user(user_id))
+                if self.store.get_account(UNVERIFIED, entry_id) is None or \
+                        user_db.get('pending_email_token') != token:  # Verified or replaced in the meantime
+                    return f'No user found. Maybe you already verified your email?', 404  # Not found
+                user_db['email'] = user_db.pop('pending_email')
+                user_db.pop('pending_email_token')
+                self.store.save_user(user_id, user_db)
+                self.store.update_account(VERIFIED, user_id, email=user_db['email'])
+                self.store.delete_account(UNVERIFIED, entry_id)
             return _redirect('/account?updated=True')
 
         # Register username and email with ID
-        user_id = user._name
-        verified.set(user_id, {
-            "email": user.email(),
-            "username": user.username()
-        })
-
-        # Create personal data file for user
-        Node(
-            {
-                "email": user.email(),
-                "username": user.username(),
+        user_id = entry_id
+        with self.store.transaction():
+            if self.store.get_account(UNVERIFIED, user_id) is None:  # Verified by another worker in the meantime
+                return f'No user found. Maybe you already verified your email?', 404  # Not found
+            self.store.put_account(VERIFIED, user_id, {
+                "email": user['email'],
+                "username": user['username']
+            })
+
+            # Create personal data file for user
+            self.store.save_user(user_id, {
+                "email": user['email'],
+                "username": user['username'],
                 "crtime": datetime.now(),  # Set crtime to verification time
-                "password": user.password(),
+                "password": user['password'],
                 "id": user_id,
                 "socials": {},
                 "groups": [],
                 "orgs": [],
-            }
-        ).save(
-            f"db/users/{user_id}.pyn",
-            password=ENCRYPTION_KEY
-        )
+            })
 
-        # Remove user from unverified
-        unverified.delete(user_id)
+            # Remove user from unverified
+            self.store.delete_account(UNVERIFIED, user_id)
 
         return user_id
 
+    @metrics.api_call
     def change_email(self, user_id, new_email, require_verification=True):
         # Ensure email is valid
         if not is_email(new_email):
             return 'Please provide a valid email.', 400  # Bad request
 
-        # Ensure email is not taken
-        if verified.where(email=new_email) or unverified.where(email=new_email):  # Hopefully both are empty lists
-            return 'That email is already taken.', 401  # Unauthorized
-
-        user_db = Node(f'db/users/{user_id}.pyn', password=ENCRYPTION_KEY)
         if require_verification:
             token = str(uuid4())
-            user_db.pending_email = new_email
-            user_db.pending_email_token = token
-            user_db.save()
-            unverified.set(token, {
-                "user_id": user_id,
-                "email_change": True,
-                "token": token,
-                "crtime": datetime.now(),
-            })
-            send_verification_link(new_email, email_change=user_id)
+            with self.store.transaction():
+                # Ensure email is not taken
+                if self.store.find_account(VERIFIED, 'email', new_email) or \
+                        self.store.find_account(UNVERIFIED, 'email', new_email):
+                    return 'That email is already taken.', 401  # Unauthorized
+                user_db = dict(self.store.load_user(user_id))
+                user_db['pending_email'] = new_email
+                user_db['pending_email_token'] = token
+                self.store.save_user(user_id, user_db)
+                self.store.put_account(UNVERIFIED, token, {
+                    "user_id": user_id,
+                    "email_change": True,
+                    "token": token,
+                    "crtime": datetime.now(),
+                })
+            send_verification_link(new_email, email_change=user_id, store=self.store, mailer=self.mailer)
             return token
         else:
-            user_db.email = new_email
+            with self.store.transaction():
+                if self.store.find_account(VERIFIED, 'email', new_email) or \
+                        self.store.find_account(UNVERIFIED, 'email', new_email):
+                    return 'That email is already taken.', 401  # Unauthorized
+                user_db = dict(self.store.load_user(user_id))
+                user_db['email'] = new_email
+                self.store.save_user(user_id, user_db)
+                self.store.update_account(VERIFIED, user_id, email=new_email)
             return None
 
+    @metrics.api_call
     def change_username(self, user_id, new_username):
         if not new_username:
             return 'Please provide a valid username', 400
@@ -285,24 +402,35 @@ class API:
             if char not in USERNAME_ALLOWED:
                 return 'Usernames may only contain alphanumeric characters, as well as _ and -', 400  # Bad request
 
-        # Ensure email is not taken
-        if verified.where(username=new_username) or unverified.where(username=new_username):  # Hopefully both are empty lists
-            return 'That username is already taken.', 401  # Unauthorized
-
-        user_db = Node(f'db/users/{user_id}.pyn', password=ENCRYPTION_KEY)
-        user_db.username = new_username
-        user_db.save()
-        user_info = verified.get(user_id)
-        user_info.username = new_username
-
+        with self.store.transaction():
+            # Ensure username is not taken
+            if self.store.find_account(VERIFIED, 'username', new_username) or \
+                    self.store.find_account(UNVERIFIED, 'username', new_username):
+                return 'That username is already taken.', 401  # Unauthorized
+            user_db = dict(self.store.load_user(user_id))
+            user_db['username'] = new_username
+            self.store.save_user(user_id, user_db)
+            self.store.update_account(VERIFIED, user_id, username=new_username)
+
+    @metrics.api_call
     def change_password(self, user_id, new_password):
         if not new_password:
             return 'A password was not provided.', 400
 
-        user_db = Node(f'db/users/{user_id}.pyn', password=ENCRYPTION_KEY)
-        user_db.password = new_password
-        user_db.save()
+        new_password = self.hasher.hash(new_password)
+        with self.store.transaction():
+            user_db = dict(self.store.load_user(user_id))
+            user_db['password'] = new_password
+            self.store.save_user(user_id, user_db)
+
+    def _rehash(self, user_id, old_hash, password) -> None:
+        new_hash = self.hasher.hash(password)
+        with self.store.transaction():
+            user_db = self.store.load_user(user_id)
+            if user_db is not None and user_db['password'] == old_hash:  # Unless the password changed meanwhile
+                self.store.save_user(user_id, {**user_db, 'password': new_hash})
 
+    @metrics.api_call
     def handle_social_login(self, username, platform, session):
         """
         Logs in social users to their associated accounts, or creates new ones for them
@@ -310,28 +438,42 @@ class API:
         Example OAuth response:
         {'access_token': '[redacted]', 'token_type': 'Bearer', 'expires_in': 3600, 'refresh_token': '[redacted]', 'user_id': 'jvadair', 'expires_at': 1684416088}
 
-        :return: Whether an account was created
+        :return: Whether an account was created, or an error if the username for a new account is taken
         """
-        if not socials.has(platform):
-            socials.set(platform, {})
-
-        if socials.get(platform).has(username):
-            user_id = socials.get(platform).get(username)()
-            session['id'] = user_id  # Log in
-            session['social_platform'] = platform
-            session['social_id'] = username
-            return False
-        else:
-            verification_token = self.register(platform + ':' + username, email=f"{str(uuid4())}@website.tld",
-                                               password=str(uuid4()), validate_username=False)
-            user_id = self.verify(verification_token)
-            self.link_social_account(user_id, username, platform)
-            # No email (but random uuid since it can't be blank) or verification for OAuth accounts; random password
-            session['id'] = user_id  # Log in
-            session['social_platform'] = platform
-            session['social_id'] = username
-            return True
-
+        user_id = self.store.get_social(platform, username)  # Returning users: a single lookup
+        created = False
+        if user_id is None:
+            # New users skip register and verify: there is no email to confirm (but a random uuid since it can't be
+            # blank) and no password, so the account, user file and social link are created in one commit
+            name = platform + ':' + username
+            email = f"{str(uuid4())}@website.tld"
+            new_id = str(uuid4())
+            with self.store.transaction():
+                user_id = self.store.get_social(platform, username)
+                if user_id is None:  # Unless another worker created it in the meantime
+                    if self.store.find_account(VERIFIED, 'username', name) or \
+                            self.store.find_account(UNVERIFIED, 'username', name):
+                        return 'That username is already taken.', 401  # Unauthorized
+                    self.store.put_account(VERIFIED, new_id, {"email": email, "username": name})
+                    self.store.save_user(new_id, {
+                        "email": email,
+                        "username": name,
+                        "crtime": datetime.now(),
+                        "password": self.hasher.unusable(),
+                        "id": new_id,
+                        "socials": {platform: username},
+                        "groups": [],
+                        "orgs": [],
+                    })
+                    self.store.set_social(platform, username, new_id)
+                    user_id, created = new_id, True
+
+        session['id'] = user_id  # Log in
+        session['social_platform'] = platform
+        session['social_id'] = username
+        return created
+
+    @metrics.api_call
     def link_social_account(self, user_id, social_name, social_platform):
         """
         :param user_id: The local ID of the user
@@ -339,31 +481,34 @@ class API:
         :param social_platform: The platform used to connect
         :return: Whether the linking operation was successful. If False, the user has already linked that platform or the social account is in use by another account.
         """
-        if not socials.has(social_platform):
-            socials.set(social_platform, {})
-        user_db = Node(f'db/users/{user_id}.pyn', password=ENCRYPTION_KEY)
-        if user_db.socials.has(social_platform) or socials.get(social_platform).has(social_name):
-            return False
-        user_db.socials.set(social_platform, social_name)
-        user_db.save()
-        socials.get(social_platform).set(social_name, user_id)
+        with self.store.transaction():
+            user_db = dict(self.store.load_user(user_id))
+            if social_platform in user_db['socials'] or \
+                    self.store.get_social(social_platform, social_name) is not None:
+                return False
+            user_db['socials'] = {**user_db['socials'], social_platform: social_name}
+            self.store.save_user(user_id, user_db)
+            self.store.set_social(social_platform, social_name, user_id)
         return True
 
+    @metrics.api_call
     def unlink_social_account(self, user_id, social_platform):
         """
         :param user_id: The local ID of the user
         :param social_platform: The associated platform
         :return: Whether the unlinking operation was successful
         """
-        user_db = Node(f'db/users/{user_id}.pyn', password=ENCRYPTION_KEY)
-        if not user_db.socials.has(social_platform):
-            return False
-        social_name = user_db.socials.get(social_platform)()
-        socials.get(social_platform).delete(social_name)
-        user_db.socials.delete(social_platform)
-        user_db.save()
+        with self.store.transaction():
+            user_db = dict(self.store.load_user(user_id))
+            if social_platform not in user_db['socials']:
+                return False
+            user_db['socials'] = dict(user_db['socials'])
+            social_name = user_db['socials'].pop(social_platform)
+            self.store.delete_social(social_platform, social_name)
+            self.store.save_user(user_id, user_db)
         return True
 
+    @metrics.api_call
     def delete_account(self, user_id: str, session: dict = None) -> None:
         """
         Delete the account of the specified user
@@ -374,84 +519,298 @@ class API:
         if session:
             self.logout(session)
         # Remove social login ties, if any. Must be done before deleting user data.
-        user_db = Node(f'db/users/{user_id}.pyn', password=ENCRYPTION_KEY)
-        for platform in user_db.socials._values:
-            socials.get(platform).delete(user_db.socials.get(platform)())
-        os.remove(f'db/users/{user_id}.pyn')  # Remove user data file
-        verified.delete(user_id)  # Remove user from account map
+        with self.store.transaction():
+            user_db = self.store.load_user(user_id)
+            for platform, social_name in user_db['socials'].items():
+                self.store.delete_social(platform, social_name)
+            for relation in MEMBERS.values():
+                self.store.unlink_all(relation, right=user_id)  # Leave every group and org
+            self.store.delete_user(user_id)  # Remove user data file
+            self.store.delete_account(VERIFIED, user_id)  # Remove user from account map
+
+    @metrics.api_call
+    def delete_accounts(self, user_ids, batch_size: int = 1000, progress=None) -> dict:
+        """
+        Delete many accounts at once, e.g. for data retention. Besides what delete_account removes, this also forgets
+        the users' email IDs (taking them off the do-not-email list) and any pending email change. Everything belonging
+        to a batch of users is gathered first, then removed in a single commit.
+        :param user_ids: The users to delete
+        :param batch_size: How many users to delete per commit
+        :param progress: Called with the report after each batch
+        :return: A report: {'deleted': int, 'missing': [IDs of users who didn't have an account]}
+        """
+        report = {"deleted": 0, "missing": []}
+        user_ids = iter(user_ids)
+        while True:
+            batch = list(dict.fromkeys(islice(user_ids, batch_size)))
+            if not batch:
+                break
+            with self.store.transaction():
+                users = {}
+                for user_id in batch:
+                    user_db = self.store.load_user(user_id)
+                    if user_db is None:
+                        report['missing'].append(user_id)
+                    else:
+                        users[user_id] = user_db
+
+                emails = []
+                for user_id, user_db in users.items():
+                    for platform, social_name in user_db['socials'].items():
+                        if self.store.get_social(platform, social_name) == user_id:
+                            self.store.delete_social(platform, social_name)
+                    token = user_db.get('pending_email_token')
+                    if token and self.store.get_account(UNVERIFIED, token) is not None:
+                        self.store.delete_account(UNVERIFIED, token)  # Pending email change
+                    emails += filter(None, (user_db['email'], user_db.get('pending_email')))
+                    for relation in MEMBERS.values():
+                        self.store.unlink_all(relation, right=user_id)  # Leave every group and org
+                    self.store.delete_user(user_id)
+                    self.store.delete_account(VERIFIED, user_id)
+                self.store.delete_email_ids(emails)
+            report['deleted'] += len(users)
+            if progress:
+                progress(report)
+        return report
 
     # Group management functions
+    @metrics.api_call
     def create_group(self, owner_id: str, name: str) -> str:
         """
-        Creates a new group
+        Creates a new group, with its owner as the first member
         :param owner_id: The user id to set as the owner
         :param name: The name of the group
         :return: The group ID
         """
-        new_group = Node({
-            "id": str(uuid4()),
-            "name": name,
-            "owner": owner_id,
-            "members": [owner_id],
-        })
-        new_group.save(f"db/groups/{new_group.id()}.pyn")
-        return new_group.id()
+        group_id = str(uuid4())
+        with self.store.transaction():
+            self.store.save_entity('groups', group_id, {
+                "id": group_id,
+                "name": name,
+                "owner": owner_id,
+                "version": 1,
+            })
+            self._enter('groups', group_id, owner_id)
+        return group_id
 
-    def modify_group(self, group_id: str, **kwargs) -> None:
+    @metrics.api_call
+    def modify_group(self, group_id: str, expected_version: int = None, append: dict = None, remove: dict = None,
+                     **kwargs) -> Any:
         """
+        Only the given properties are changed, so concurrent changes to others aren't lost. Members are changed with
+        add_member and remove_member instead.
         :param group_id: The ID of the group
+        :param expected_version: If given, only make the change if the group is still at this version (its "version"
+                                 property, or the version returned by the last change)
+        :param append: {list property: [values to add], ...}
+        :param remove: {list property: [values to remove], ...}
         :param kwargs: The group properties to change and their respective new values
-        :return:
+        :return: The group's new version
         """
-        group = Node(f"db/groups/{group_id}.pyn")
-        for kwarg in kwargs:
-            group.set(kwarg, kwargs[kwarg])
-        group.save()
+        result = self._modify('groups', {group_id: {**kwargs, 'expected_version': expected_version, 'append': append,
+                                                    'remove': remove}})
+        return result[group_id] if isinstance(result, dict) else result
 
+    @metrics.api_call
     def delete_group(self, group_id: str) -> None:
         """
-        Deletes a group
+        Deletes a group, removing it from its members and organizations
         :param self:
         :param group_id: The ID of the group to delete
         :return:
         """
-        os.remove(f'db/groups/{group_id}.pyn')
+        with self.store.transaction():
+            for user_id in self.store.unlink_all(MEMBERS['groups'], group_id):
+                self._leave('groups', group_id, user_id)
+            self.store.unlink_all(ORG_GROUPS, right=group_id)
+            self.store.delete_entity('groups', group_id)
 
     # Organization management functions
 
+    @metrics.api_call
     def create_org(self, owner_id: str, name: str) -> str:
         """
-        Creates a new organization
+        Creates a new organization, with its owner as the first member
         :param owner_id: The user id to set as the owner
         :param name: The name of the organization
         :return: The org ID
         """
-        new_org = Node({
-            "id": str(uuid4()),
-            "name": name,
-            "owner": owner_id,
-            "members": [owner_id],
-            "groups": [],
-        })
-        new_org.save(f"db/orgs/{new_org.id()}.pyn")
-        return new_org.id()
+        org_id = str(uuid4())
+        with self.store.transaction():
+            self.store.save_entity('orgs', org_id, {
+                "id": org_id,
+                "name": name,
+                "owner": owner_id,
+                "version": 1,
+            })
+            self._enter('orgs', org_id, owner_id)
+        return org_id
 
-    def modify_org(self, org_id: str, **kwargs) -> None:
+    @metrics.api_call
+    def modify_org(self, org_id: str, expected_version: int = None, append: dict = None, remove: dict = None,
+                   **kwargs) -> Any:
         """
+        Works like modify_group. Members and groups are changed with add_member, remove_member, add_group_to_org and
+        remove_group_from_org instead.
         :param org_id: The ID of the organization
+        :param expected_version: If given, only make the change if the org is still at this version
+        :param append: {list property: [values to add], ...}
+        :param remove: {list property: [values to remove], ...}
         :param kwargs: The org properties to change and their respective new values
-        :return:
+        :return: The org's new version
         """
-        org = Node(f"db/orgs/{org_id}.pyn")
-        for kwarg in kwargs:
-            org.set(kwarg, kwargs[kwarg])
-        org.save()
+        result = self._modify('orgs', {org_id: {**kwargs, 'expected_version': expected_version, 'append': append,
+                                                'remove': remove}})
+        return result[org_id] if isinstance(result, dict) else result
 
+    @metrics.api_call
     def delete_org(self, org_id: str) -> None:
         """
-        Deletes an organization
+        Deletes an organization, removing it from its members. Its groups are kept.
         :param self:
         :param org_id: The ID of the organization to delete
         :return:
         """
-        os.remove(f'db/orgs/{org_id}.pyn')
+        with self.store.transaction():
+            for user_id in self.store.unlink_all(MEMBERS['orgs'], org_id):
+                self._leave('orgs', org_id, user_id)
+            self.store.unlink_all(ORG_GROUPS, org_id)
+            self.store.delete_entity('orgs', org_id)
+
+    @metrics.api_call
+    def modify_many(self, changes: dict, kind: str = 'groups') -> Any:
+        """
+        Changes many groups or organizations in one commit. If any of them doesn't exist or isn't at its expected
+        version, nothing is changed.
+        :param changes: {ID: {property: new value, ...}, ...}. Each change may also have expected_version, append and
+                        remove, as in modify_group.
+        :param kind: 'groups' or 'orgs'
+        :return: {ID: new version, ...}
+        """
+        return self._modify(kind, changes)
+
+    def _modify(self, kind, changes) -> Any:
+        updates = {}
+        for entity_id, change in changes.items():
+            change = dict(change)
+            updates[entity_id] = {'expected_version': change.pop('expected_version', None),
+                                  'append': change.pop('append', None), 'remove': change.pop('remove', None),
+                                  'set': change}
+        try:
+            return self.store.update_entities(kind, updates)
+        except KeyError as e:
+            return f'{ENTITY_NAMES[kind]} not found: {e.args[0]}', 404  # Not found
+        except VersionConflict as e:
+            message = f'{ENTITY_NAMES[kind]} {e.entity_id} was changed by someone else (now at version {e.version})'
+            return message, 409  # Conflict
+
+    @metrics.api_call
+    def add_group_to_org(self, org_id: str, group_id: str) -> Any:
+        """
+        :param org_id: The ID of the organization
+        :param group_id: The ID of the group
+        :return: Whether the group was added (False if it was already part of the org)
+        """
+        if self.store.load_entity('orgs', org_id) is None:
+            return f'Organization not found: {org_id}', 404  # Not found
+        if self.store.load_entity('groups', group_id) is None:
+            return f'Group not found: {group_id}', 404  # Not found
+        return self.store.link(ORG_GROUPS, org_id, group_id)
+
+    @metrics.api_call
+    def remove_group_from_org(self, org_id: str, group_id: str) -> bool:
+        """
+        :param org_id: The ID of the organization
+        :param group_id: The ID of the group
+        :return: Whether the group was removed (False if it wasn't part of the org)
+        """
+        return self.store.unlink(ORG_GROUPS, org_id, group_id)
+
+    @metrics.api_call
+    def groups_of_org(self, org_id: str, cursor: str = None, limit: int = 100) -> tuple:
+        """
+        :param org_id: The ID of the organization
+        :param cursor: The cursor returned with the previous page, if any
+        :param limit: The maximum number of group IDs to return (at least 1, or a 400 is returned)
+        :return: (group IDs, the cursor for the next page or None if this is the last one)
+        """
+        return _paginate(partial(self.store.linked, ORG_GROUPS, org_id), cursor, limit)
+
+    # Membership functions. Memberships are indexed in both directions, and listed a page at a time in ID order.
+
+    @metrics.api_call
+    def add_member(self, entity_id: str, user_id: str, kind: str = 'groups') -> Any:
+        """
+        Adds a user to a group or organization
+        :param entity_id: The ID of the group or org
+        :param user_id: The user to add
+        :param kind: 'groups' or 'orgs'
+        :return: Whether the user was added (False if they were already a member)
+        """
+        if self.store.load_entity(kind, entity_id) is None:
+            return f'{ENTITY_NAMES[kind]} not found: {entity_id}', 404  # Not found
+        if self.store.get_account(VERIFIED, user_id) is None:
+            return f'User not found: {user_id}', 404  # Not found
+        with self.store.transaction():
+            return self._enter(kind, entity_id, user_id)
+
+    @metrics.api_call
+    def remove_member(self, entity_id: str, user_id: str, kind: str = 'groups') -> bool:
+        """
+        Removes a user from a group or organization
+        :param entity_id: The ID of the group or org
+        :param user_id: The user to remove
+        :param kind: 'groups' or 'orgs'
+        :return: Whether the user was removed (False if they weren't a member)
+        """
+        with self.store.transaction():
+            if not self.store.unlink(MEMBERS[kind], entity_id, user_id):
+                return False
+            self._leave(kind, entity_id, user_id)
+        return True
+
+    @metrics.api_call
+    def members_of(self, entity_id: str, kind: str = 'groups', cursor: str = None, limit: int = 100) -> tuple:
+        """
+        :param entity_id: The ID of the group or org
+        :param kind: 'groups' or 'orgs'
+        :param cursor: The cursor returned with the previous page, if any
+        :param limit: The maximum number of user IDs to return (at least 1, or a 400 is returned)
+        :return: (user IDs, the cursor for the next page or None if this is the last one)
+        """
+        return _paginate(partial(self.store.linked, MEMBERS[kind], entity_id), cursor, limit)
+
+    @metrics.api_call
+    def groups_for_user(self, user_id: str, cursor: str = None, limit: int = 100) -> tuple:
+        """
+        :param user_id: The ID of the user
+        :param cursor: The cursor returned with the previous page, if any
+        :param limit: The maximum number of group IDs to return (at least 1, or a 400 is returned)
+        :return: (group IDs, the cursor for the next page or None if this is the last one)
+        """
+        return _paginate(partial(self.store.linked_to, MEMBERS['groups'], user_id), cursor, limit)
+
+    @metrics.api_call
+    def orgs_for_user(self, user_id: str, cursor: str = None, limit: int = 100) -> tuple:
+        """
+        :param user_id: The ID of the user
+        :param cursor: The cursor returned with the previous page, if any
+        :param limit: The maximum number of org IDs to return (at least 1, or a 400 is returned)
+        :return: (org IDs, the cursor for the next page or None if this is the last one)
+        """
+        return _paginate(partial(self.store.linked_to, MEMBERS['orgs'], user_id), cursor, limit)
+
+    def _enter(self, kind, entity_id, user_id) -> bool:
+        # Link a member, and list the group or org in their user record. Call within a transaction.
+        if not self.store.link(MEMBERS[kind], entity_id, user_id):
+            return False
+        user_db = self.store.load_user(user_id)
+        if user_db is not None and entity_id not in user_db.get(kind, []):
+            self.store.save_user(user_id, {**user_db, kind: [*user_db.get(kind, []), entity_id]})
+        return True
+
+    def _leave(self, kind, entity_id, user_id) -> None:
+        # Remove a group or org from a former member's user record. Call within a transaction.
+        user_db = self.store.load_user(user_id)
+        if user_db is not None and entity_id in user_db.get(kind, []):
+            self.store.save_user(user_id, {**user_db, kind: [i for i in user_db[kind] if i != entity_id]})
@@ -1,12 +1,14 @@
-import smtplib, ssl
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
 from pyntree import Node
 from flask import render_template
 import os
+import smtplib
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from itertools import islice
 from jinja2 import Template
 from uuid import uuid4
-from copy import copy
+from registrationAPI.mailqueue import MailQueue, SMTPPool, RateLimiter, build_message, send
+from registrationAPI.storage import LazyStore, default_store
 
 # Config
 """
@@ -15,68 +17,334 @@ SMTP_EMAIL:    str
 SMTP_ENVPASS:  str  (the name of the environment variable holding the password)
 SMTP_SERVER:   str
 SMTP_PORT:     int
-"""
 
-settings = Node('config.json')
-nocontact = Node('db/do_not_email.pyn', autosave=True)
-if nocontact() == {}:  # First-run with nocontact db
-    nocontact.emails = []
-email_ids = Node('db/email_map.pyn', autosave=True)
+And optionally:
+SMTP_SSL:        bool  (default true; disable to deliver to a local stand-in server)
+SMTP_POOL_SIZE:  int   (default 4; idle connections kept open)
+MAIL_WORKERS:    int   (default 2; delivery threads)
+MAIL_QUEUE_DIR:  str   (default db/mail, or mail in the folder given to configure() or Mailer())
+MAIL_STALE_AFTER: float (default 600; seconds before a message claimed by a process which died is sent again)
+BULK_RATE:       float (default unlimited; messages per second for send_bulk)
 
+The config file and the store are loaded on first use, so importing this module is cheap.
+The functions of this module send with a shared Mailer, set up by configure().
+"""
 
-def associate_email(email):
-    try:
-        return email_ids.get(email)._val
-    except AttributeError:
-        ID = str(uuid4())
-        email_ids.set(email, ID)
-        return ID
+templates = {}  # Compiled templates: {'path': (mtime, Template), ...}, shared by every mailer
 
 
-def send_template(template_path, subject, *recipients, ignore_unsubscribed=False, **kwargs):
+def load_template(template_path) -> Template:
     """
-    Fill and send a Jinja template
-    :param template_path: The HTML template to send
-    :param subject: The subject of the email
-    :param recipients: All emails receiving the message
-    :param ignore_unsubscribed: You can choose to ignore users who have unsubscribed
-    :param kwargs: Pass variables to the Jinja template
-    :return:
+    Compile a template, or reuse the compiled copy if the file hasn't changed since
+    :param template_path: The path of the template, relative to the templates folder
+    :return: The compiled template
     """
-    recipients = list(recipients)
-    if not ignore_unsubscribed:
-        for recipient in recipients:
-            if associate_email(recipient) in nocontact.emails():
-                recipients.remove(recipient)
+    filename = 'templates/' + template_path
+    mtime = os.stat(filename).st_mtime_ns
+    cached = templates.get(template_path)
+    if cached is None or cached[0] != mtime:
+        with open(filename, 'r') as file:
+            cached = (mtime, Template(file.read()))
+        templates[template_path] = cached
+    return cached[1]
+
+
+class Mailer:
+    def __init__(self, config=None, data_store=None, folder: str = None):
+        """
+        Sends email with one set of settings, storage and mail queue. Each API with its own data folder or config
+        has its own mailer; the functions of this module use a shared one.
+        :param config: A dict of settings, or the path of a JSON config file (default ./config.json)
+        :param data_store: Where to keep email IDs and the do-not-email list (default: the shared store)
+        :param folder: The data folder; the mail queue is kept in <folder>/mail unless MAIL_QUEUE_DIR is set
+        """
+        self.config_file = 'config.json'
+        self.settings = None  # Loaded from config_file by get_settings()
+        self.data_dir = 'db'
+        self.store = LazyStore(default_store)  # Holds the email ID map and the do-not-email list
+        self.mail_queue = None  # Started on first use by get_queue()
+        self._lock = threading.Lock()
+        self.configure(config, data_store, folder)
+
+    def configure(self, config=None, data_store=None, folder: str = None) -> None:
+        """
+        Change the settings given; the others are kept. Call this before sending anything.
+        :param config: A dict of settings, or the path of a JSON config file
+        :param data_store: Where to keep email IDs and the do-not-email list
+        :param folder: The data folder; the mail queue is kept in <folder>/mail unless MAIL_QUEUE_DIR is set
+        """
+        if self.mail_queue is not None and (config is not None or folder is not None):
+            raise RuntimeError('The mail queue has already started with the current settings')
+        if isinstance(config, dict):
+            self.settings = config
+        elif config is not None:
+            self.config_file, self.settings = config, None
+        if data_store is not None:
+            self.store = data_store
+        if folder is not None:
+            self.data_dir = folder
+
+    def get_settings(self) -> dict:
+        """
+        :return: The settings, loading them from the config file if needed
+        """
+        if self.settings is None:
+            self.settings = Node(self.config_file)()
+        return self.settings
+
+    def queue_dir(self, config: dict = None) -> str:
+        config = config if config is not None else self.get_settings()
+        return config.get('MAIL_QUEUE_DIR', f'{self.data_dir}/mail')
+
+    def make_pool(self, size: int) -> SMTPPool:
+        """
+        :param size: The maximum number of idle connections to keep open
+        :return: A connection pool for the configured SMTP server
+        """
+        config = self.get_settings()
+        return SMTPPool(
+            config['SMTP_SERVER'], config['SMTP_PORT'], config['SMTP_EMAIL'],
+            password=os.getenv(config['SMTP_ENVPASS']) if config.get('SMTP_ENVPASS') else None,
+            use_ssl=config.get('SMTP_SSL', True),
+            size=size,
+        )
 
-    message = MIMEMultipart("alternative")
-    message["Subject"] = subject
-    message["From"] = settings.SMTP_EMAIL()
-    context = ssl.create_default_context()
+    def get_queue(self) -> MailQueue:
+        """
+        :return: The mail queue, starting its delivery workers if needed
+        """
+        with self._lock:  # Never start two sets of workers
+            if self.mail_queue is None:
+                config = self.get_settings()
+                self.mail_queue = MailQueue(self.make_pool(config.get('SMTP_POOL_SIZE', 4)),
+                                            folder=self.queue_dir(config),
+                                            workers=config.get('MAIL_WORKERS', 2),
+                                            stale_after=config.get('MAIL_STALE_AFTER', 600))
+        return self.mail_queue
 
-    with smtplib.SMTP_SSL(settings.SMTP_SERVER(), settings.SMTP_PORT(), context=context) as server:
-        server.login(settings.SMTP_EMAIL(), os.getenv(settings.SMTP_ENVPASS()))
+    def close(self) -> None:
+        """
+        Stop the mail queue, if it was started, once the messages already queued have been attempted
+        """
+        with self._lock:
+            if self.mail_queue is not None:
+                self.mail_queue.close()
+                self.mail_queue = None
+
+    def associate_email(self, email):
+        return self.associate_emails([email])[email]
+
+    def associate_emails(self, emails) -> dict:
+        """
+        Look up the email IDs of several emails, minting IDs for new ones
+        :param emails: The emails to look up
+        :return: {email: email_id, ...}
+        """
+        IDs = self.store.get_email_ids(emails)
+        new = {email: str(uuid4()) for email in emails if email not in IDs}
+        if new:
+            self.store.set_email_ids(new)  # Persist every new ID in a single commit
+            IDs.update(new)
+        return IDs
+
+    def is_suppressed(self, emails) -> set:
+        """
+        :param emails: The emails to check
+        :return: The emails which must not be contacted
+        """
+        IDs = self.store.get_email_ids(emails)
+        suppressed = self.store.unsubscribed_among(IDs.values())
+        return {email for email, ID in IDs.items() if ID in suppressed}
+
+    def suppress(self, emails) -> None:
+        """
+        Stop emailing several addresses at once, e.g. after bounces or complaints
+        :param emails: The emails to add to the do-not-email list
+        """
+        self.store.unsubscribe_many(self.associate_emails(emails).values())
+
+    def send_template(self, template_path, subject, *recipients, ignore_unsubscribed=False, **kwargs):
+        """
+        Fill a Jinja template and queue it for delivery. Returns once the messages are queued, not sent.
+        :param template_path: The HTML template to send
+        :param subject: The subject of the email
+        :param recipients: All emails receiving the message
+        :param ignore_unsubscribed: You can choose to ignore users who have unsubscribed
+        :param kwargs: Pass variables to the Jinja template
+        :return: The IDs of the queued messages
+        """
+        IDs = self.associate_emails(recipients)
+        if not ignore_unsubscribed:
+            suppressed = self.store.unsubscribed_among(IDs.values())
+            recipients = [recipient for recipient in recipients if IDs[recipient] not in suppressed]
+
+        # Compile once, then render with a single context which only changes per recipient
+        template = load_template(template_path)
+        context = dict(kwargs)
+        queue = self.get_queue()
+        queued = []
         for recipient in recipients:
-            to_send = copy(message)
-            to_send["To"] = recipient
-            with open('templates/' + template_path, 'r') as file:
-                html = Template(file.read()).render(**kwargs, unsub_id=associate_email(recipient))
-            to_send.attach(MIMEText(html, "html"))
-            server.sendmail(
-                settings.SMTP_EMAIL(),
-                recipient,
-                to_send.as_string()
-            )
-
-
-def unsubscribe(email_id):
-    if not email_id:
-        return "No user ID was provided.", 400
-    elif email_id in nocontact.emails():
-        return "You have already unsubscribed.", 400
-    elif email_id not in nocontact().values():
-        return "There is no email associated with that ID", 400
-    else:
-        nocontact.emails().append(email_id)
-        nocontact.save()  # .append() doesn't trigger autosave!
-        return "You are no longer subscribed to emails from HashCards."
+            context['unsub_id'] = IDs[recipient]
+            queued.append(queue.enqueue(recipient, subject, template.render(context)))
+        return queued
+
+    def send_bulk(self, template_path, subject, recipients, campaign_id=None, chunk_size=500, rate=None,
+                  connections=4, ignore_unsubscribed=False, **kwargs) -> dict:
+        """
+        Send a template to a large, streamed list of recipients, e.g. every verified user:
+        send_bulk('email/notice.html', 'Notice', (user['email'] for _, user in store.accounts(VERIFIED)), 'notice-1')
+
+        Recipients are read one chunk at a time and each chunk is sent over its own pooled SMTP connection. Progress is
+        checkpointed after every chunk, so calling send_bulk again with the same campaign_id and the same recipients
+        (in the same order) resumes after the last completed chunk. Messages which fail are handed to the mail queue
+        to be retried.
+
+        :param template_path: The HTML template to send
+        :param subject: The subject of the email
+        :param recipients: An iterable or generator of emails
+        :param campaign_id: Names the checkpoint to resume from. A new campaign is started if not provided.
+        :param chunk_size: How many recipients to read and send at a time
+        :param rate: The maximum number of messages per second, across all connections (default: BULK_RATE)
+        :param connections: How many SMTP connections to send over in parallel
+        :param ignore_unsubscribed: You can choose to ignore users who have unsubscribed
+        :param kwargs: Pass variables to the Jinja template
+        :return: The campaign's progress: {'campaign', 'done', 'sent', 'skipped', 'failed', 'finished'}
+        """
+        config = self.get_settings()
+        campaign_id = campaign_id or str(uuid4())
+        folder = self.queue_dir(config) + '/campaigns'
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        checkpoint_path = f'{folder}/{campaign_id}.pyn'
+        if os.path.isfile(checkpoint_path):
+            progress = Node(checkpoint_path)()
+        else:
+            progress = {"campaign": campaign_id, "done": 0, "sent": 0, "skipped": 0, "failed": 0, "finished": False}
+
+        template = load_template(template_path)
+        sender = config['SMTP_EMAIL']
+        limiter = RateLimiter(rate if rate is not None else config.get('BULK_RATE'))
+        pool = self.make_pool(connections)
+
+        def send_chunk(chunk):
+            IDs = self.associate_emails(chunk)
+            suppressed = set() if ignore_unsubscribed else self.store.unsubscribed_among(IDs.values())
+            context = dict(kwargs)
+            counts = {"sent": 0, "skipped": 0, "failed": 0}
+            conn = None
+            try:
+                for recipient in chunk:
+                    if IDs[recipient] in suppressed:
+                        counts['skipped'] += 1
+                        continue
+                    context['unsub_id'] = IDs[recipient]
+                    html = template.render(context)
+                    limiter.wait()
+                    try:
+                        conn = conn or pool.acquire()
+                        send(conn, sender, recipient, build_message(sender, recipient, subject, html))
+                        counts['sent'] += 1
+                    except (smtplib.SMTPException, OSError):
+                        if conn is not None:
+                            pool.discard(conn)
+                            conn = None
+                        self.get_queue().enqueue(recipient, subject, html, sender=sender)  # Retried in the background
+                        counts['failed'] += 1
+            except BaseException:  # e.g. the template failed to render; don't leave the connection open
+                if conn is not None:
+                    pool.discard(conn)
+                raise
+            if conn is not None:
+                pool.release(conn)
+            return counts
+
+        def save_checkpoint():
+            Node(progress).save(checkpoint_path + '.tmp')
+            os.replace(checkpoint_path + '.tmp', checkpoint_path)
+
+        recipients = islice(recipients, progress['done'], None)  # Skip what a previous run already sent
+        completed = {}  # {index: (length, counts)} for chunks which finished before an earlier chunk did
+        next_chunk = 0  # The next chunk in order, whose completion moves the checkpoint forward
+        in_flight = {}  # {future: (index, length)}
+
+        def collect(finished):
+            nonlocal next_chunk
+            for future in finished:
+                chunk_index, length = in_flight.pop(future)
+                completed[chunk_index] = (length, future.result())
+            while next_chunk in completed:
+                length, counts = completed.pop(next_chunk)
+                progress['done'] += length
+                for count in counts:
+                    progress[count] += counts[count]
+                next_chunk += 1
+            save_checkpoint()
+
+        try:
+            with ThreadPoolExecutor(max_workers=connections) as executor:
+                index = 0
+                try:
+                    while True:
+                        chunk = list(islice(recipients, chunk_size))
+                        if chunk:
+                            in_flight[executor.submit(send_chunk, chunk)] = (index, len(chunk))
+                            index += 1
+                        # Only read ahead as far as there are connections to send with
+                        if in_flight and (len(in_flight) >= connections or not chunk):
+                            collect(wait(in_flight, return_when=FIRST_COMPLETED).done)
+                        if not chunk and not in_flight:
+                            break
+                finally:
+                    if in_flight:  # Interrupted; checkpoint the chunks which were already being sent
+                        collect(wait(in_flight).done)
+        finally:
+            pool.close()
+        progress['finished'] = True
+        save_checkpoint()
+        return progress
+
+    def unsubscribe(self, email_id):
+        if not email_id:
+            return "No user ID was provided.", 400
+        elif self.store.is_unsubscribed(email_id):
+            return "You have already unsubscribed.", 400
+        elif not self.store.has_email_id(email_id):
+            return "There is no email associated with that ID", 400
+        else:
+            self.store.unsubscribe(email_id)
+            return "You are no longer subscribed to emails from HashCards."
+
+
+mailer = Mailer()  # Used by the functions below, and by every API without its own data folder or config
+get_settings = mailer.get_settings
+make_pool = mailer.make_pool
+get_queue = mailer.get_queue
+associate_email = mailer.associate_email
+associate_emails = mailer.associate_emails
+is_suppressed = mailer.is_suppressed
+suppress = mailer.suppress
+send_template = mailer.send_template
+send_bulk = mailer.send_bulk
+unsubscribe = mailer.unsubscribe
+
+
+def configure(config=None, data_store=None, folder: str = None) -> None:
+    """
+    Use different settings or storage than ./config.json and the shared store for the functions of this module.
+    Call this before sending anything. To send with several configurations at once, use a Mailer for each.
+    :param config: A dict of settings, or the path of a JSON config file
+    :param data_store: Where to keep email IDs and the do-not-email list
+    :param folder: The data folder; the mail queue is kept in <folder>/mail unless MAIL_QUEUE_DIR is set
+    """
+    mailer.configure(config, data_store, folder)
+
+
+def queue_dir(config: dict = None) -> str:
+    return mailer.queue_dir(config)
+
+
+def __getattr__(name):
+    # The shared mailer's state, e.g. sendmail.store, as when it was kept in module globals
+    if name in ('config_file', 'settings', 'data_dir', 'store', 'mail_queue'):
+        return getattr(mailer, name)
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
@@ -0,0 +1,1670 @@
+import json
+import os
+import pickle
+import sqlite3
+import threading
+import time
+import zlib
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager, ExitStack
+from datetime import datetime
+from functools import lru_cache, partial
+from os import getenv, path
+from typing import Any, Iterator, Optional, Tuple
+from pyntree import Node
+from pyntree import encryption
+from registrationAPI import metrics
+from registrationAPI.cache import LRUCache
+from registrationAPI.indexes import MapIndex, ExpiryIndex, LinkIndex
+from registrationAPI.journal import Journal, file_lock
+
+try:
+    from cryptography.fernet import MultiFernet
+except ImportError:  # Encryption is optional (pip install pyntree[encryption]); encryption.check() explains
+    MultiFernet = None
+
+# Account map kinds
+VERIFIED = 'verified'
+UNVERIFIED = 'unverified'
+
+# Fields of the account maps which can be looked up directly
+INDEXED_FIELDS = {
+    VERIFIED: ('email', 'username'),
+    UNVERIFIED: ('email', 'username', 'token'),
+}
+
+DEFAULT_SALT = b'pyntree_default'  # The salt pyntree uses when only a password is given
+
+LAYOUT_FILE = '.layout'  # Present once every per-user, group and org file is in its shard folder
+BATCH_DIR = '.batches'  # Intent records of save_entities batches which may not have been applied completely
+
+# Membership relations, each linking a group or org (left) to a user or group (right)
+MEMBERS = {'groups': 'group_members', 'orgs': 'org_members'}
+ORG_GROUPS = 'org_groups'
+
+
+class VersionConflict(Exception):
+    def __init__(self, kind: str, entity_id: str, version: int):
+        """
+        Raised when a group or org has changed since the version an update expected
+        :param kind: 'groups' or 'orgs'
+        :param entity_id: The ID of the group or org
+        :param version: Its current version
+        """
+        super().__init__(f'{kind}/{entity_id} is at version {version}')
+        self.kind = kind
+        self.entity_id = entity_id
+        self.version = version
+
+
+def apply_change(entity: dict, set: dict = None, append: dict = None, remove: dict = None) -> dict:
+    """
+    :param entity: A group or org
+    :param set: {field: new value, ...}
+    :param append: {list field: [values to add if missing], ...}
+    :param remove: {list field: [values to remove], ...}
+    :return: A changed copy of entity, one version later
+    """
+    changed = {**entity, **(set or {})}
+    for field, values in (append or {}).items():
+        current = changed.get(field, [])
+        changed[field] = [*current, *(value for value in dict.fromkeys(values) if value not in current)]
+    for field, values in (remove or {}).items():
+        values = frozenset(values)
+        changed[field] = [value for value in changed.get(field, []) if value not in values]
+    changed['version'] = entity.get('version', 0) + 1  # Entities created before versioning start at 0
+    return changed
+
+
+@lru_cache(maxsize=32)
+def cipher(password: str, salt: bytes = DEFAULT_SALT, old_passwords: tuple = ()):
+    """
+    Derive the keys once per process, instead of on every encryption and decryption. The result is compatible with
+    pyntree's encrypted files.
+    :param password: The key to encrypt with
+    :param salt: The encryption salt
+    :param old_passwords: Previous keys, which records may still be encrypted with
+    :return: A cryptography MultiFernet, which encrypts with password and decrypts with any of the keys
+    """
+    encryption.check()
+    return MultiFernet([encryption.Fernet(encryption.derive_key(key, salt)) for key in (password, *old_passwords)])
+
+
+def shard_path(folder: str, record_id: str) -> str:
+    """
+    :param folder: The folder of a kind of record, e.g. db/users
+    :param record_id: The ID of the record
+    :return: The record's file, two levels of shard folders below folder (e.g. db/users/3f/a2/<id>.pyn), so that no
+             folder holds more than a few thousand files however many records there are
+    """
+    shard = f'{zlib.crc32(record_id.encode()):08x}'
+    return f'{folder}/{shard[:2]}/{shard[2:4]}/{record_id}.pyn'
+
+
+def _is_record(filename: str) -> bool:
+    return filename.endswith('.pyn') and not filename.startswith('_')  # Not a map (or a temporary file)
+
+
+def old_keys() -> tuple:
+    """
+    :return: The previous encryption key from RAPI_AUTHKEY_OLD, which is accepted while records are re-encrypted
+             under RAPI_AUTHKEY (see keyrotation.py)
+    """
+    key = getenv("RAPI_AUTHKEY_OLD")
+    return (key,) if key else ()
+
+
+def encode_user(data: dict, password: str = None, salt: bytes = DEFAULT_SALT) -> bytes:
+    """
+    Serialize (and encrypt, if a password is given) a user record. The result is both the content of a pyntree user
+    file and a SQLite user blob. This is a plain function so it can run in a worker process.
+    :param data: The user record
+    :param password: The encryption key
+    :param salt: The encryption salt
+    :return: The encoded record
+    """
+    blob = pickle.dumps(data)
+    if password:
+        start = time.perf_counter()
+        blob = cipher(password, salt).encrypt(blob)
+        if metrics.enabled:
+            metrics.observe('rapi_storage_encrypt_seconds', time.perf_counter() - start)
+    return blob
+
+
+def decode_user(blob: bytes, password: str = None, salt: bytes = DEFAULT_SALT, old_passwords: tuple = ()) -> dict:
+    """
+    The reverse of encode_user
+    :param blob: The encoded record
+    :param password: The encryption key
+    :param salt: The encryption salt
+    :param old_passwords: Previous keys, which the record may still be encrypted with
+    :return: The user record
+    """
+    if password:
+        start = time.perf_counter()
+        blob = cipher(password, salt, tuple(old_passwords)).decrypt(blob)
+        if metrics.enabled:
+            metrics.observe('rapi_storage_decrypt_seconds', time.perf_counter() - start)
+    return pickle.loads(blob)
+
+
+class Store:
+    """
+    The interface between the API and wherever its data lives.
+
+    Account maps ('verified' and 'unverified') hold small records keyed by id, which can be looked up by their
+    indexed fields. User records, groups and orgs are larger documents which are loaded and saved as a whole.
+    Records returned by a store should be treated as read-only; save a modified copy to change them.
+    """
+
+    @contextmanager
+    def transaction(self):
+        """
+        Group several changes into one commit. Transactions may be nested.
+        """
+        yield self
+
+    def refresh(self) -> bool:
+        """
+        Pick up changes made by other processes sharing the same data. Stores call this themselves where needed.
+        :return: Whether anything changed
+        """
+        return False
+
+    # Account maps
+    def get_account(self, kind: str, key: str) -> Optional[dict]:
+        raise NotImplementedError
+
+    def find_account(self, kind: str, field: str, value: Any) -> Optional[str]:
+        """
+        :param kind: VERIFIED or UNVERIFIED
+        :param field: An indexed field (see INDEXED_FIELDS)
+        :param value: The value to look for
+        :return: The id of the matching account, or None
+        """
+        raise NotImplementedError
+
+    def put_account(self, kind: str, key: str, record: dict) -> None:
+        raise NotImplementedError
+
+    def update_account(self, kind: str, key: str, **fields) -> None:
+        record = dict(self.get_account(kind, key))
+        record.update(fields)
+        self.put_account(kind, key, record)
+
+    def delete_account(self, kind: str, key: str) -> None:
+        raise NotImplementedError
+
+    def accounts(self, kind: str) -> Iterator[Tuple[str, dict]]:
+        raise NotImplementedError
+
+    def expire_accounts(self, kind: str, before: datetime) -> list:
+        """
+        Delete every account created (crtime) at or before a cutoff, in one commit
+        :param kind: VERIFIED or UNVERIFIED
+        :param before: The cutoff
+        :return: The ids of the deleted accounts
+        """
+        with self.transaction():
+            expired = [key for key, record in list(self.accounts(kind))
+                       if 'crtime' in record and record['crtime'] <= before]
+            for key in expired:
+                self.delete_account(kind, key)
+        return expired
+
+    # Social logins
+    def get_social(self, platform: str, social_name: str) -> Optional[str]:
+        raise NotImplementedError
+
+    def set_social(self, platform: str, social_name: str, user_id: str) -> None:
+        raise NotImplementedError
+
+    def delete_social(self, platform: str, social_name: str) -> None:
+        raise NotImplementedError
+
+    def socials(self) -> Iterator[Tuple[str, str, str]]:
+        """
+        :return: (platform, social_name, user_id) for every linked social account
+        """
+        raise NotImplementedError
+
+    # Per-user records
+    def load_user(self, user_id: str) -> Optional[dict]:
+        raise NotImplementedError
+
+    def save_user(self, user_id: str, data: dict) -> None:
+        raise NotImplementedError
+
+    def user_version(self, user_id: str) -> Any:
+        """
+        A cheap check for whether a user record has changed, e.g. since it was cached
+        :param user_id: The ID of the user
+        :return: A value which changes whenever the record is saved, or None if it doesn't exist
+        """
+        raise NotImplementedError
+
+    def save_user_blobs(self, blobs: dict) -> None:
+        """
+        Store several user records which have already been through encode_user()
+        :param blobs: {user_id: encoded record, ...}
+        """
+        raise NotImplementedError
+
+    def load_user_blobs(self, user_ids) -> dict:
+        """
+        The reverse of save_user_blobs
+        :param user_ids: The users to load
+        :return: {user_id: encoded record, ...} for each user which exists
+        """
+        raise NotImplementedError
+
+    def delete_user(self, user_id: str) -> None:
+        raise NotImplementedError
+
+    def user_ids(self) -> Iterator[str]:
+        raise NotImplementedError
+
+    # Groups and orgs
+    def load_entity(self, kind: str, entity_id: str) -> Optional[dict]:
+        """
+        :param kind: 'groups' or 'orgs'
+        :param entity_id: The ID of the group or org
+        :return: The entity's data, or None if it doesn't exist
+        """
+        raise NotImplementedError
+
+    def save_entity(self, kind: str, entity_id: str, data: dict) -> None:
+        raise NotImplementedError
+
+    def delete_entity(self, kind: str, entity_id: str) -> None:
+        raise NotImplementedError
+
+    def entity_ids(self, kind: str) -> Iterator[str]:
+        raise NotImplementedError
+
+    def update_entity(self, kind: str, entity_id: str, expected_version: int = None, **change) -> int:
+        """
+        Change some fields of a group or org without losing concurrent changes to the others
+        :param kind: 'groups' or 'orgs'
+        :param entity_id: The ID of the group or org
+        :param expected_version: If given, only apply the change if the entity is still at this version
+        :param change: The set, append and remove arguments of apply_change
+        :return: The new version
+        :raises KeyError: If the entity doesn't exist
+        :raises VersionConflict: If the entity isn't at expected_version
+        """
+        return self.update_entities(kind, {entity_id: {**change, 'expected_version': expected_version}})[entity_id]
+
+    def update_entities(self, kind: str, changes: dict) -> dict:
+        """
+        Apply changes to many groups or orgs in one commit. Every entity is checked before any is written, so either
+        all changes are applied or none are.
+        :param kind: 'groups' or 'orgs'
+        :param changes: {entity_id: {'set': ..., 'append': ..., 'remove': ..., 'expected_version': ...}, ...}
+        :return: {entity_id: new version, ...}
+        :raises KeyError: If an entity doesn't exist
+        :raises VersionConflict: If an entity isn't at its expected version
+        """
+        with self.transaction():
+            changed = {}
+            for entity_id, change in changes.items():
+                change = dict(change)
+                expected_version = change.pop('expected_version', None)
+                entity = self.load_entity(kind, entity_id)
+                if entity is None:
+                    raise KeyError(entity_id)
+                if expected_version is not None and entity.get('version', 0) != expected_version:
+                    raise VersionConflict(kind, entity_id, entity.get('version', 0))
+                changed[entity_id] = apply_change(entity, **change)
+            self.save_entities(kind, changed)
+        return {entity_id: entity['version'] for entity_id, entity in changed.items()}
+
+    def save_entities(self, kind: str, entities: dict) -> None:
+        """
+        :param kind: 'groups' or 'orgs'
+        :param entities: {entity_id: data, ...}
+        """
+        with self.transaction():
+            for entity_id, data in entities.items():
+                self.save_entity(kind, entity_id, data)
+
+    # Memberships. Each relation is indexed in both directions, and listed in id order so it can be paged through.
+    def link(self, relation: str, left: str, right: str) -> bool:
+        """
+        :param relation: One of MEMBERS' values, or ORG_GROUPS
+        :param left: The group or org
+        :param right: The member (a user, or a group for ORG_GROUPS)
+        :return: Whether the link is new
+        """
+        raise NotImplementedError
+
+    def unlink(self, relation: str, left: str, right: str) -> bool:
+        """
+        :return: Whether the link existed
+        """
+        raise NotImplementedError
+
+    def unlink_all(self, relation: str, left: str = None, right: str = None) -> list:
+        """
+        Remove every link of a group or org (left), or of a member (right), in one commit
+        :return: The ids at the other end of the removed links
+        """
+        with self.transaction():
+            if left is not None:
+                removed = self.linked(relation, left)
+                for other in removed:
+                    self.unlink(relation, left, other)
+            else:
+                removed = self.linked_to(relation, right)
+                for other in removed:
+                    self.unlink(relation, other, right)
+        return removed
+
+    def linked(self, relation: str, left: str, after: str = None, limit: int = None) -> list:
+        """
+        :param relation: The relation
+        :param left: The group or org
+        :param after: Only return ids sorting after this one (the cursor)
+        :param limit: The maximum number of ids to return
+        :return: The members of left, sorted
+        """
+        raise NotImplementedError
+
+    def linked_to(self, relation: str, right: str, after: str = None, limit: int = None) -> list:
+        """
+        The reverse of linked()
+        :return: The groups or orgs which right is a member of, sorted
+        """
+        raise NotImplementedError
+
+    def links(self) -> Iterator[Tuple[str, str, str]]:
+        """
+        :return: (relation, left, right) for every link
+        """
+        raise NotImplementedError
+
+    # Mail
+    def get_email_id(self, email: str) -> Optional[str]:
+        raise NotImplementedError
+
+    def get_email_ids(self, emails) -> dict:
+        """
+        :param emails: The emails to look up
+        :return: {email: email_id} for each email which has an ID
+        """
+        found = {}
+        for email in emails:
+            email_id = self.get_email_id(email)
+            if email_id is not None:
+                found[email] = email_id
+        return found
+
+    def set_email_id(self, email: str, email_id: str) -> None:
+        raise NotImplementedError
+
+    def set_email_ids(self, email_ids: dict) -> None:
+        """
+        Store several new email IDs in one commit
+        :param email_ids: {email: email_id, ...}
+        """
+        with self.transaction():
+            for email, email_id in email_ids.items():
+                self.set_email_id(email, email_id)
+
+    def find_email(self, email_id: str) -> Optional[str]:
+        """
+        :return: The email an ID belongs to, or None
+        """
+        raise NotImplementedError
+
+    def has_email_id(self, email_id: str) -> bool:
+        return self.find_email(email_id) is not None
+
+    def delete_email_ids(self, emails) -> list:
+        """
+        Forget the IDs of several emails, and take them off the do-not-email list, in one commit
+        :param emails: The emails to forget
+        :return: The IDs which were removed
+        """
+        raise NotImplementedError
+
+    def email_ids(self) -> Iterator[Tuple[str, str]]:
+        """
+        :return: (email, email_id) for every email that has been sent to
+        """
+        raise NotImplementedError
+
+    def is_unsubscribed(self, email_id: str) -> bool:
+        raise NotImplementedError
+
+    def unsubscribed_among(self, email_ids) -> set:
+        """
+        :param email_ids: The email IDs to check
+        :return: The ones which have unsubscribed
+        """
+        return {email_id for email_id in email_ids if self.is_unsubscribed(email_id)}
+
+    def unsubscribe(self, email_id: str) -> None:
+        self.unsubscribe_many([email_id])
+
+    def unsubscribe_many(self, email_ids) -> None:
+        """
+        Add several email IDs to the do-not-email list in one commit
+        """
+        raise NotImplementedError
+
+    def unsubscribed(self) -> Iterator[str]:
+        raise NotImplementedError
+
+
+class PyntreeStore(Store):
+    def __init__(self, root: str = 'db', password: str = None, old_passwords: tuple = ()):
+        """
+        The original file layout: account maps in db/users/_map*.pyn, one encrypted file per user in db/users,
+        and one file per group or org in db/groups and db/orgs. Those files are spread over shard folders (see
+        shard_path). Folders created by older versions keep their files at the old flat paths until
+        `python -m registrationAPI.storage shard` has moved them, and are read from both paths until then.
+        Several processes (e.g. gunicorn workers) may share the same folder: the maps are locked while they are
+        changed, and each process picks up the others' changes before reading them.
+        :param root: The database folder
+        :param password: The key used to encrypt per-user files
+        :param old_passwords: Previous keys, which per-user files may still be encrypted with
+        """
+        self.root = root
+        self.password = password
+        self.old_passwords = tuple(old_passwords)
+        self.salt = DEFAULT_SALT
+
+        # Create needed folders and files if they don't exist
+        new = not path.exists(f'{root}/users')
+        for d in (root, f'{root}/users', f'{root}/groups', f'{root}/orgs'):
+            os.makedirs(d, exist_ok=True)
+        if new:
+            _mark_sharded(root)
+        self.flat = not path.exists(f'{root}/{LAYOUT_FILE}')  # Whether files may still be at their old flat paths
+
+        # The maps are loaded on first use (see __getattr__), so a process only pays for the maps it needs
+        self._open_lock = threading.RLock()
+        self._lock = threading.RLock()  # Held for the duration of transaction()
+        self._lock_file = open(f'{root}/.lock', 'ab')
+        self._stack = None  # The ExitStack of the running transaction
+        self._owner = None  # The thread running it
+        os.makedirs(f'{root}/{BATCH_DIR}', exist_ok=True)
+        if os.listdir(f'{root}/{BATCH_DIR}'):  # A process died part way through save_entities
+            with file_lock(self._lock_file):
+                self._finish_batches()
+
+    # Attributes created by each group's opener
+    LAZY = {
+        'maps': '_open_accounts', 'journals': '_open_accounts', 'indexes': '_open_accounts', 'expiry': '_open_accounts',
+        'social_map': '_open_socials', 'social_journal': '_open_socials',
+        'nocontact': '_open_mail', 'nocontact_journal': '_open_mail', 'suppressed': '_open_mail',
+        'email_map': '_open_mail', 'email_journal': '_open_mail', 'email_owners': '_open_mail',
+        'email_owners_stale': '_open_mail',
+        'links_map': '_open_links', 'links_journal': '_open_links', 'link_index': '_open_links',
+    }
+
+    def __getattr__(self, name):
+        # Only called for attributes which haven't been set yet
+        opener = PyntreeStore.LAZY.get(name)
+        if opener is None:
+            raise AttributeError(name)
+        with self._open_lock:
+            if name not in self.__dict__:
+                getattr(self, opener)()
+        return self.__dict__[name]
+
+    def _open_accounts(self):
+        # The maps are not autosaved; all changes go through their journals, which compact them in the background
+        maps = {
+            VERIFIED: self._open_map(f'{self.root}/users/_map.pyn'),
+            UNVERIFIED: self._open_map(f'{self.root}/users/_map-unverified.pyn'),
+        }
+        journals = {kind: self._join(Journal(node)) for kind, node in maps.items()}
+
+        # Secondary indexes over the account maps, rebuilt on startup and kept up to date with other processes
+        self.indexes = {kind: MapIndex(node, *INDEXED_FIELDS[kind]) for kind, node in maps.items()}
+        self.expiry = {kind: ExpiryIndex(node, 'crtime') for kind, node in maps.items()}
+        for kind, journal in journals.items():
+            journal.on_record = partial(self._account_changed, kind)
+            journal.on_reload = partial(self._accounts_reloaded, kind)
+        self.maps, self.journals = maps, journals
+
+    def _open_socials(self):
+        self.social_map = self._open_map(f'{self.root}/users/_map-social.pyn')  # format: {'platform': {'name': 'id'}}
+        self.social_journal = self._join(Journal(self.social_map))
+
+    def _open_mail(self):
+        # Mail data is journaled too, and mirrored in memory for O(1) membership and reverse lookups
+        self.nocontact = self._open_map(f'{self.root}/do_not_email.pyn')
+        nocontact_journal = self._join(Journal(self.nocontact))
+        with nocontact_journal.transaction():
+            if self.nocontact() == {}:  # First-run with nocontact db
+                nocontact_journal.set('emails', [])
+        self.suppressed = set(self.nocontact.emails())
+        self.email_map = self._open_map(f'{self.root}/email_map.pyn')  # format: {'email': 'email_id', ...}
+        self.email_journal = self._join(Journal(self.email_map))
+        self.email_owners = {email_id: email for email, email_id in self.email_map().items()}
+        self.email_owners_stale = False
+        nocontact_journal.on_record = self._suppressed_changed
+        nocontact_journal.on_reload = self._suppressed_reloaded
+        self.email_journal.on_record = self._email_ids_changed
+        self.email_journal.on_reload = self._email_ids_reloaded
+        self.nocontact_journal = nocontact_journal
+
+    def _open_links(self):
+        self.links_map = self._open_map(f'{self.root}/_links.pyn')  # format: {'relation': {'left': {'right': True}}}
+        self.link_index = LinkIndex(self.links_map)
+        self.links_journal = self._join(Journal(self.links_map, on_record=self._link_changed,
+                                                on_reload=self.link_index.rebuild))
+
+    def _join(self, journal: Journal) -> Journal:
+        # A map opened during a transaction joins it
+        if self._stack is not None and self._owner == threading.get_ident():
+            self._stack.enter_context(journal.transaction())
+        return journal
+
+    def _journals(self) -> list:
+        # The journals of the maps opened so far
+        opened = self.__dict__
+        journals = list(opened['journals'].values()) if 'journals' in opened else []
+        journals += [opened[name] for name in ('social_journal', 'email_journal', 'nocontact_journal', 'links_journal')
+                     if name in opened]
+        return journals
+
+    @contextmanager
+    def transaction(self):
+        with self._lock:
+            if self._stack is not None:  # Nested
+                yield self
+                return
+            # Maps opened during the transaction lock it out of order, which the store-wide lock keeps deadlock-free
+            with file_lock(self._lock_file), ExitStack() as stack:
+                self._stack, self._owner = stack, threading.get_ident()
+                try:
+                    for journal in self._journals():
+                        stack.enter_context(journal.transaction())
+                    yield self
+                finally:
+                    self._stack = self._owner = None
+
+    def refresh(self):
+        changed = False
+        for journal in self._journals():
+            changed = journal.refresh() or changed
+        return changed
+
+    def check(self) -> list:
+        """
+        Verify that the in-memory indexes match the account maps
+        :return: A list of problems found (empty if the indexes are consistent)
+        """
+        self.refresh()
+        return [problem for index in self.indexes.values() for problem in index.check()]
+
+    # Changes picked up from other processes
+    def _account_changed(self, kind, op, path, value):
+        key = path[0]
+        if key in self.maps[kind]():
+            self.indexes[kind].add(key)
+            if op == 'set' and (len(path) == 1 or path[1] == 'crtime'):
+                self.expiry[kind].add(key)
+        else:
+            self.indexes[kind].remove(key)
+
+    def _accounts_reloaded(self, kind):
+        self.indexes[kind].rebuild()
+        self.expiry[kind].rebuild()
+
+    def _suppressed_changed(self, op, path, value):
+        if op == 'extend':
+            self.suppressed.update(value)
+        else:
+            self._suppressed_reloaded()
+
+    def _suppressed_reloaded(self):
+        self.suppressed = set(self.nocontact.emails())
+
+    def _email_ids_changed(self, op, path, value):
+        if op == 'set' and len(path) == 1:
+            self.email_owners[value] = path[0]
+        else:  # Rebuilt when next needed, so a batch of deletions costs a single rebuild
+            self.email_owners_stale = True
+
+    def _email_ids_reloaded(self):
+        self.email_owners = {email_id: email for email, email_id in self.email_map().items()}
+        self.email_owners_stale = False
+
+    def _link_changed(self, op, path, value):
+        if len(path) == 3:
+            if op == 'set':
+                self.link_index.add(*path)
+            else:
+                self.link_index.remove(*path)
+        elif len(path) == 2 and op == 'delete':
+            self.link_index.remove_left(*path)
+        elif value:  # Only empty dicts are set above the links themselves
+            self.link_index.rebuild()
+
+    def _open_map(self, filename) -> Node:
+        if not path.exists(filename):
+            # Another process may be starting up too, so create the file atomically and never replace it
+            tmp = f'{filename}.{os.getpid()}-{threading.get_ident()}.tmp'
+            with open(tmp, 'wb') as file:
+                file.write(encode_user({}))
+            try:
+                os.link(tmp, filename)
+            except FileExistsError:
+                pass
+            finally:
+                os.remove(tmp)
+        return Node(filename)
+
+    @staticmethod
+    def _open_tmp(filename):
+        # A temporary file to swap in for filename, so other processes never read a partly written file
+        tmp = f'{filename}.{os.getpid()}-{threading.get_ident()}.tmp'
+        try:
+            return tmp, open(tmp, 'wb')
+        except FileNotFoundError:  # The first file in its shard folder
+            os.makedirs(path.dirname(filename), exist_ok=True)
+            return tmp, open(tmp, 'wb')
+
+    def _write(self, filename, blob, kind):
+        tmp, file = self._open_tmp(filename)
+        with file:
+            file.write(blob)
+        os.replace(tmp, filename)
+        if metrics.enabled:
+            metrics.inc('rapi_storage_saves_total', kind=kind)
+            metrics.inc('rapi_storage_written_bytes_total', len(blob), kind=kind)
+
+    def _read_blob(self, filename, kind):
+        try:
+            with open(filename, 'rb') as file:
+                blob = file.read()
+        except FileNotFoundError:
+            return None
+        if metrics.enabled:
+            metrics.inc('rapi_storage_loads_total', kind=kind)
+            metrics.inc('rapi_storage_read_bytes_total', len(blob), kind=kind)
+        return blob
+
+    def _read(self, filename, kind, password=None):
+        blob = self._read_blob(filename, kind)
+        if blob is None:
+            return None
+        return decode_user(blob, password, self.salt, self.old_passwords if password else ())
+
+    # Per-user, group and org files
+    def _path(self, folder, record_id):
+        return shard_path(f'{self.root}/{folder}', record_id)
+
+    def _candidates(self, folder, record_id):
+        filename = self._path(folder, record_id)
+        if not self.flat:
+            return filename,
+        # Until the shard tool has finished, a file may still be at its old path, or be moved there while we look
+        return filename, f'{self.root}/{folder}/{record_id}.pyn', filename
+
+    def _load_record(self, folder, record_id, kind, password=None):
+        for filename in self._candidates(folder, record_id):
+            record = self._read(filename, kind, password)
+            if record is not None:
+                return record
+        return None
+
+    def _saved(self, folder, record_id):
+        if self.flat:  # Drop the old copy, if the shard tool hasn't moved it yet
+            try:
+                os.remove(f'{self.root}/{folder}/{record_id}.pyn')
+            except FileNotFoundError:
+                pass
+
+    def _delete_record(self, folder, record_id):
+        # The old path goes first, so the shard tool can't move the file back once it has been deleted
+        filenames = (f'{self.root}/{folder}/{record_id}.pyn', self._path(folder, record_id)) if self.flat else \
+            (self._path(folder, record_id),)
+        deleted = False
+        for filename in filenames:
+            try:
+                os.remove(filename)
+                deleted = True
+            except FileNotFoundError:
+                pass
+        if not deleted:
+            raise FileNotFoundError(self._path(folder, record_id))
+
+    def _record_ids(self, folder):
+        folder = f'{self.root}/{folder}'
+        shards = []
+        flat = set()
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    shards.append(entry.path)
+                elif _is_record(entry.name):  # Not moved into its shard folder yet
+                    flat.add(entry.name[:-len('.pyn')])
+        yield from flat
+        # Scanned after the old paths, so a file moved meanwhile is seen twice rather than missed
+        for shard in shards:
+            with os.scandir(shard) as subshards:
+                subshards = [entry.path for entry in subshards if entry.is_dir()]
+            for subshard in subshards:
+                with os.scandir(subshard) as entries:
+                    for entry in entries:
+                        if _is_record(entry.name) and entry.name[:-len('.pyn')] not in flat:
+                            yield entry.name[:-len('.pyn')]
+
+    # Account maps
+    def get_account(self, kind, key):
+        self.journals[kind].refresh()
+        return self.maps[kind]().get(key)
+
+    def find_account(self, kind, field, value):
+        self.journals[kind].refresh()
+        return self.indexes[kind].lookup(field, value)
+
+    def put_account(self, kind, key, record):
+        self.journals[kind].set(key, record)
+        self.indexes[kind].add(key, record)
+        self.expiry[kind].add(key, record)
+
+    def update_account(self, kind, key, **fields):
+        with self.journals[kind].transaction():
+            for field in fields:
+                self.journals[kind].set(key, field, fields[field])
+        self.indexes[kind].add(key)
+        if 'crtime' in fields:
+            self.expiry[kind].add(key)
+
+    def delete_account(self, kind, key):
+        self.journals[kind].delete(key)
+        self.indexes[kind].remove(key)
+
+    def accounts(self, kind):
+        self.journals[kind].refresh()
+        yield from list(self.maps[kind]().items())  # Copy, so entries can be changed while iterating
+
+    def expire_accounts(self, kind, before):
+        with self.journals[kind].transaction():
+            expired = self.expiry[kind].pop_due(before)
+            for key in expired:
+                self.delete_account(kind, key)
+        return expired
+
+    # Social logins
+    def get_social(self, platform, social_name):
+        self.social_journal.refresh()
+        return self.social_map().get(platform, {}).get(social_name)
+
+    def set_social(self, platform, social_name, user_id):
+        with self.social_journal.transaction():
+            if not self.social_map.has(platform):
+                self.social_journal.set(platform, {})
+            self.social_journal.set(platform, social_name, user_id)
+
+    def delete_social(self, platform, social_name):
+        self.social_journal.delete(platform, social_name)
+
+    def socials(self):
+        self.social_journal.refresh()
+        for platform, names in list(self.social_map().items()):
+            for social_name, user_id in list(names.items()):
+                yield platform, social_name, user_id
+
+    # Per-user records
+    def user_path(self, user_id: str) -> str:
+        return self._path('users', user_id)
+
+    def load_user(self, user_id):
+        return self._load_record('users', user_id, 'user', self.password)
+
+    def save_user(self, user_id, data):
+        self._write(self.user_path(user_id), encode_user(data, self.password, self.salt), 'user')
+        self._saved('users', user_id)
+
+    def user_version(self, user_id):
+        for filename in self._candidates('users', user_id):
+            try:
+                stat = os.stat(filename)
+            except FileNotFoundError:
+                continue
+            return stat.st_ino, stat.st_mtime_ns, stat.st_size  # Every save replaces the file
+        return None
+
+    def save_user_blobs(self, blobs):
+        for user_id, blob in blobs.items():
+            self._write(self.user_path(user_id), blob, 'user')
+            self._saved('users', user_id)
+
+    def load_user_blobs(self, user_ids):
+        blobs = {}
+        for user_id in user_ids:
+            for filename in self._candidates('users', user_id):
+                blob = self._read_blob(filename, 'user')
+                if blob is not None:
+                    blobs[user_id] = blob
+                    break
+        return blobs
+
+    def delete_user(self, user_id):
+        self._delete_record('users', user_id)
+
+    def user_ids(self):
+        return self._record_ids('users')
+
+    # Groups and orgs
+    def entity_path(self, kind: str, entity_id: str) -> str:
+        return self._path(kind, entity_id)
+
+    def load_entity(self, kind, entity_id):
+        return self._load_record(kind, entity_id, kind)
+
+    def save_entity(self, kind, entity_id, data):
+        self._write(self.entity_path(kind, entity_id), encode_user(data), kind)
+        self._saved(kind, entity_id)
+
+    def save_entities(self, kind, entities):
+        # Every file is written and synced before any is swapped in, along with an intent record listing them. If the
+        # process dies while swapping them in, the next store to open the folder or save entities finishes the batch,
+        # so either every entity is changed or none is. Until then, other running processes may see some changes.
+        with self.transaction():
+            self._finish_batches()
+            tmps = {}
+            written = 0
+            try:
+                for entity_id, data in entities.items():
+                    tmps[entity_id], file = self._open_tmp(self.entity_path(kind, entity_id))
+                    with file:
+                        written += file.write(encode_user(data))
+                        file.flush()
+                        os.fsync(file.fileno())
+                intent = self._write_intent(kind, tmps)
+            except BaseException:
+                for tmp in tmps.values():
+                    if path.exists(tmp):
+                        os.remove(tmp)
+                raise
+            self._apply_batch(kind, tmps)
+            os.remove(intent)
+        if metrics.enabled:
+            metrics.inc('rapi_storage_saves_total', len(tmps), kind=kind)
+            metrics.inc('rapi_storage_written_bytes_total', written, kind=kind)
+
+    def _write_intent(self, kind, tmps):
+        intent = f'{self.root}/{BATCH_DIR}/{os.getpid()}-{threading.get_ident()}.json'
+        with open(intent + '.tmp', 'w') as file:
+            json.dump({"kind": kind, "tmps": {entity_id: path.relpath(tmp, self.root)
+                                              for entity_id, tmp in tmps.items()}}, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(intent + '.tmp', intent)
+        _fsync_dir(f'{self.root}/{BATCH_DIR}')  # The batch is committed once its intent record is on disk
+        return intent
+
+    def _apply_batch(self, kind, tmps):
+        for entity_id, tmp in tmps.items():
+            try:
+                os.replace(tmp, self.entity_path(kind, entity_id))
+            except FileNotFoundError:  # Swapped in before the process applying the batch died
+                pass
+        for folder in {path.dirname(self.entity_path(kind, entity_id)) for entity_id in tmps}:
+            _fsync_dir(folder)  # Before the intent record is removed
+        for entity_id in tmps:
+            self._saved(kind, entity_id)
+
+    def _finish_batches(self):
+        # Called with the store locked, so any intent record left belongs to a process which died
+        for name in os.listdir(f'{self.root}/{BATCH_DIR}'):
+            intent = f'{self.root}/{BATCH_DIR}/{name}'
+            if name.endswith('.json'):
+                with open(intent) as file:
+                    batch = json.load(file)
+                self._apply_batch(batch['kind'], {entity_id: f'{self.root}/{tmp}'
+                                                  for entity_id, tmp in batch['tmps'].items()})
+            os.remove(intent)  # Including intent records which were never committed
+
+    def delete_entity(self, kind, entity_id):
+        self._delete_record(kind, entity_id)
+
+    def entity_ids(self, kind):
+        return self._record_ids(kind)
+
+    # Memberships
+    def link(self, relation, left, right):
+        with self.links_journal.transaction():
+            lefts = self.links_map().get(relation)
+            if lefts is None:
+                self.links_journal.set(relation, {})
+                lefts = self.links_map()[relation]
+            if left not in lefts:
+                self.links_journal.set(relation, left, {})
+            elif right in lefts[left]:
+                return False
+            self.links_journal.set(relation, left, right, True)  # A dict, so each change journals a single link
+            self.link_index.add(relation, left, right)
+        return True
+
+    def unlink(self, relation, left, right):
+        with self.links_journal.transaction():
+            if right not in self.links_map().get(relation, {}).get(left, {}):
+                return False
+            self.links_journal.delete(relation, left, right)
+            self.link_index.remove(relation, left, right)
+        return True
+
+    def unlink_all(self, relation, left=None, right=None):
+        with self.links_journal.transaction():
+            if left is None:
+                removed = self.link_index.linked_to(relation, right)
+                for other in removed:
+                    self.links_journal.delete(relation, other, right)
+                    self.link_index.remove(relation, other, right)
+            else:
+                removed = self.link_index.linked(relation, left)
+                if left in self.links_map().get(relation, {}):
+                    self.links_journal.delete(relation, left)  # One record, however many members there were
+                    self.link_index.remove_left(relation, left)
+        return removed
+
+    def linked(self, relation, left, after=None, limit=None):
+        self.links_journal.refresh()
+        return self.link_index.linked(relation, left, after, limit)
+
+    def linked_to(self, relation, right, after=None, limit=None):
+        self.links_journal.refresh()
+        return self.link_index.linked_to(relation, right, after, limit)
+
+    def links(self):
+        self.links_journal.refresh()
+        for relation, lefts in list(self.links_map().items()):
+            for left, rights in list(lefts.items()):
+                for right in list(rights):
+                    yield relation, left, right
+
+    # Mail
+    def get_email_id(self, email):
+        self.email_journal.refresh()
+        return self.email_map().get(email)
+
+    def get_email_ids(self, emails):
+        self.email_journal.refresh()
+        email_map = self.email_map()
+        return {email: email_map[email] for email in emails if email in email_map}
+
+    def set_email_id(self, email, email_id):
+        self.set_email_ids({email: email_id})
+
+    def set_email_ids(self, email_ids):
+        with self.email_journal.transaction():
+            for email, email_id in email_ids.items():
+                self.email_journal.set(email, email_id)
+                self.email_owners[email_id] = email
+
+    def find_email(self, email_id):
+        self.email_journal.refresh()
+        if self.email_owners_stale:
+            self._email_ids_reloaded()
+        return self.email_owners.get(email_id)
+
+    def delete_email_ids(self, emails):
+        with self.transaction():
+            email_map = self.email_map()
+            removed = {}
+            for email in emails:
+                if email in email_map:
+                    removed[email] = email_map[email]
+                    self.email_journal.delete(email)
+            for email_id in removed.values():
+                self.email_owners.pop(email_id, None)
+            unsubscribed = self.suppressed.intersection(removed.values())
+            if unsubscribed:  # The list is rewritten once for the whole batch
+                self.nocontact_journal.set('emails', [email_id for email_id in self.nocontact.emails()
+                                                      if email_id not in unsubscribed])
+                self.suppressed -= unsubscribed
+        return list(removed.values())
+
+    def email_ids(self):
+        self.email_journal.refresh()
+        yield from list(self.email_map().items())
+
+    def is_unsubscribed(self, email_id):
+        self.nocontact_journal.refresh()
+        return email_id in self.suppressed
+
+    def unsubscribed_among(self, email_ids):
+        self.nocontact_journal.refresh()
+        return self.suppressed.intersection(email_ids)
+
+    def unsubscribe_many(self, email_ids):
+        with self.nocontact_journal.transaction():
+            new = [email_id for email_id in dict.fromkeys(email_ids) if email_id not in self.suppressed]
+            if new:
+                self.nocontact_journal.extend('emails', new)
+                self.suppressed.update(new)
+
+    def unsubscribed(self):
+        self.nocontact_journal.refresh()
+        yield from list(self.nocontact.emails())
+
+
+class SQLiteStore(Store):
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS accounts (
+            kind TEXT NOT NULL,
+            id TEXT NOT NULL,
+            email TEXT,
+            username TEXT,
+            token TEXT,
+            crtime REAL,
+            data BLOB NOT NULL,
+            PRIMARY KEY (kind, id)
+        );
+        CREATE INDEX IF NOT EXISTS accounts_email ON accounts (kind, email);
+        CREATE INDEX IF NOT EXISTS accounts_username ON accounts (kind, username);
+        CREATE INDEX IF NOT EXISTS accounts_token ON accounts (kind, token);
+        CREATE INDEX IF NOT EXISTS accounts_crtime ON accounts (kind, crtime);
+        CREATE TABLE IF NOT EXISTS socials (
+            platform TEXT NOT NULL,
+            social_name TEXT NOT NULL,
+            user_id TEXT NOT NULL,
+            PRIMARY KEY (platform, social_name)
+        );
+        CREATE TABLE IF NOT EXISTS users (id TEXT PRIMARY KEY, data BLOB NOT NULL, version INTEGER NOT NULL DEFAULT 0);
+        CREATE TABLE IF NOT EXISTS entities (
+            kind TEXT NOT NULL,
+            id TEXT NOT NULL,
+            data BLOB NOT NULL,
+            PRIMARY KEY (kind, id)
+        );
+        CREATE TABLE IF NOT EXISTS links (
+            relation TEXT NOT NULL,
+            left_id TEXT NOT NULL,
+            right_id TEXT NOT NULL,
+            PRIMARY KEY (relation, left_id, right_id)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS links_reverse ON links (relation, right_id, left_id);
+        CREATE TABLE IF NOT EXISTS email_ids (email TEXT PRIMARY KEY, email_id TEXT NOT NULL UNIQUE);
+        CREATE TABLE IF NOT EXISTS unsubscribed (email_id TEXT PRIMARY KEY);
+    """
+
+    def __init__(self, filename: str = 'db/registration.sqlite3', password: str = None, salt: bytes = DEFAULT_SALT,
+                 old_passwords: tuple = ()):
+        """
+        An embedded SQLite database in WAL mode. Each thread gets its own connection.
+        :param filename: The database file
+        :param password: The key used to encrypt per-user records (same scheme as pyntree's encrypted files)
+        :param salt: The salt used with password
+        :param old_passwords: Previous keys, which per-user records may still be encrypted with
+        """
+        self.filename = filename
+        self.password = password
+        self.salt = salt
+        self.old_passwords = tuple(old_passwords)
+        self._local = threading.local()
+        folder = path.dirname(filename)
+        if folder and not path.isdir(folder):
+            os.makedirs(folder)
+        self._connection().executescript(self.SCHEMA)
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # isolation_level=None leaves transactions to us; statements are prepared once and cached per connection
+            conn = sqlite3.connect(self.filename, isolation_level=None, cached_statements=128)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')  # Durable at checkpoints, which is safe with WAL
+            self._local.conn = conn
+            self._local.depth = 0
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        conn = self._connection()
+        if not self._local.depth:
+            conn.execute('BEGIN IMMEDIATE')
+        self._local.depth += 1
+        try:
+            yield self
+        except BaseException:
+            self._local.depth -= 1
+            if not self._local.depth:
+                conn.execute('ROLLBACK')
+            raise
+        else:
+            self._local.depth -= 1
+            if not self._local.depth:
+                conn.execute('COMMIT')
+
+    def _dump(self, data, encrypt=False) -> bytes:
+        return encode_user(data, self.password if encrypt else None, self.salt)
+
+    def _load(self, blob, encrypted=False):
+        if encrypted:
+            return decode_user(blob, self.password, self.salt, self.old_passwords)
+        return decode_user(blob, None, self.salt)
+
+    def _one(self, query, *args):
+        row = self._connection().execute(query, args).fetchone()
+        return row[0] if row else None
+
+    # Account maps
+    def get_account(self, kind, key):
+        blob = self._one('SELECT data FROM accounts WHERE kind = ? AND id = ?', kind, key)
+        return self._load(blob) if blob is not None else None
+
+    def find_account(self, kind, field, value):
+        if field not in INDEXED_FIELDS[kind]:
+            raise ValueError(f'{field} is not an indexed field of {kind} accounts')
+        return self._one(f'SELECT id FROM accounts WHERE kind = ? AND {field} = ? LIMIT 1', kind, value)
+
+    def put_account(self, kind, key, record):
+        crtime = record['crtime'].timestamp() if 'crtime' in record else None
+        self._connection().execute(
+            'INSERT OR REPLACE INTO accounts (kind, id, email, username, token, crtime, data) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (kind, key, record.get('email'), record.get('username'), record.get('token'), crtime, self._dump(record))
+        )
+
+    def update_account(self, kind, key, **fields):
+        with self.transaction():
+            super().update_account(kind, key, **fields)
+
+    def delete_account(self, kind, key):
+        self._connection().execute('DELETE FROM accounts WHERE kind = ? AND id = ?', (kind, key))
+
+    def accounts(self, kind):
+        for key, blob in self._connection().execute('SELECT id, data FROM accounts WHERE kind = ?', (kind,)):
+            yield key, self._load(blob)
+
+    def expire_accounts(self, kind, before):
+        conn = self._connection()
+        with self.transaction():
+            expired = [row[0] for row in conn.execute(
+                'SELECT id FROM accounts WHERE kind = ? AND crtime <= ? ORDER BY crtime', (kind, before.timestamp())
+            )]
+            conn.executemany('DELETE FROM accounts WHERE kind = ? AND id = ?', ((kind, key) for key in expired))
+        return expired
+
+    # Social logins
+    def get_social(self, platform, social_name):
+        return self._one('SELECT user_id FROM socials WHERE platform = ? AND social_name = ?', platform, social_name)
+
+    def set_social(self, platform, social_name, user_id):
+        self._connection().execute('INSERT OR REPLACE INTO socials VALUES (?, ?, ?)', (platform, social_name, user_id))
+
+    def delete_social(self, platform, social_name):
+        self._connection().execute('DELETE FROM socials WHERE platform = ? AND social_name = ?',
+                                   (platform, social_name))
+
+    def socials(self):
+        yield from self._connection().execute('SELECT platform, social_name, user_id FROM socials')
+
+    # Per-user records
+    def load_user(self, user_id):
+        blob = self._one('SELECT data FROM users WHERE id = ?', user_id)
+        if blob is None:
+            return None
+        if metrics.enabled:
+            metrics.inc('rapi_storage_loads_total', kind='user')
+            metrics.inc('rapi_storage_read_bytes_total', len(blob), kind='user')
+        return self._load(blob, encrypted=True)
+
+    def save_user(self, user_id, data):
+        blob = self._dump(data, encrypt=True)
+        self._connection().execute('INSERT OR REPLACE INTO users VALUES (?, ?, ?)', (user_id, blob, time.time_ns()))
+        if metrics.enabled:
+            metrics.inc('rapi_storage_saves_total', kind='user')
+            metrics.inc('rapi_storage_written_bytes_total', len(blob), kind='user')
+
+    def user_version(self, user_id):
+        return self._one('SELECT version FROM users WHERE id = ?', user_id)
+
+    def save_user_blobs(self, blobs):
+        version = time.time_ns()
+        with self.transaction():
+            self._connection().executemany('INSERT OR REPLACE INTO users VALUES (?, ?, ?)',
+                                           ((user_id, blob, version) for user_id, blob in blobs.items()))
+        if metrics.enabled:
+            metrics.inc('rapi_storage_saves_total', len(blobs), kind='user')
+            metrics.inc('rapi_storage_written_bytes_total', sum(map(len, blobs.values())), kind='user')
+
+    def load_user_blobs(self, user_ids):
+        blobs = {}
+        for chunk in self._chunks(user_ids):
+            query = f'SELECT id, data FROM users WHERE id IN ({",".join("?" * len(chunk))})'
+            blobs.update(self._connection().execute(query, chunk))
+        if metrics.enabled:
+            metrics.inc('rapi_storage_loads_total', len(blobs), kind='user')
+            metrics.inc('rapi_storage_read_bytes_total', sum(map(len, blobs.values())), kind='user')
+        return blobs
+
+    def delete_user(self, user_id):
+        self._connection().execute('DELETE FROM users WHERE id = ?', (user_id,))
+
+    def user_ids(self):
+        for row in self._connection().execute('SELECT id FROM users'):
+            yield row[0]
+
+    # Groups and orgs
+    def load_entity(self, kind, entity_id):
+        blob = self._one('SELECT data FROM entities WHERE kind = ? AND id = ?', kind, entity_id)
+        return self._load(blob) if blob is not None else None
+
+    def save_entity(self, kind, entity_id, data):
+        self._connection().execute('INSERT OR REPLACE INTO entities VALUES (?, ?, ?)',
+                                   (kind, entity_id, self._dump(data)))
+
+    def save_entities(self, kind, entities):
+        with self.transaction():
+            rows = ((kind, entity_id, self._dump(data)) for entity_id, data in entities.items())
+            self._connection().executemany('INSERT OR REPLACE INTO entities VALUES (?, ?, ?)', rows)
+
+    def delete_entity(self, kind, entity_id):
+        self._connection().execute('DELETE FROM entities WHERE kind = ? AND id = ?', (kind, entity_id))
+
+    def entity_ids(self, kind):
+        for row in self._connection().execute('SELECT id FROM entities WHERE kind = ?', (kind,)):
+            yield row[0]
+
+    # Memberships
+    def link(self, relation, left, right):
+        return self._connection().execute('INSERT OR IGNORE INTO links VALUES (?, ?, ?)',
+                                          (relation, left, right)).rowcount > 0
+
+    def unlink(self, relation, left, right):
+        return self._connection().execute('DELETE FROM links WHERE relation = ? AND left_id = ? AND right_id = ?',
+                                          (relation, left, right)).rowcount > 0
+
+    def unlink_all(self, relation, left=None, right=None):
+        mine, other = ('left_id', 'right_id') if left is not None else ('right_id', 'left_id')
+        with self.transaction():
+            removed = [row[0] for row in self._connection().execute(
+                f'SELECT {other} FROM links WHERE relation = ? AND {mine} = ? ORDER BY {other}',
+                (relation, left if left is not None else right))]
+            self._connection().execute(f'DELETE FROM links WHERE relation = ? AND {mine} = ?',
+                                       (relation, left if left is not None else right))
+        return removed
+
+    def _page(self, mine, other, relation, key, after, limit):
+        # Keyset pagination over the primary key or links_reverse, so each page is a single index range scan
+        return [row[0] for row in self._connection().execute(
+            f'SELECT {other} FROM links WHERE relation = ? AND {mine} = ? AND {other} > ? ORDER BY {other} LIMIT ?',
+            (relation, key, after if after is not None else '', limit if limit is not None else -1))]
+
+    def linked(self, relation, left, after=None, limit=None):
+        return self._page('left_id', 'right_id', relation, left, after, limit)
+
+    def linked_to(self, relation, right, after=None, limit=None):
+        return self._page('right_id', 'left_id', relation, right, after, limit)
+
+    def links(self):
+        yield from self._connection().execute('SELECT relation, left_id, right_id FROM links')
+
+    def _chunks(self, values, size=500):  # Stay below SQLite's limit on bound parameters
+        values = list(values)
+        for i in range(0, len(values), size):
+            yield values[i:i + size]
+
+    # Mail
+    def get_email_id(self, email):
+        return self._one('SELECT email_id FROM email_ids WHERE email = ?', email)
+
+    def get_email_ids(self, emails):
+        found = {}
+        for chunk in self._chunks(emails):
+            query = f'SELECT email, email_id FROM email_ids WHERE email IN ({",".join("?" * len(chunk))})'
+            found.update(self._connection().execute(query, chunk))
+        return found
+
+    def set_email_id(self, email, email_id):
+        self._connection().execute('INSERT OR REPLACE INTO email_ids VALUES (?, ?)', (email, email_id))
+
+    def set_email_ids(self, email_ids):
+        with self.transaction():
+            self._connection().executemany('INSERT OR REPLACE INTO email_ids VALUES (?, ?)', email_ids.items())
+
+    def find_email(self, email_id):
+        return self._one('SELECT email FROM email_ids WHERE email_id = ?', email_id)
+
+    def email_ids(self):
+        yield from self._connection().execute('SELECT email, email_id FROM email_ids')
+
+    def delete_email_ids(self, emails):
+        conn = self._connection()
+        removed = []
+        with self.transaction():
+            for chunk in self._chunks(emails):
+                placeholders = ",".join("?" * len(chunk))
+                removed += [row[0] for row in conn.execute(
+                    f'SELECT email_id FROM email_ids WHERE email IN ({placeholders})', chunk)]
+                conn.execute(f'DELETE FROM email_ids WHERE email IN ({placeholders})', chunk)
+            conn.executemany('DELETE FROM unsubscribed WHERE email_id = ?', ((email_id,) for email_id in removed))
+        return removed
+
+    def is_unsubscribed(self, email_id):
+        return self._one('SELECT 1 FROM unsubscribed WHERE email_id = ?', email_id) is not None
+
+    def unsubscribed_among(self, email_ids):
+        found = set()
+        for chunk in self._chunks(email_ids):
+            query = f'SELECT email_id FROM unsubscribed WHERE email_id IN ({",".join("?" * len(chunk))})'
+            found.update(row[0] for row in self._connection().execute(query, chunk))
+        return found
+
+    def unsubscribe_many(self, email_ids):
+        with self.transaction():
+            self._connection().executemany('INSERT OR IGNORE INTO unsubscribed VALUES (?)',
+                                           ((email_id,) for email_id in email_ids))
+
+    def unsubscribed(self):
+        for row in self._connection().execute('SELECT email_id FROM unsubscribed'):
+            yield row[0]
+
+
+class CachedStore:
+    def __init__(self, store: Store, maxsize: int = 10000, ttl: float = 300, validate: bool = True):
+        """
+        Wraps a store with a cache of decrypted user records, so repeat reads skip disk I/O and decryption.
+        Saves are written through to the cache, and deletes invalidate it. Everything else is passed through.
+        :param store: The store to wrap
+        :param maxsize: The maximum number of cached user records
+        :param ttl: How long (in seconds) a cached record stays valid
+        :param validate: Check each cached record against store.user_version() before using it, so changes made by
+                         other processes are seen. Only disable this if a single process uses the store.
+        """
+        self.store = store
+        self.cache = LRUCache(maxsize, ttl)  # user_id -> (version, record)
+        self.validate = validate
+
+    def __getattr__(self, name):
+        return getattr(self.store, name)
+
+    @contextmanager
+    def transaction(self):
+        try:
+            with self.store.transaction():
+                yield self
+        except BaseException:
+            self.cache.clear()  # Writes made during the transaction may have been rolled back
+            raise
+
+    def load_user(self, user_id):
+        version = self.store.user_version(user_id) if self.validate else None
+        entry = self.cache.get(user_id, lambda cached: cached[0] == version)  # Stale records are misses
+        if entry is not LRUCache.MISSING:
+            if metrics.enabled:
+                metrics.inc('rapi_user_cache_hits_total')
+            return entry[1]
+        if metrics.enabled:
+            metrics.inc('rapi_user_cache_misses_total')
+        data = self.store.load_user(user_id)
+        if data is None:
+            self.cache.invalidate(user_id)
+        else:
+            self.cache.put(user_id, (version, data))
+        return data
+
+    def save_user(self, user_id, data):
+        self.store.save_user(user_id, data)
+        self.cache.put(user_id, (self.store.user_version(user_id) if self.validate else None, data))
+
+    def save_user_blobs(self, blobs):
+        for user_id in blobs:
+            self.cache.invalidate(user_id)
+        self.store.save_user_blobs(blobs)
+
+    def delete_user(self, user_id):
+        self.cache.invalidate(user_id)
+        self.store.delete_user(user_id)
+
+
+def open_store(url: str = None, password: str = None, cache_size: int = 10000, cache_ttl: float = 300,
+               old_passwords: tuple = ()) -> Store:
+    """
+    :param url: 'pyntree:<folder>' or 'sqlite:<file>'. Defaults to the pyntree layout in ./db
+    :param password: The key used to encrypt per-user records
+    :param cache_size: How many decrypted user records to keep in memory. 0 disables the cache.
+    :param cache_ttl: How long (in seconds) a cached user record stays valid
+    :param old_passwords: Previous keys, which per-user records may still be encrypted with
+    :return: The store
+    """
+    backend, _, location = (url or 'pyntree').partition(':')
+    if backend == 'pyntree':
+        store = PyntreeStore(location or 'db', password=password, old_passwords=old_passwords)
+    elif backend == 'sqlite':
+        store = SQLiteStore(location or 'db/registration.sqlite3', password=password, old_passwords=old_passwords)
+    else:
+        raise ValueError(f'Unknown storage backend: {backend}')
+    if cache_size:
+        store = CachedStore(store, maxsize=cache_size, ttl=cache_ttl)
+    return store
+
+
+def open_data_dir(data_dir: str, password: str = None, **kwargs) -> Store:
+    """
+    Open the store kept in a folder, using the backend named by RAPI_STORAGE (pyntree by default)
+    :param data_dir: The folder holding all data (the pyntree root, or the folder of the SQLite database)
+    :param password: The key used to encrypt per-user records
+    :param kwargs: Passed to open_store (the cache settings default to RAPI_USER_CACHE and RAPI_USER_CACHE_TTL, and
+                   old_passwords to RAPI_AUTHKEY_OLD)
+    :return: The store
+    """
+    backend = (getenv("RAPI_STORAGE") or 'pyntree').partition(':')[0]
+    location = f'{data_dir}/registration.sqlite3' if backend == 'sqlite' else data_dir
+    kwargs.setdefault('cache_size', int(getenv("RAPI_USER_CACHE", 10000)))
+    kwargs.setdefault('cache_ttl', float(getenv("RAPI_USER_CACHE_TTL", 300)))
+    kwargs.setdefault('old_passwords', old_keys())
+    return open_store(f'{backend}:{location}', password=password, **kwargs)
+
+
+class LazyStore:
+    def __init__(self, opener):
+        """
+        Stands in for a store which isn't opened until it is first used, so importing or constructing things which
+        hold a store stays cheap
+        :param opener: Called with no arguments to open the store
+        """
+        self.opener = opener
+        self._store = None
+        self._lock = threading.Lock()
+
+    @property
+    def store(self) -> Store:
+        if self._store is None:
+            with self._lock:
+                if self._store is None:
+                    self._store = self.opener()
+        return self._store
+
+    @property
+    def opened(self) -> bool:
+        return self._store is not None
+
+    def __getattr__(self, name):
+        return getattr(self.store, name)
+
+
+_default_store = None
+_default_store_lock = threading.Lock()
+
+
+def default_store() -> Store:
+    """
+    The store shared by the API and sendmail, configured by the RAPI_STORAGE, RAPI_AUTHKEY, RAPI_AUTHKEY_OLD,
+    RAPI_USER_CACHE (size) and RAPI_USER_CACHE_TTL environment variables
+    :return:
+    """
+    global _default_store
+    with _default_store_lock:
+        if _default_store is None:
+            _default_store = open_store(getenv("RAPI_STORAGE"), password=getenv("RAPI_AUTHKEY"),
+                                        cache_size=int(getenv("RAPI_USER_CACHE", 10000)),
+                                        cache_ttl=float(getenv("RAPI_USER_CACHE_TTL", 300)), old_passwords=old_keys())
+    return _default_store
+
+
+def migrate(source: Store, target: Store, batch_size: int = 1000, progress=print) -> int:
+    """
+    Stream every record from one store into another, committing in batches
+    :param source: The store to copy from
+    :param target: The store to copy to
+    :param batch_size: How many records to write per commit
+    :param progress: Called with a status message after each batch
+    :return: The number of records copied
+    """
+    def batches(items, copy):
+        nonlocal copied
+        items = iter(items)
+        while True:
+            with target.transaction():
+                count = 0
+                for item in items:
+                    copy(*item)
+                    count += 1
+                    if count == batch_size:
+                        break
+            copied += count
+            if progress and count:
+                progress(f'{copied} records copied')
+            if count < batch_size:
+                return
+
+    copied = 0
+    for kind in (VERIFIED, UNVERIFIED):
+        batches(source.accounts(kind), lambda key, record: target.put_account(kind, key, record))
+    batches(source.socials(), target.set_social)
+    batches(((user_id, source.load_user(user_id)) for user_id in source.user_ids()), target.save_user)
+    for kind in ('groups', 'orgs'):
+        batches(((entity_id, source.load_entity(kind, entity_id)) for entity_id in source.entity_ids(kind)),
+                lambda entity_id, data: target.save_entity(kind, entity_id, data))
+    batches(source.links(), target.link)
+    batches(source.email_ids(), target.set_email_id)
+    batches(((email_id,) for email_id in source.unsubscribed()), target.unsubscribe)
+    return copied
+
+
+def index_memberships(store: Store, progress=print) -> int:
+    """
+    Move the member lists of groups and orgs created before memberships were indexed into the store's links, and
+    list each group and org in its members' user records. Entities which have already been indexed are skipped, so
+    this can be run again if it is interrupted.
+    :param store: The store to index
+    :param progress: Called with a status message after each group or org
+    :return: The number of links added
+    """
+    added = 0
+    for kind in ('groups', 'orgs'):
+        for entity_id in list(store.entity_ids(kind)):
+            entity = store.load_entity(kind, entity_id)
+            if 'members' not in entity and 'groups' not in entity:
+                continue
+            entity = dict(entity)
+            with store.transaction():
+                for user_id in entity.pop('members', []):
+                    added += store.link(MEMBERS[kind], entity_id, user_id)
+                    user = store.load_user(user_id)
+                    if user is not None and entity_id not in user.get(kind, []):
+                        store.save_user(user_id, {**user, kind: [*user.get(kind, []), entity_id]})
+                for group_id in entity.pop('groups', []):
+                    added += store.link(ORG_GROUPS, entity_id, group_id)
+                store.save_entity(kind, entity_id, entity)
+            if progress:
+                progress(f'{kind}/{entity_id} indexed')
+    return added
+
+
+def _fsync_dir(folder: str) -> None:
+    # Make the files created, renamed or removed in a folder durable
+    if os.name == 'nt':  # Folders can't be opened, and renames are durable once they return
+        return
+    fd = os.open(folder, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _mark_sharded(root: str) -> None:
+    with open(f'{root}/{LAYOUT_FILE}', 'w') as file:
+        file.write('sharded\n')
+
+
+def _shard_batch(folder: str, record_ids: list) -> int:
+    # Runs in a worker process
+    moved = 0
+    for record_id in record_ids:
+        old, new = f'{folder}/{record_id}.pyn', shard_path(folder, record_id)
+        try:
+            try:
+                os.link(old, new)  # Unlike a rename, never replaces a newer file the app has saved at the new path
+            except FileNotFoundError:
+                os.makedirs(path.dirname(new), exist_ok=True)
+                os.link(old, new)
+        except FileExistsError:
+            pass
+        except FileNotFoundError:  # Deleted meanwhile
+            continue
+        try:
+            os.remove(old)
+            moved += 1
+        except FileNotFoundError:
+            pass
+    return moved
+
+
+def shard_files(root: str = 'db', processes: int = None, batch_size: int = 1000, progress=print) -> int:
+    """
+    Move the per-user, group and org files of a folder created by an older version from their flat paths into their
+    shard folders (see shard_path), on a process pool. The app can keep running meanwhile (as long as every process
+    runs a version which knows about shard folders), as it looks for files at both paths until this has finished.
+    Files which have already been moved are skipped, so this can be run again if it is interrupted.
+    :param root: The database folder
+    :param processes: The number of processes moving files (defaults to the number of CPUs)
+    :param batch_size: How many files each process moves at a time
+    :param progress: Called with a status message after each batch
+    :return: The number of files moved
+    """
+    moved = 0
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        for folder in ('users', 'groups', 'orgs'):
+            folder = f'{root}/{folder}'
+            with os.scandir(folder) as entries:
+                record_ids = [entry.name[:-len('.pyn')] for entry in entries
+                              if entry.is_file() and _is_record(entry.name)]
+            batches = [record_ids[start:start + batch_size] for start in range(0, len(record_ids), batch_size)]
+            for count in executor.map(partial(_shard_batch, folder), batches):
+                moved += count
+                if progress:
+                    progress(f'{moved} files moved')
+    _mark_sharded(root)  # Processes started from now on only look at the new paths
+    return moved
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Copy all registration data from one store to another, index the '
+                                        'memberships of groups and orgs created by older versions, or move their '
+                                        'files into shard folders')
+    parser.add_argument('command', choices=['migrate', 'index-memberships', 'shard'])
+    parser.add_argument('source', help="e.g. pyntree:db")
+    parser.add_argument('target', nargs='?', help="e.g. sqlite:db/registration.sqlite3 (migrate only)")
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--processes', type=int, default=None, help='(shard only)')
+    args = parser.parse_args()
+    key = getenv("RAPI_AUTHKEY")
+    if args.command == 'index-memberships':
+        print(f'Done: {index_memberships(open_store(args.source, key, cache_size=0))} memberships')
+    elif args.command == 'shard':
+        backend, _, location = args.source.partition(':')
+        if backend != 'pyntree':
+            parser.error('shard needs a pyntree store')
+        print(f'Done: {shard_files(location or "db", args.processes, args.batch_size)} files moved')
+    else:
+        if not args.target:
+            parser.error('migrate needs a target')
+        total = migrate(open_store(args.source, key, cache_size=0), open_store(args.target, key, cache_size=0),
+                        batch_size=args.batch_size)
+        print(f'Done: {total} records')
@@ -0,0 +1,63 @@
+"""
+Run from the folder containing registrationAPI: PYTHONPATH=. python -m pytest registrationAPI/tests
+"""
+import socketserver
+import threading
+import pytest
+
+
+class SMTPSink(socketserver.StreamRequestHandler):
+    # Accepts every message, recording who it was delivered to
+    def handle(self):
+        self.reply('220 sink')
+        recipients = []
+        in_data = False
+        for line in self.rfile:
+            if in_data:
+                if line.rstrip(b'\r\n') == b'.':
+                    in_data = False
+                    with self.server.lock:
+                        self.server.recipients.extend(recipients)
+                    recipients = []
+                    self.reply('250 ok')
+                continue
+            command = line[:4].upper()
+            if command == b'RCPT':
+                recipients.append(line.decode().split('<', 1)[1].split('>', 1)[0])
+                self.reply('250 ok')
+            elif command == b'DATA':
+                in_data = True
+                self.reply('354 go ahead')
+            elif command == b'QUIT':
+                self.reply('221 bye')
+                return
+            else:
+                self.reply('250 ok')
+
+    def reply(self, text):
+        self.wfile.write(text.encode() + b'\r\n')
+
+
+@pytest.fixture
+def smtp_sink():
+    """
+    A local SMTP server which accepts everything. Its recipients attribute lists every address delivered to.
+    """
+    server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), SMTPSink)
+    server.daemon_threads = True
+    server.recipients = []
+    server.lock = threading.Lock()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture(params=['pyntree', 'sqlite'])
+def store_url(request, tmp_path):
+    """
+    A store URL for each backend, in a fresh folder
+    """
+    if request.param == 'sqlite':
+        return f'sqlite:{tmp_path}/db/registration.sqlite3'
+    return f'pyntree:{tmp_path}/db'
@@ -0,0 +1,74 @@
+import multiprocessing
+from registrationAPI.storage import open_store, VERIFIED, UNVERIFIED
+
+USERS = 30
+WORKERS = 4
+HASH = 'pbkdf2_sha256:iterations=1000'
+
+
+def run(target, *args):
+    # Run target in a fresh process, as another worker of the app would
+    process = multiprocessing.get_context('spawn').Process(target=target, args=args)
+    process.start()
+    process.join(60)
+    assert process.exitcode == 0
+
+
+def _register(url, worker, results):
+    from registrationAPI.passwords import PasswordHasher
+    from registrationAPI.registration_api import API
+    api = API(store=open_store(url), hasher=PasswordHasher(HASH, workers=0))
+    registered = 0
+    for i in range(USERS):  # Every worker tries to take the same usernames
+        token = api.register(f'user{i}', f'user{i}-{worker}@example.com', 'password', send_email=False)
+        if isinstance(token, str):
+            api.verify(token)
+            registered += 1
+    results.put(registered)
+
+
+def test_concurrent_register(store_url):
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    processes = [context.Process(target=_register, args=(store_url, worker, results)) for worker in range(WORKERS)]
+    for process in processes:
+        process.start()
+    registered = [results.get(timeout=120) for _ in processes]
+    for process in processes:
+        process.join(60)
+        assert process.exitcode == 0
+
+    assert sum(registered) == USERS  # Each username was taken exactly once
+    store = open_store(store_url, cache_size=0)
+    accounts = [account for _, account in store.accounts(VERIFIED)]
+    assert sorted(account['username'] for account in accounts) == sorted(f'user{i}' for i in range(USERS))
+    assert not list(store.accounts(UNVERIFIED))
+    for i in range(USERS):
+        assert store.find_account(VERIFIED, 'username', f'user{i}') is not None
+    if hasattr(store, 'check'):
+        assert store.check() == []
+
+
+def _save_user(url, user_id, data):
+    open_store(url, cache_size=0).save_user(user_id, data)
+
+
+def _delete_user(url, user_id):
+    open_store(url, cache_size=0).delete_user(user_id)
+
+
+def test_cached_store_sees_other_process_writes(store_url):
+    store = open_store(store_url)
+    store.save_user('u1', {'name': 'old'})
+    assert store.load_user('u1') == {'name': 'old'}
+    assert store.cache.stats()['hits'] == 1
+
+    run(_save_user, store_url, 'u1', {'name': 'new'})
+    assert store.load_user('u1') == {'name': 'new'}
+    assert store.cache.stats()['misses'] == 1  # The stale record wasn't counted as a hit
+    assert store.load_user('u1') == {'name': 'new'}
+    assert store.cache.stats()['hits'] == 2
+
+    run(_delete_user, store_url, 'u1')
+    assert store.load_user('u1') is None
+    assert len(store.cache) == 0
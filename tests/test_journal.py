@@ -0,0 +1,65 @@
+import pickle
+import pytest
+from pyntree import Node
+from registrationAPI.journal import Journal
+
+
+@pytest.fixture
+def map_file(tmp_path):
+    filename = str(tmp_path / 'map.pyn')
+    Node({}).save(filename)
+    return filename
+
+
+def open_journal(filename) -> Journal:
+    return Journal(Node(filename), compact_interval=3600)  # Never compacts on its own during a test
+
+
+def test_replay_after_truncated_write(map_file):
+    journal = open_journal(map_file)
+    journal.set('a', 1)
+    journal.set('b', {'x': 2})
+    journal.set('l', [])
+    journal.extend('l', [1, 2])
+    with open(map_file + '.journal', 'ab') as file:  # A crash part way through writing the next record
+        file.write(pickle.dumps(('set', ['c'], 3))[:-3])
+
+    reopened = open_journal(map_file)
+    assert reopened.node() == {'a': 1, 'b': {'x': 2}, 'l': [1, 2]}
+
+    reopened.set('d', 4)  # Writes over the torn record
+    assert open_journal(map_file).node() == {'a': 1, 'b': {'x': 2}, 'l': [1, 2], 'd': 4}
+
+
+def test_replay_after_compaction(map_file):
+    journal = open_journal(map_file)
+    journal.set('a', 1)
+    journal.compact()
+    journal.set('b', 2)
+    assert open_journal(map_file).node() == {'a': 1, 'b': 2}
+
+
+def test_failed_transaction_is_rolled_back(map_file):
+    journal = open_journal(map_file)
+    journal.set('a', 1)
+    with pytest.raises(RuntimeError):
+        with journal.transaction():
+            journal.set('a', 2)
+            journal.set('b', 3)
+            raise RuntimeError('boom')
+    assert journal.node() == {'a': 1}
+    assert open_journal(map_file).node() == {'a': 1}
+
+    journal.set('c', 4)  # Later changes are still committed
+    assert open_journal(map_file).node() == {'a': 1, 'c': 4}
+
+
+def test_other_journal_picks_up_changes(map_file):
+    writer, reader = open_journal(map_file), open_journal(map_file)
+    writer.set('a', 1)
+    assert reader.refresh()
+    assert reader.node() == {'a': 1}
+    writer.compact()
+    writer.set('b', 2)
+    assert reader.refresh()
+    assert reader.node() == {'a': 1, 'b': 2}
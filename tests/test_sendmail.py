@@ -0,0 +1,48 @@
+import pytest
+from registrationAPI.sendmail import Mailer
+from registrationAPI.storage import open_store
+
+RECIPIENTS = [f'user{i}@example.com' for i in range(50)]
+
+
+class Interrupted(Exception):
+    pass
+
+
+@pytest.fixture
+def mailer(tmp_path, monkeypatch, smtp_sink):
+    monkeypatch.chdir(tmp_path)  # Templates are read from ./templates
+    (tmp_path / 'templates' / 'email').mkdir(parents=True)
+    (tmp_path / 'templates' / 'email' / 'notice.html').write_text('Notice {{ unsub_id }}')
+    config = {"SMTP_EMAIL": 'sender@example.com', "SMTP_SERVER": '127.0.0.1', "SMTP_PORT": smtp_sink.server_address[1],
+              "SMTP_SSL": False}
+    mailer = Mailer(config, data_store=open_store(f'pyntree:{tmp_path}/db', cache_size=0), folder=f'{tmp_path}/db')
+    yield mailer
+    mailer.close()
+
+
+def interrupted_after(count):
+    for number, recipient in enumerate(RECIPIENTS):
+        if number == count:
+            raise Interrupted
+        yield recipient
+
+
+def test_send_bulk_resumes_after_interruption(mailer, smtp_sink):
+    with pytest.raises(Interrupted):
+        mailer.send_bulk('email/notice.html', 'Notice', interrupted_after(23), campaign_id='notice', chunk_size=5,
+                         connections=2)
+    assert 0 < len(smtp_sink.recipients) < len(RECIPIENTS)
+
+    progress = mailer.send_bulk('email/notice.html', 'Notice', iter(RECIPIENTS), campaign_id='notice', chunk_size=5,
+                                connections=2)
+    assert sorted(smtp_sink.recipients) == sorted(RECIPIENTS)  # Everyone, and nobody twice
+    assert progress['finished']
+    assert progress['done'] == progress['sent'] == len(RECIPIENTS)
+
+
+def test_send_bulk_skips_suppressed(mailer, smtp_sink):
+    mailer.suppress(RECIPIENTS[:10])
+    progress = mailer.send_bulk('email/notice.html', 'Notice', iter(RECIPIENTS), chunk_size=7)
+    assert sorted(smtp_sink.recipients) == sorted(RECIPIENTS[10:])
+    assert (progress['sent'], progress['skipped']) == (40, 10)